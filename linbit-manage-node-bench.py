@@ -0,0 +1,1053 @@
+#!/usr/bin/env python
+
+"""
+Offline test bed for linbit-manage-node.py.
+
+serve
+    Runs a mock of the my.linbit.com API and of the package downloads:
+
+        linbit-manage-node-bench.py serve --port 8080 --latency 50
+        LMN_MYLINBIT_BASE=http://127.0.0.1:8080/ LMN_PACKAGES_BASE=http://127.0.0.1:8080/pkgs/ \\
+            LB_USERNAME=bench LB_PASSWORD=bench LB_CLUSTER_ID=0 ./linbit-manage-node.py
+
+run
+    Registers simulated nodes with the UrllibHandler of linbit-manage-node.py, the same requests a
+    non-interactive run does, and reports latency percentiles and throughput:
+
+        linbit-manage-node-bench.py run --nodes 500 --concurrency 16 --latency 20 --error-rate 0.01
+
+    The mock is started in-process unless --url is given. --client benchmarks another copy of the
+    script, e.g. one checked out from an older commit. --clusters seeds every contract with existing
+    clusters, --no-paging makes the mock answer the clusters listing as a whole. --gzip compresses the
+    script download for clients that accept it, a range then applies to the compressed body.
+
+models
+    Decodes a synthetic clusters answer (--clusters, --cluster-nodes) with the API records of the script,
+    runs the accesses main() does on it, builds the cluster index and places --placements nodes with it:
+
+        linbit-manage-node-bench.py models --clusters 5000
+
+kmods
+    Builds a synthetic kernel module catalog (--packages, --kernels) and picks the best package for every
+    host kernel, once with KmodIndex of the script and once with the linear scan it replaced. The linear
+    scan takes seconds per kernel on large catalogs, so it only runs for a sample of --linear-kernels:
+
+        linbit-manage-node-bench.py kmods --packages 30000 --kernels 500 --linear-kernels 20 --family sles
+
+nics
+    Builds a fake /sys/class/net with --interfaces devices in a temporary directory and collects the
+    MAC addresses with node_macs() of the script and with the listdir/open loop it replaced:
+
+        linbit-manage-node-bench.py nics --interfaces 10000 --workers 8
+
+startup
+    Measures the start up time of the subcommands that do not talk to my.linbit.com, once through the
+    sh launcher and once per interpreter given with --python:
+
+        linbit-manage-node-bench.py startup --runs 20 --python python3 --python python2
+
+The mock takes the same fault options in both modes: --latency and --jitter (ms) delay every
+response, --error-rate answers a fraction of the requests with 503, --rate limits the requests per
+second (excess requests get 429 and Retry-After) and --bandwidth limits the bytes per second of
+every response body.
+"""
+
+import argparse
+import base64
+import functools
+import json
+import math
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+CLIENT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "linbit-manage-node.py")
+TOKEN_TTL = 3600
+ARTIFACT_SIZE = 64 * 1024
+WRITE_CHUNK = 16 * 1024
+REPOS = ["drbd-9", "drbd-9.0", "drbd-proxy-3.2", "linstor-gateway", "pacemaker-2"]
+HIDDEN_REPOS = ["drbd-9.2-only"]
+
+
+def percentile(values, p):
+    """
+    :param List[float] values: sorted
+    :param float p: 0 to 100
+    :return: nearest-rank percentile, 0.0 for no values
+    :rtype: float
+    """
+    if not values:
+        return 0.0
+    rank = int(math.ceil(p / 100.0 * len(values)))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+class TokenBucket(object):
+    """
+    Allows rate requests per second on average, bursts up to one second worth of requests.
+    """
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self._tokens = self.rate
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def take(self):
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.rate, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class MockState(object):
+    """
+    Accounts, contracts, clusters and registered nodes of the mock API.
+    """
+    def __init__(self, username, password, contracts=1, clusters=0, cluster_nodes=3):
+        self.credentials = {username: password}
+        self.contracts = [{"id": i + 1, "kind_name": "Mock Support", "support_until": "2099-12-31"}
+                          for i in range(contracts)]
+        self.clusters = dict((c["id"], []) for c in self.contracts)
+        self.nodes = {}  # (contract id, hostname) -> node dict
+        self.tokens = {}  # token -> expiry
+        self.last = {}  # endpoint -> {"headers": lower case headers, "data": JSON body} of the last request
+        self.stats = {"requests": 0, "status": {}, "endpoints": {}}
+        self._next_cluster = 1
+        self.lock = threading.Lock()
+        # a large contract, the nodes of a cluster share a hostname prefix ("c12-n0", "c12-n1", ...)
+        for contract_id in self.clusters:
+            for _ in range(clusters):
+                cluster = self.create_cluster(contract_id)
+                for n in range(cluster_nodes):
+                    self.register(contract_id, cluster["id"], "c{0}-n{1}".format(cluster["id"], n), [])
+
+    def issue_token(self, username):
+        exp = int(time.time()) + TOKEN_TTL
+        payload = base64.urlsafe_b64encode(json.dumps({"sub": username, "exp": exp}).encode("utf-8"))
+        token = "e30.{0}.mock".format(payload.decode("ascii").rstrip("="))
+        with self.lock:
+            self.tokens[token] = exp
+        return token
+
+    def authorized(self, header):
+        token = (header or "")[len("Bearer "):]
+        with self.lock:
+            return self.tokens.get(token, 0) > time.time()
+
+    def create_cluster(self, contract_id):
+        with self.lock:
+            cluster = {"id": self._next_cluster, "customer_id": 1, "nodes": []}
+            self._next_cluster += 1
+            self.clusters[contract_id].append(cluster)
+            return cluster
+
+    def register(self, contract_id, cluster_id, hostname, macs):
+        with self.lock:
+            cluster = [c for c in self.clusters[contract_id] if c["id"] == cluster_id]
+            if not cluster:
+                return None
+            node = self.nodes.get((contract_id, hostname))
+            if node is None:
+                node = {"nodehash": "{0:032x}".format(random.getrandbits(128)), "cluster_id": cluster_id}
+                self.nodes[(contract_id, hostname)] = node
+                cluster[0]["nodes"].append({"hostname": hostname})
+            node["mac_addresses"] = macs
+            return node
+
+    def clusters_page(self, contract_id, offset, limit):
+        with self.lock:
+            clusters = self.clusters[contract_id]
+            return json.loads(json.dumps(clusters[offset:offset + limit] if limit is not None else clusters))
+
+    def snapshot(self, value):
+        # deep copy taken under the lock, responses are written without holding it
+        with self.lock:
+            return json.loads(json.dumps(value))
+
+    def count(self, endpoint, status):
+        with self.lock:
+            self.stats["requests"] += 1
+            self.stats["status"][str(status)] = self.stats["status"].get(str(status), 0) + 1
+            self.stats["endpoints"][endpoint] = self.stats["endpoints"].get(endpoint, 0) + 1
+
+
+def repo_configs(packages, nodehash, distribution, hidden):
+    names = REPOS + (HIDDEN_REPOS if hidden else [])
+    if distribution.startswith(("rhel", "sles")):
+        return dict((name, {"config": "baseurl={0}{1}/yum/{2}/{3}/$basearch".format(
+            packages, nodehash, distribution, name)}) for name in names)
+    codename = distribution.split("-")[-1]
+    return dict((name, {"config": "deb {0}{1}/ {2}".format(packages, nodehash, codename)}) for name in names)
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are separate writes, with Nagle every keep-alive response would wait for a delayed ACK
+    disable_nagle_algorithm = True
+
+    # endpoint name -> path pattern, ids are the groups
+    ROUTES = [
+        ("login", "POST", r"/v1/login$"),
+        ("contracts", "GET", r"/v1/my/contracts$"),
+        ("clusters", "GET", r"/v1/my/contracts/(\d+)/clusters$"),
+        ("create-cluster", "POST", r"/v1/my/contracts/(\d+)/clusters$"),
+        ("is-node-registered", "POST", r"/v1/my/contracts/(\d+)/is-node-registered$"),
+        ("register-node", "POST", r"/v1/my/contracts/(\d+)/clusters/(\d+)/register-node$"),
+        ("license-from-nodehash", "POST", r"/v1/license-from-nodehash$"),
+        ("self", "GET", r"/public/linbit-manage-node\.py$"),
+        ("stats", "GET", r"/_mock/stats$"),
+        ("packages", "GET", r"/pkgs/.+"),
+    ]
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_HEAD(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def dispatch(self, method):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        path = self.path.split("?")[0]
+        for name, route_method, pattern in self.ROUTES:
+            m = re.match(pattern, path)
+            if m and route_method == method:
+                break
+        else:
+            name, m = "unknown", None
+
+        server = self.server
+        if name == "stats":
+            return self.send_json(server.state.snapshot(server.state.stats))
+        if server.latency or server.jitter:
+            time.sleep(max(0.0, random.uniform(server.latency - server.jitter, server.latency + server.jitter)))
+        if server.bucket is not None and not server.bucket.take():
+            return self.send_json({"error": {"message": "rate limit exceeded"}}, 429, name, [("Retry-After", "1")])
+        if server.error_rate and random.random() < server.error_rate:
+            return self.send_json({"error": {"message": "injected error"}}, 503, name)
+        if m is None:
+            return self.send_json({"error": {"message": "not found"}}, 404, name)
+        # the license of a registered node only needs its nodehash, reruns get it without logging in
+        public = ("login", "self", "packages", "license-from-nodehash")
+        if name not in public and not server.state.authorized(self.headers.get("Authorization")):
+            return self.send_json({"error": {"message": "unauthorized"}}, 401, name)
+
+        try:
+            data = json.loads(body.decode("utf-8")) if body else {}
+        except ValueError:
+            return self.send_json({"error": {"message": "invalid JSON"}}, 400, name)
+        with server.state.lock:
+            server.state.last[name] = {"headers": dict((k.lower(), v) for k, v in self.headers.items()), "data": data}
+        getattr(self, "handle_" + name.replace("-", "_"))(name, data, *[int(x) for x in m.groups()])
+
+    def send_json(self, obj, status=200, endpoint="stats", headers=()):
+        self.send_body(json.dumps(obj).encode("utf-8"), status, endpoint, "application/json", headers)
+
+    def send_body(self, body, status=200, endpoint="stats", content_type="application/octet-stream", headers=()):
+        if endpoint != "stats":
+            self.server.state.count(endpoint, status)
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in headers:
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command == "HEAD":
+            return
+        if not self.server.bandwidth:
+            self.wfile.write(body)
+            return
+        for i in range(0, len(body), WRITE_CHUNK):
+            chunk = body[i:i + WRITE_CHUNK]
+            self.wfile.write(chunk)
+            time.sleep(len(chunk) / float(self.server.bandwidth))
+
+    def handle_login(self, name, data):
+        state = self.server.state
+        if data.get("user") not in state.credentials or state.credentials[data.get("user")] != data.get("pass"):
+            return self.send_json({"error": {"message": "invalid credentials"}}, 401, name)
+        self.send_json({"data": {"access_token": state.issue_token(data["user"])}}, endpoint=name)
+
+    def handle_contracts(self, name, data):
+        self.send_json({"data": {"list": self.server.state.contracts}}, endpoint=name)
+
+    def contract_exists(self, name, contract_id):
+        if contract_id in self.server.state.clusters:
+            return True
+        self.send_json({"error": {"message": "unknown contract"}}, 404, name)
+        return False
+
+    def handle_clusters(self, name, data, contract_id):
+        if not self.contract_exists(name, contract_id):
+            return
+        query = dict(x.partition("=")[::2] for x in self.path.partition("?")[2].split("&") if x)
+        offset, limit = 0, None
+        if self.server.paging and "limit" in query:
+            try:
+                offset, limit = int(query.get("offset", 0)), int(query["limit"])
+            except ValueError:
+                return self.send_json({"error": {"message": "invalid offset/limit"}}, 400, name)
+        self.send_json({"data": {"list": self.server.state.clusters_page(contract_id, offset, limit)}}, endpoint=name)
+
+    def handle_create_cluster(self, name, data, contract_id):
+        if self.contract_exists(name, contract_id):
+            self.send_json({"data": {"id": self.server.state.create_cluster(contract_id)["id"]}}, endpoint=name)
+
+    def handle_is_node_registered(self, name, data, contract_id):
+        if self.contract_exists(name, contract_id):
+            with self.server.state.lock:
+                node = self.server.state.nodes.get((contract_id, data.get("hostname")))
+                node = dict(node) if node else {}
+            node.pop("mac_addresses", None)
+            self.send_json({"data": node}, endpoint=name)
+
+    def handle_register_node(self, name, data, contract_id, cluster_id):
+        if not self.contract_exists(name, contract_id):
+            return
+        node = self.server.state.register(contract_id, cluster_id, data.get("hostname"), data.get("mac_addresses"))
+        if node is None:
+            return self.send_json({"error": {"message": "unknown cluster"}}, 404, name)
+        repos = repo_configs(self.server.packages, node["nodehash"], data.get("distribution", ""),
+                             data.get("hidden_repos"))
+        self.send_json({"data": {"nodehash": node["nodehash"], "cluster_id": cluster_id, "repo_config": "",
+                                 "repos": repos}}, endpoint=name)
+
+    def handle_license_from_nodehash(self, name, data):
+        with self.server.state.lock:
+            known = [n for n in self.server.state.nodes.values() if n["nodehash"] == data.get("nodehash")]
+        if not known:
+            return self.send_json({"error": {"message": "unknown nodehash"}}, 404, name)
+        lic = "# mock DRBD Proxy license\nnodehash={0}\n".format(data["nodehash"])
+        self.send_json({"data": {"license_file_content": base64.b64encode(lic.encode("utf-8")).decode("ascii")}},
+                       endpoint=name)
+
+    def handle_self(self, name, data):
+        body = self.server.script
+        headers = [("ETag", '"{0}"'.format(len(body))), ("Accept-Ranges", "bytes")]
+        if self.server.gzip and "gzip" in (self.headers.get("Accept-Encoding") or ""):
+            compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+            headers = [("ETag", '"{0}-gzip"'.format(len(body))), ("Accept-Ranges", "bytes"),
+                       ("Content-Encoding", "gzip"), ("Vary", "Accept-Encoding")]
+        m = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range") or "")
+        if m:
+            end = int(m.group(2)) if m.group(2) else len(body) - 1
+            return self.send_body(body[int(m.group(1)):end + 1], 206, name, headers=headers)
+        self.send_body(body, endpoint=name, headers=headers)
+
+    def handle_packages(self, name, data):
+        if self.headers.get("If-None-Match") == '"mock"':
+            return self.send_body(b"", 304, name)
+        seed = self.path.encode("utf-8") + b"\n"
+        body = (seed * (self.server.artifact_size // len(seed) + 1))[:self.server.artifact_size]
+        self.send_body(body, endpoint=name, headers=[("ETag", '"mock"')])
+
+
+class MockServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, args):
+        HTTPServer.__init__(self, address, MockHandler)
+        self.state = MockState(args.user, args.password, args.contracts, args.clusters, args.cluster_nodes)
+        self.paging = args.paging
+        self.gzip = args.gzip
+        self.latency = args.latency / 1000.0
+        self.jitter = args.jitter / 1000.0
+        self.error_rate = args.error_rate
+        self.bucket = TokenBucket(args.rate) if args.rate else None
+        self.bandwidth = args.bandwidth
+        self.artifact_size = args.artifact_size
+        self.verbose = getattr(args, "verbose", False)
+        with open(args.client, "rb") as f:
+            self.script = f.read()
+        self.url = "http://{0}:{1}/".format(*self.server_address[:2])
+        self.packages = self.url + "pkgs/"
+
+
+def start_mock(args, port=0):
+    server = MockServer((args.host, port), args)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def load_client(path, url=None):
+    """
+    Loads linbit-manage-node.py as a module dict, pointed at url if given.
+    """
+    if url is not None:
+        os.environ["LMN_MYLINBIT_BASE"] = url
+        os.environ["LMN_PACKAGES_BASE"] = url + "pkgs/"
+    # not runpy.run_path(), python2 clears the globals the functions still use when it returns
+    namespace = {"__name__": "linbit_manage_node", "__file__": path}
+    with open(path) as f:
+        exec(compile(f.read(), path, "exec"), namespace)
+    return namespace
+
+
+class Recorder(object):
+    """
+    Collects the duration of every API call and registration.
+    """
+    def __init__(self):
+        self.durations = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, duration):
+        with self._lock:
+            self.durations.setdefault(name, []).append(duration)
+
+    def error(self, reason):
+        with self._lock:
+            self.errors[reason] = self.errors.get(reason, 0) + 1
+
+    def timed(self, name, func, *args, **kwargs):
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.add(name, time.time() - start)
+
+
+def register(lmn, args, recorder, i, tmpdir):
+    """
+    Does the requests of a non-interactive run (LB_CLUSTER_ID=0) for simulated node i.
+
+    :return: True if the node got registered
+    :rtype: bool
+    """
+    hostname = "bench-{0}".format(i % args.hosts)
+    macs = ["52:54:00:{0:02x}:{1:02x}:{2:02x}".format((i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff)]
+    if args.retries is None:
+        urlhandler = lmn["UrllibHandler"]()
+    else:
+        pool = lmn["HTTPConnectionPool"](retry_policy=lmn["RetryPolicy"](attempts=args.retries))
+        urlhandler = lmn["UrllibHandler"](pool=pool)
+    headers = lmn["create_headers"](args.user)
+    start = time.time()
+    try:
+        if recorder.timed("login", urlhandler.login, headers, args.user, args.password) != 200:
+            recorder.error("login failed")
+            return False
+        contracts = recorder.timed("contracts", urlhandler.get_request, lmn["CONTRACT_URL"], headers,
+                                   lmn["ContractsResponse"])
+        contract_id = contracts.data().list[0].id
+        reg_node = recorder.timed("is-node-registered", urlhandler.post_is_node_registered, headers,
+                                  contract_id=contract_id, hostname=hostname, mac_addresses=macs)
+        if reg_node is not None:
+            cluster_id = reg_node.cluster_id
+        else:
+            if "ClusterIndex" in lmn:
+                cluster_id = recorder.timed("clusters", urlhandler.get_cluster_index, headers, contract_id,
+                                            lmn["ClusterIndex"](())).last
+            else:
+                # older copies of the script
+                clusters = recorder.timed("clusters", urlhandler.get_request, lmn["CLUSTER_URL"].format(contract_id),
+                                          headers, lmn["ClustersResponse"]).data().list
+                cluster_id = clusters[-1].id if clusters else None
+            if cluster_id is None:
+                cluster_id = recorder.timed("create-cluster", urlhandler.post_create_cluster, headers, contract_id).id
+        answer = recorder.timed("register-node", urlhandler.post_register_node, headers,
+                                contract_id=contract_id, cluster_id=cluster_id, hostname=hostname,
+                                distribution=args.distribution, mac_addresses=macs,
+                                register_version=lmn["REMOTEVERSION"], hidden_repos=False)
+        if answer.is_error():
+            recorder.error(answer.error_msg())
+            return False
+        ret = answer.data()
+        recorder.timed("license-from-nodehash", urlhandler.post_license_from_nodehash, headers, ret.nodehash,
+                       mac_addresses=macs, hostname=hostname, contract_id=contract_id, cluster_id=cluster_id)
+        if args.downloads:
+            rpm = args.distribution.startswith(("rhel", "sles"))
+            urls = [lmn["GPG_KEYRING_RPM"] if rpm else lmn["GPG_KEYRING_DEB"]]
+            if args.distribution.startswith("rhel"):
+                urls += [lmn["LINBIT_PLUGIN"], lmn["LINBIT_PLUGIN_CONF"]]
+            for url in urls:
+                recorder.timed("download", urlhandler.download, url,
+                               os.path.join(tmpdir, "{0}-{1}".format(i, os.path.basename(url))))
+    except SystemExit as e:
+        # err() of the client, its message went to the (muted) stdout
+        recorder.error("exit code {0}".format(e.code))
+        return False
+    except Exception as e:
+        recorder.error(str(e))
+        return False
+    recorder.add("registration", time.time() - start)
+    return True
+
+
+def run_benchmark(args):
+    server = None
+    url = args.url
+    if url is None:
+        server = start_mock(args)
+        url = server.url
+    if not url.endswith("/"):
+        url += "/"
+    lmn = load_client(args.client, url)
+
+    recorder = Recorder()
+    tmpdir = tempfile.mkdtemp(prefix="lmn-bench-")
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    start = time.time()
+    try:
+        results = lmn["parallel_map"](lambda i: register(lmn, args, recorder, i, tmpdir),
+                                      range(args.nodes), args.concurrency)
+    finally:
+        elapsed = time.time() - start
+        sys.stdout.close()
+        sys.stdout = stdout
+        for name in os.listdir(tmpdir):
+            os.unlink(os.path.join(tmpdir, name))
+        os.rmdir(tmpdir)
+
+    calls = sum(len(v) for k, v in recorder.durations.items() if k != "registration")
+    report = {
+        "client": args.client,
+        "url": url,
+        "nodes": args.nodes,
+        "concurrency": args.concurrency,
+        "elapsed": elapsed,
+        "registered": results.count(True),
+        "failed": results.count(False),
+        "registrations_per_sec": results.count(True) / elapsed,
+        "api_calls": calls,
+        "api_calls_per_sec": calls / elapsed,
+        "errors": recorder.errors,
+        "latency": {},
+    }
+    for name, values in recorder.durations.items():
+        values.sort()
+        report["latency"][name] = {
+            "count": len(values),
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+            "p99": percentile(values, 99),
+            "max": values[-1],
+        }
+    if server is not None:
+        report["server"] = server.state.snapshot(server.state.stats)
+        report["http_requests_per_sec"] = report["server"]["requests"] / elapsed
+        server.shutdown()
+    return report
+
+
+def print_report(report):
+    print("{0} of {1} registrations in {2:.2f}s ({3:.1f}/s), {4} API calls ({5:.1f}/s)".format(
+        report["registered"], report["nodes"], report["elapsed"], report["registrations_per_sec"],
+        report["api_calls"], report["api_calls_per_sec"]))
+    if "server" in report:
+        print("mock: {0} HTTP requests ({1:.1f}/s), status {2}".format(
+            report["server"]["requests"], report["http_requests_per_sec"],
+            ", ".join("{0}: {1}".format(k, v) for k, v in sorted(report["server"]["status"].items()))))
+    for reason, count in sorted(report["errors"].items()):
+        print("failed: {0}x {1}".format(count, reason))
+    fmt = "{0:<22} {1:>6} {2:>9} {3:>9} {4:>9} {5:>9}"
+    print("")
+    print(fmt.format("latency (ms)", "count", "p50", "p95", "p99", "max"))
+    order = ["registration", "login", "contracts", "is-node-registered", "clusters", "create-cluster",
+             "register-node", "license-from-nodehash", "download"]
+    for name in sorted(report["latency"], key=lambda n: order.index(n) if n in order else len(order)):
+        row = report["latency"][name]
+        print(fmt.format(name, row["count"], *["{0:.1f}".format(row[k] * 1000) for k in ("p50", "p95", "p99", "max")]))
+
+
+def models_benchmark(args):
+    """
+    :return: (case name, sorted durations in seconds), peak memory of decoding and choosing in bytes (None on python2)
+    :rtype: Tuple[List[Tuple[str, List[float]]], Optional[int]]
+    """
+    lmn = load_client(args.client)
+    APIAnswer, ClustersResponse = lmn["APIAnswer"], lmn["ClustersResponse"]
+    raw = json.dumps({"data": {"list": [
+        {"id": i, "customer_id": 1, "nodes": [{"hostname": "c{0}-n{1}".format(i, n)} for n in range(args.cluster_nodes)]}
+        for i in range(args.clusters)]}})
+
+    def decode():
+        return APIAnswer(json.loads(raw), ClustersResponse).data()
+
+    def choose(clusters):
+        # what main() does with the clusters: the last one for LB_CLUSTER_ID=0, the options of the cluster question.
+        # written like the original main(), so older copies of the script can be benchmarked as well
+        cluster_list = clusters.list
+        last = cluster_list[len(cluster_list) - 1].id
+        opts = {}
+        for x in clusters.list:
+            opts[x.id] = " ".join([y.hostname for y in x.nodes]) if x.nodes else None
+        return last, opts
+
+    decoded = decode()
+    cases = [
+        ("json.loads", lambda: json.loads(raw)),
+        ("decode", decode),
+        ("choose", lambda: choose(decoded)),
+        ("decode + choose", lambda: choose(decode())),
+    ]
+    if "ClusterIndex" in lmn:
+        placement = lmn["ClusterPlacement"](lmn["CLUSTER_SUGGESTION"].split(","))
+
+        def index():
+            idx = placement.index()
+            idx.update(decoded.list)
+            return idx
+
+        def place(idx):
+            # new nodes of existing clusters, every second one only matches by prefix
+            for i in range(args.placements):
+                placement.place(idx, "c{0}-n{1}".format(i % args.clusters, args.cluster_nodes + i % 2))
+
+        indexed = index()
+        cases += [
+            ("index", index),
+            ("place {0} nodes".format(args.placements), lambda: place(indexed)),
+        ]
+    results = []
+    for name, func in cases:
+        durations = []
+        for _ in range(args.runs):
+            start = time.time()
+            func()
+            durations.append(time.time() - start)
+        results.append((name, sorted(durations)))
+
+    peak = None
+    try:
+        import tracemalloc
+    except ImportError:
+        pass
+    else:
+        tracemalloc.start()
+        choose(decode())
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return results, peak
+
+
+def print_models(results, peak):
+    fmt = "{0:<32} {1:>6} {2:>9} {3:>9} {4:>9}"
+    print(fmt.format("clusters answer (ms)", "runs", "min", "p50", "p95"))
+    for name, values in results:
+        print(fmt.format(name, len(values), *["{0:.1f}".format(v * 1000) for v in
+                                               (values[0], percentile(values, 50), percentile(values, 95))]))
+    if peak is not None:
+        print("peak memory of decode + choose: {0:.1f} MiB".format(peak / 1024.0 / 1024.0))
+
+
+def kmod_catalog(family, packages, kernels, seed=1):
+    """
+    :return: package names and host kernels ("uname -r") in the naming of the family
+    :rtype: Tuple[List[str], List[str]]
+    """
+    rnd = random.Random(seed)
+    bases = ["4.18.0", "5.14.0"] if family == "rhel" else ["5.3.18", "5.14.21"]
+    catalog = []
+    while len(catalog) < packages:
+        base = rnd.choice(bases)
+        drbd = "9.{0}.{1}".format(rnd.randint(0, 2), rnd.randint(0, 20))
+        release = [rnd.randint(1, 600), rnd.randint(0, 60), rnd.randint(0, 9)]
+        if family == "rhel":
+            catalog.append("kmod-drbd-{0}_{1}_{2}.{3}.{4}.el9_{5}.x86_64-1.x86_64.rpm".format(
+                drbd, base, release[0], release[1], release[2], rnd.randint(0, 4)))
+        else:
+            catalog.append("drbd-kmp-default-{0}_k{1}_150500.{2}.{3}-1.x86_64.rpm".format(
+                drbd, base, release[0], release[1]))
+    hosts = []
+    for _ in range(kernels):
+        base = rnd.choice(bases)
+        if family == "rhel":
+            hosts.append("{0}-{1}.{2}.{3}.el9_{4}.x86_64".format(
+                base, rnd.randint(1, 620), rnd.randint(0, 60), rnd.randint(0, 9), rnd.randint(0, 4)))
+        else:
+            hosts.append("{0}-150500.{1}.{2}-default".format(base, rnd.randint(1, 620), rnd.randint(0, 60)))
+    return catalog, hosts
+
+
+def linear_best_kmod(choices, hostkernel, sles=False):
+    """
+    The selection best_drbd_kmod() did before KmodIndex: every package is parsed and compared for every
+    host kernel.
+    """
+    hostkernelsplit = hostkernel.replace('-', '.').split('.')[::-1]
+    for i, e in enumerate(hostkernelsplit):
+        if e.isdigit():
+            hostkernelsplit = hostkernelsplit[i:][::-1]
+            break
+
+    kmap = {}
+    for c in choices:
+        kpart = os.path.basename(c)
+        if not (kpart.startswith('kmod-drbd') or kpart.startswith('drbd-kmp')):
+            continue
+        kpart = '_'.join(kpart.split('_')[1:])
+        if sles and kpart[0] == 'k':
+            kpart = kpart[1:]
+        kpart = kpart.split('-')[0].replace('_', '.', 1)
+        kps = [a for a in kpart.split('.') if a.isdigit()]
+        if len(kps) < 3 or kps[:3] != hostkernelsplit[:3]:
+            continue
+        kmap['.'.join(kps[3:])] = c
+
+    hks_base = hostkernelsplit[3:]
+
+    def kcmp(v1, v2):
+        v1s, v2s, hks = v1.split('.'), v2.split('.'), list(hks_base)
+        ml = max(len(hks), len(v1s), len(v2s))
+        for lst in (v1s, v2s, hks):
+            lst += [0] * (ml - len(lst))
+        for i, e in enumerate(hks):
+            e = int(e)
+            d1 = e - int(v1s[i])
+            d2 = e - int(v2s[i])
+            if d1 == d2:
+                continue
+            if d1 >= 0 and d2 >= 0:
+                return v1 if d1 < d2 else v2
+            elif d1 >= 0:
+                return v1
+            elif d2 >= 0:
+                return v2
+            return v2 if d1 < d2 else v1
+        return v1
+
+    if not kmap:
+        return None
+    return kmap[functools.reduce(kcmp, kmap.keys())]
+
+
+def kmods_benchmark(args):
+    """
+    :return: (case name, sorted durations in seconds), number of sampled host kernels with a different answer
+    :rtype: Tuple[List[Tuple[str, List[float]]], Optional[int]]
+    """
+    lmn = load_client(args.client)
+    sles = args.family == "sles"
+    catalog, hosts = kmod_catalog(args.family, args.packages, args.kernels)
+    sample = random.Random(1).sample(hosts, min(args.linear_kernels, len(hosts)))
+
+    cases = [("linear scan x {0} kernels".format(len(sample)),
+              lambda: dict((k, linear_best_kmod(catalog, k, sles)) for k in sample))]
+    mismatches = None
+    if "KmodIndex" in lmn:
+        KmodIndex = lmn["KmodIndex"]
+        index = KmodIndex(catalog, sles=sles)
+        cases += [
+            ("KmodIndex build", lambda: KmodIndex(catalog, sles=sles)),
+            ("KmodIndex query x {0} kernels".format(len(hosts)), lambda: index.best_many(hosts)),
+            ("build + query", lambda: KmodIndex(catalog, sles=sles).best_many(hosts)),
+        ]
+        expected = cases[0][1]()
+        mismatches = sum(1 for k, v in index.best_many(sample).items() if expected[k] != v)
+
+    results = []
+    for name, func in cases:
+        durations = []
+        for _ in range(args.runs):
+            start = time.time()
+            func()
+            durations.append(time.time() - start)
+        results.append((name, sorted(durations)))
+    return results, mismatches
+
+
+def print_kmods(results, mismatches):
+    fmt = "{0:<32} {1:>6} {2:>9} {3:>9} {4:>9}"
+    print(fmt.format("kmod selection (ms)", "runs", "min", "p50", "p95"))
+    for name, values in results:
+        print(fmt.format(name, len(values), *["{0:.1f}".format(v * 1000) for v in
+                                               (values[0], percentile(values, 50), percentile(values, 95))]))
+    if mismatches is not None:
+        print("sampled host kernels where KmodIndex differs from the linear scan: {0}".format(mismatches))
+
+
+def fake_classnet(root, interfaces, seed=1):
+    """
+    Creates a sysfs like class/net below root: every device is a symlink to devices/<name> holding
+    type, addr_assign_type and address. A mix of lo, ethernet, infiniband, virtual and random MAC
+    devices, some without addr_assign_type like on very old kernels.
+
+    :return: path of the class/net directory
+    :rtype: str
+    """
+    rnd = random.Random(seed)
+    classnet = os.path.join(root, "class", "net")
+    devices = os.path.join(root, "devices")
+    os.makedirs(classnet)
+    os.makedirs(devices)
+    kinds = [("eth", "1", "0"), ("eth", "1", "3"), ("ib", "32", "0"), ("vnet", "1", "1"),
+             ("eth", "1", "1"), ("bond", "1", None)]
+    names = ["lo"] + ["{0}{1}".format(rnd.choice(kinds)[0], i) for i in range(interfaces - 1)]
+    for name in names:
+        prefix = name.rstrip("0123456789")
+        dev_type, aatype = ("772", "0") if name == "lo" else \
+            rnd.choice([(t, a) for p, t, a in kinds if p == prefix])
+        path = os.path.join(devices, name)
+        os.mkdir(path)
+        attrs = {"type": dev_type, "address": ":".join("{0:02x}".format(rnd.randint(0, 255)) for _ in range(6))}
+        if aatype is not None:
+            attrs["addr_assign_type"] = aatype
+        for attr, value in attrs.items():
+            with open(os.path.join(path, attr), "w") as f:
+                f.write(value + "\n")
+        os.symlink(os.path.join("..", "..", "devices", name), os.path.join(classnet, name))
+    # a regular file, like bonding_masters, that is not a device
+    with open(os.path.join(classnet, "bonding_masters"), "w") as f:
+        f.write("\n")
+    return classnet
+
+
+def listdir_node_macs(usable_nic, classnet):
+    """
+    The collection getHostInfo() did before node_macs(): listdir, islink and isfile per device and
+    a buffered open for every attribute.
+    """
+    macs = set()
+    for dev in os.listdir(classnet):
+        devpath = os.path.join(classnet, dev)
+        if not os.path.islink(devpath):
+            continue
+        with open(os.path.join(devpath, "type")) as t:
+            dev_type = t.readline().strip()
+        dev_aatype = None
+        addr_assign_path = os.path.join(devpath, "addr_assign_type")
+        if os.path.isfile(addr_assign_path):
+            with open(addr_assign_path) as a:
+                dev_aatype = a.readline().strip()
+        if not usable_nic(dev, dev_type, dev_aatype):
+            continue
+        with open(os.path.join(devpath, "address")) as addr:
+            macs.add(addr.readline().strip())
+    return macs
+
+
+def nics_benchmark(args):
+    """
+    :return: (case name, sorted durations in seconds), whether node_macs() found other MACs than the
+            reference
+    :rtype: Tuple[List[Tuple[str, List[float]]], Optional[bool]]
+    """
+    lmn = load_client(args.client)
+    root = tempfile.mkdtemp(prefix="lmn-sysfs-")
+    try:
+        classnet = fake_classnet(root, args.interfaces)
+        expected = listdir_node_macs(lmn["usable_nic"], classnet)
+        cases = [("listdir + open x {0}".format(args.interfaces),
+                  lambda: listdir_node_macs(lmn["usable_nic"], classnet))]
+        differs = None
+        if "node_macs" in lmn:
+            node_macs = lmn["node_macs"]
+            cases.append(("node_macs", lambda: node_macs(classnet)))
+            if args.workers > 1:
+                cases.append(("node_macs workers={0}".format(args.workers),
+                              lambda: node_macs(classnet, args.workers)))
+            differs = node_macs(classnet, args.workers) != expected
+
+        results = []
+        for name, func in cases:
+            durations = []
+            for _ in range(args.runs):
+                start = time.time()
+                func()
+                durations.append(time.time() - start)
+            results.append((name, sorted(durations)))
+        return results, len(expected), differs
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def print_nics(results, usable, differs):
+    fmt = "{0:<32} {1:>6} {2:>9} {3:>9} {4:>9}"
+    print(fmt.format("MAC collection (ms)", "runs", "min", "p50", "p95"))
+    for name, values in results:
+        print(fmt.format(name, len(values), *["{0:.1f}".format(v * 1000) for v in
+                                               (values[0], percentile(values, 50), percentile(values, 95))]))
+    print("usable MAC addresses: {0}".format(usable))
+    if differs is not None:
+        print("node_macs differs from the reference: {0}".format("yes" if differs else "no"))
+
+
+# name -> arguments of the script, None is the bare interpreter start up for reference
+STARTUP_CASES = [
+    ("interpreter", None),
+    ("import", []),
+    ("--hints", ["--hints"]),
+    ("--exclude-info", ["--exclude-info"]),
+]
+
+
+def startup_benchmark(args):
+    """
+    :return: (case name, sorted durations in seconds) in the order the cases ran
+    :rtype: List[Tuple[str, List[float]]]
+    """
+    # "import" only loads the script, i.e. compiling it and the module level imports
+    load = "import sys; p = sys.argv[1]; exec(compile(open(p).read(), p, 'exec'), {'__name__': 'lmn'})"
+    commands = []
+    for python in args.python:
+        for name, argv in STARTUP_CASES:
+            if argv is None:
+                cmd = [python, "-c", "pass"]
+            elif not argv:
+                cmd = [python, "-c", load, args.client]
+            else:
+                cmd = [python, args.client] + argv
+            commands.append(("{0} {1}".format(python, name), cmd))
+    for name, argv in STARTUP_CASES:
+        if argv:
+            commands.append(("sh launcher " + name, ["sh", args.client] + argv))
+
+    devnull = open(os.devnull, "w")
+    results = dict((name, []) for name, _ in commands)
+    try:
+        # interleaved, so changing load on the machine affects all cases alike
+        for _ in range(args.runs):
+            for name, cmd in commands:
+                start = time.time()
+                subprocess.call(cmd, stdout=devnull, stderr=devnull)
+                results[name].append(time.time() - start)
+    finally:
+        devnull.close()
+    return [(name, sorted(results[name])) for name, _ in commands]
+
+
+def print_startup(results):
+    fmt = "{0:<32} {1:>6} {2:>9} {3:>9} {4:>9}"
+    print(fmt.format("start up (ms)", "runs", "min", "p50", "p95"))
+    for name, values in results:
+        print(fmt.format(name, len(values), *["{0:.1f}".format(v * 1000) for v in
+                                               (values[0], percentile(values, 50), percentile(values, 95))]))
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Mock my.linbit.com server and benchmark for linbit-manage-node.py")
+    sub = parser.add_subparsers(dest="command")
+    serve = sub.add_parser("serve", help="run the mock server")
+    run = sub.add_parser("run", help="benchmark registrations")
+    for p in (serve, run):
+        p.add_argument("--client", default=CLIENT, help="linbit-manage-node.py to benchmark/serve as update")
+        p.add_argument("--host", default="127.0.0.1")
+        p.add_argument("--user", default="bench")
+        p.add_argument("--password", default="bench")
+        p.add_argument("--contracts", type=int, default=1)
+        p.add_argument("--clusters", type=int, default=0, help="existing clusters per contract")
+        p.add_argument("--cluster-nodes", type=int, default=3, help="nodes per existing cluster")
+        p.add_argument("--no-paging", dest="paging", action="store_false",
+                       help="ignore offset/limit of the clusters listing")
+        p.add_argument("--gzip", action="store_true", help="compress the script download if the client accepts it")
+        p.add_argument("--latency", type=float, default=0.0, help="response delay in ms")
+        p.add_argument("--jitter", type=float, default=0.0, help="random +- on the delay in ms")
+        p.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 503")
+        p.add_argument("--rate", type=float, default=0.0, help="requests per second, excess gets 429")
+        p.add_argument("--bandwidth", type=int, default=0, help="bytes per second of every response body")
+        p.add_argument("--artifact-size", type=int, default=ARTIFACT_SIZE, help="size of package downloads")
+    serve.add_argument("--port", type=int, default=8080)
+    serve.add_argument("--verbose", action="store_true", help="log every request")
+    run.add_argument("--url", help="server to use instead of an in-process mock")
+    run.add_argument("--nodes", type=int, default=100, help="number of registrations")
+    run.add_argument("--hosts", type=int, help="distinct hostnames, fewer than --nodes re-registers nodes")
+    run.add_argument("--concurrency", type=int, default=8)
+    run.add_argument("--distribution", default="debian-bookworm")
+    run.add_argument("--no-downloads", dest="downloads", action="store_false", help="skip keyring/plugin downloads")
+    run.add_argument("--retries", type=int, help="HTTP attempts of the client (default: its HTTP_RETRIES)")
+    run.add_argument("--json", metavar="FILE", help="also write the report as JSON, '-' for stdout only")
+    models = sub.add_parser("models", help="benchmark decoding of a large clusters answer")
+    models.add_argument("--client", default=CLIENT, help="linbit-manage-node.py to benchmark")
+    models.add_argument("--clusters", type=int, default=5000)
+    models.add_argument("--cluster-nodes", type=int, default=3, help="nodes per cluster")
+    models.add_argument("--placements", type=int, default=1000, help="nodes placed by the suggestion rules")
+    models.add_argument("--runs", type=int, default=20)
+    kmods = sub.add_parser("kmods", help="benchmark the kernel module selection on a synthetic catalog")
+    kmods.add_argument("--client", default=CLIENT, help="linbit-manage-node.py to benchmark")
+    kmods.add_argument("--family", choices=["rhel", "sles"], default="rhel")
+    kmods.add_argument("--packages", type=int, default=30000, help="packages in the catalog")
+    kmods.add_argument("--kernels", type=int, default=500, help="host kernels to pick a package for")
+    kmods.add_argument("--linear-kernels", type=int, default=20,
+                       help="sample of the host kernels the linear scan is timed and compared on")
+    kmods.add_argument("--runs", type=int, default=3)
+    nics = sub.add_parser("nics", help="benchmark the MAC address collection on a fake sysfs")
+    nics.add_argument("--client", default=CLIENT, help="linbit-manage-node.py to benchmark")
+    nics.add_argument("--interfaces", type=int, default=10000, help="network devices in the fake sysfs")
+    nics.add_argument("--workers", type=int, default=8, help="workers of the concurrent node_macs() case")
+    nics.add_argument("--runs", type=int, default=5)
+    startup = sub.add_parser("startup", help="benchmark start up time of the subcommands")
+    startup.add_argument("--client", default=CLIENT, help="linbit-manage-node.py to benchmark")
+    startup.add_argument("--runs", type=int, default=20)
+    startup.add_argument("--python", action="append", help="interpreter to run the script with, can be repeated")
+    return parser
+
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        server = MockServer((args.host, args.port), args)
+        print("Mock listening, run the script with:")
+        print("  LMN_MYLINBIT_BASE={0} LMN_PACKAGES_BASE={1} LB_USERNAME={2} LB_PASSWORD={3}".format(
+            server.url, server.packages, args.user, args.password))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    elif args.command == "run":
+        if args.hosts is None:
+            args.hosts = args.nodes
+        report = run_benchmark(args)
+        if args.json == "-":
+            print(json.dumps(report, indent=2, sort_keys=True))
+            return
+        print_report(report)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+    elif args.command == "models":
+        print_models(*models_benchmark(args))
+    elif args.command == "kmods":
+        results, mismatches = kmods_benchmark(args)
+        print_kmods(results, mismatches)
+        if mismatches:
+            sys.exit(1)
+    elif args.command == "nics":
+        results, usable, differs = nics_benchmark(args)
+        print_nics(results, usable, differs)
+        if differs:
+            sys.exit(1)
+    elif args.command == "startup":
+        if not args.python:
+            args.python = ["python3"]
+        print_startup(startup_benchmark(args))
+    else:
+        parser.print_help()
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
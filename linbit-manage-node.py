@@ -1,8 +1,8 @@
 #!/bin/sh
 
 """true" &&
-for x in python python3 python2; do
-    /usr/bin/env "$x" -V > /dev/null 2>&1 && exec /usr/bin/env "$x" "$0" "$@"
+for x in ${LMN_PYTHON:-python python3 python2}; do
+    command -v "$x" > /dev/null 2>&1 && exec "$x" "$0" "$@"
 done
 >&2 echo "no python interpreter found :-("
 exit 1
@@ -13,32 +13,77 @@ exit 1
 # But on RHEL 8 (and other) platforms,
 # we cannot write a generic shebang for python,
 # because we don't know which one is installed :-(
+# The interpreter is looked up in PATH without starting it, LMN_PYTHON overrides the candidates.
 
+import atexit
 import sys
 import json
-import platform
-import subprocess
 import os
+import random
 import re
 import base64
-import tempfile
+import errno
+import fnmatch
+import operator
+import shlex
+import signal
+import io
+import threading
 import time
-from functools import reduce
+import zlib
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
 
 try:
     from urlparse import urljoin
-    from urllib2 import urlopen
-    from urllib2 import Request
-    from urllib2 import URLError
-    from urllib import urlretrieve
+    from urlparse import urlsplit
 except ImportError:
     from urllib.parse import urljoin
-    from urllib.request import urlopen
-    from urllib.request import Request
-    from urllib.error import URLError
-    from urllib.request import urlretrieve
+    from urllib.parse import urlsplit
+
+
+class LazyModule(object):
+    """
+    Stands in for a module that gets imported on first use.
+
+    Most runs only need a part of the modules, e.g. "--hints" does not do a single HTTP request.
+
+    :param names: the first one that can be imported is used, e.g. the python2 and the python3 name
+    """
+    def __init__(self, *names):
+        self._names = names
+        self._module = None
+
+    def __getattr__(self, attr):
+        # only called for attributes that are not set on the instance, i.e. the ones of the module
+        if self._module is None:
+            for name in self._names[:-1]:
+                try:
+                    __import__(name)
+                    self._module = sys.modules[name]
+                    break
+                except ImportError:
+                    pass
+            else:
+                __import__(self._names[-1])
+                self._module = sys.modules[self._names[-1]]
+        return getattr(self._module, attr)
+
+
+hashlib = LazyModule('hashlib')
+hmac = LazyModule('hmac')
+httplib = LazyModule('httplib', 'http.client')
+socket = LazyModule('socket')
+subprocess = LazyModule('subprocess')
+tempfile = LazyModule('tempfile')
+urllib_error = LazyModule('urllib2', 'urllib.error')  # URLError, HTTPError
+urllib_request = LazyModule('urllib2', 'urllib.request')  # urlopen, Request, getproxies, proxy_bypass
 
 MYLINBIT = os.getenv("LMN_MYLINBIT_BASE", "https://api.linbit.com")
+PACKAGES = os.getenv("LMN_PACKAGES_BASE", "https://packages.linbit.com/")
 
 AUTH_URL = urljoin(MYLINBIT, "v1/login")
 CONTRACT_URL = urljoin(MYLINBIT, "v1/my/contracts")
@@ -46,15 +91,35 @@ CLUSTER_URL = urljoin(MYLINBIT, "v1/my/contracts/{0}/clusters")
 LICENSE_URL = urljoin(MYLINBIT, "v1/license-from-nodehash")
 MYNAME = "linbit-manage-node.py"
 SELF = urljoin(MYLINBIT, "public/" + MYNAME)
-GPG_KEYRING_BASE = 'https://packages.linbit.com/public/'
+GPG_KEYRING_BASE = urljoin(PACKAGES, 'public/')
 GPG_KEYRING_DEB_NAME = 'linbit-keyring.deb'
 GPG_KEYRING_RPM_NAME = 'linbit-keyring.rpm'
 GPG_KEYRING_DEB = urljoin(GPG_KEYRING_BASE, GPG_KEYRING_DEB_NAME)
 GPG_KEYRING_RPM = urljoin(GPG_KEYRING_BASE, GPG_KEYRING_RPM_NAME)
-LINBIT_PLUGIN_BASE = "https://packages.linbit.com/public/yum-plugin/"
+LINBIT_PLUGIN_BASE = urljoin(PACKAGES, "public/yum-plugin/")
 LINBIT_PLUGIN = urljoin(LINBIT_PLUGIN_BASE, "linbit.py")
 LINBIT_PLUGIN_CONF = urljoin(LINBIT_PLUGIN_BASE, "linbit.conf")
 NODE_REG_DATA = "/var/lib/drbd-support/registration.json"
+TOKEN_CACHE = "/var/lib/drbd-support/token.json"
+FACTS_CACHE = "/var/lib/drbd-support/facts.json"
+METADATA_CACHE = "/var/lib/drbd-support/metadata.json"
+FLEET_WORKERS = 8
+CLUSTER_PAGE_SIZE = 1000
+CLUSTER_OPTIONS_MAX = 20
+CLUSTER_SUGGESTION = "hostname,prefix"
+CACHE_DIR = "/var/cache/drbd-support"
+CACHE_MAX_SIZE = 64 * 1024 * 1024
+VERSION_CHECK_TTL = 3600
+BEST_KMOD_TTL = 86400
+FACTS_TTL = 0
+METADATA_TTL = 300
+REGISTRATION_TTL = 86400
+METADATA_MAX_CLUSTERS = 1000
+HTTP_RETRIES = 4
+SSH_COMMAND = "ssh -o BatchMode=yes"
+SSH_TIMEOUT = 60
+VERSION_PROBE_SIZE = 8192
+DOWNLOAD_CHUNK = 64 * 1024
 
 REMOTEVERSION = 1
 # VERSION has to be in the form "MAJOR.MINOR"
@@ -76,6 +141,7 @@ def get_input(s):
     except NameError:
         pass
 
+    sys.stdout.flush()  # stdout might be block buffered, see buffer_stdout()
     return input(s)
 
 
@@ -83,10 +149,13 @@ class Distribution(object):
     # from python-lbdist/lbdist/distribution.py 1e9160e430017ba476631b8f6ddd6bf234948fed
     _pveversion = '/usr/bin/pveversion'
 
+    _supported_dist_IDs = ('amzn', 'centos', 'rhel', 'rhcos', 'almalinux', 'rocky', 'debian',
+                           'ubuntu', 'xenenterprise', 'ol', 'sles', 'opensuse-leap', 'proxmox')
+    _detected = {}
+
     def __init__(self, osreleasepath='/etc/os-release'):
-        self._supported_dist_IDs = ('amzn', 'centos', 'rhel', 'rhcos', 'almalinux', 'rocky', 'debian',
-                                    'ubuntu', 'xenenterprise', 'ol', 'sles', 'opensuse-leap', 'proxmox')
         self._osreleasepath = osreleasepath
+        self._osrelease_text = None
 
         self._osrelease = {}
         self._update_osrelease()
@@ -98,103 +167,135 @@ class Distribution(object):
         self._update_version()
         self._update_family()
 
+    @classmethod
+    def detect(cls, osreleasepath='/etc/os-release'):
+        """
+        Returns the distribution of this host, it is only detected once per process.
+
+        Treat the returned object as read only, it is shared by all callers.
+        A failed detection is cached as well and raises the same exception again.
+        """
+        key = (cls, osreleasepath)
+        if key not in Distribution._detected:
+            try:
+                Distribution._detected[key] = cls(osreleasepath)
+            except Exception as e:
+                Distribution._detected[key] = e
+        d = Distribution._detected[key]
+        if isinstance(d, Exception):
+            raise d
+        return d
+
     @property
     def osrelease(self):
-        return self._osrelease
+        return dict(self._osrelease)
+
+    @property
+    def osrelease_text(self):
+        # the unparsed content of the os-release file
+        if self._osrelease_text is None:
+            self._osrelease_text = self._read(self._osreleasepath)
+        return self._osrelease_text
+
+    # all files are accessed via these, see ProbedDistribution
+    def _exists(self, path):
+        return os.path.exists(path)
+
+    def _read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def _pveversion_output(self):
+        return subprocess.check_output([Distribution._pveversion]).decode()
 
     def _update_osrelease(self):
         # gernates a slightly oppinionated osrelease dict that is similar to /etc/os-release
         # for very old distris it just sets the bare minimum to determine version and family
         osrelease = {}
-        if os.path.exists(Distribution._pveversion):
+        if self._exists(Distribution._pveversion):
             osrelease['ID'] = 'proxmox'
             osrelease['ID_LIKE'] = 'debian'
-        elif os.path.exists(self._osreleasepath):
-            with open(self._osreleasepath) as o:
-                for line in o:
-                    line = line.strip()
-                    if len(line) == 0 or line[0] == '#':
-                        continue
-                    k, v = line.split('=')
-
-                    if v.startswith('"') or v.startswith("'"):
-                        v = v[1:-1]  # assume they are at least symmetric
-
-                    osrelease[k] = v
+        elif self._exists(self._osreleasepath):
+            for line in self.osrelease_text.splitlines():
+                line = line.strip()
+                if len(line) == 0 or line[0] == '#':
+                    continue
+                k, v = line.split('=')
+
+                if v.startswith('"') or v.startswith("'"):
+                    v = v[1:-1]  # assume they are at least symmetric
+
+                osrelease[k] = v
             if osrelease.get('ID', '') == 'ol':  # sorry, but you really are...
                 osrelease['ID_LIKE'] = 'rhel'
             elif osrelease.get('ID', '') == 'opensuse-leap':  # they have ID_LIKE="suse opensuse"
                 osrelease['ID_LIKE'] = 'sles'
 
         # centos 6, centos first, as centos has centos-release and redhat-release
-        elif os.path.exists('/etc/centos-release'):
+        elif self._exists('/etc/centos-release'):
             osrelease['ID'] = 'centos'
             osrelease['ID_LIKE'] = 'rhel'
         # rhel 6
-        elif os.path.exists('/etc/redhat-release'):
+        elif self._exists('/etc/redhat-release'):
             osrelease['ID'] = 'rhel'
 
         self._osrelease = osrelease
 
-    def _update_version(self):
-        version = None
-
-        if self._name == 'debian':
-            try:
-                v = self._osrelease['VERSION']
-            except KeyError:
-                msg = 'No "VERSION" in your Debian {0}, are you running testing/sid?'.format(self._osreleasepath)
-                raise Exception(msg)
+    def _version_id(self):
+        return self._osrelease['VERSION_ID']
 
-            m = re.search(r'^\d+ \((\w+)\)$', v)
-            if not m:
-                raise Exception('Could not determine version information for your Debian')
-            version = m.group(1)
-        elif self._name == 'ubuntu':
-            version = self._osrelease['VERSION_CODENAME']
-        elif self._name == 'centos':
-            line = ''
-            with open('/etc/centos-release') as cr:
-                line = cr.readline().strip()
-            # .* because the nice centos people changed their string between 6 and 7 (added 'Linux')
-            # and again in the middle of the 8 series (removed '(Core|Final)')
-            m = re.search(r'^CentOS .* ([\d.]+)', line)
+    def _version_debian(self):
+        try:
+            v = self._osrelease['VERSION']
+        except KeyError:
+            msg = 'No "VERSION" in your Debian {0}, are you running testing/sid?'.format(self._osreleasepath)
+            raise Exception(msg)
+
+        m = re.search(r'^\d+ \((\w+)\)$', v)
+        if not m:
+            raise Exception('Could not determine version information for your Debian')
+        return m.group(1)
+
+    def _version_ubuntu(self):
+        return self._osrelease['VERSION_CODENAME']
+
+    def _version_centos(self):
+        line = self._read('/etc/centos-release').split('\n')[0].strip()
+        # .* because the nice centos people changed their string between 6 and 7 (added 'Linux')
+        # and again in the middle of the 8 series (removed '(Core|Final)')
+        m = re.search(r'^CentOS .* ([\d.]+)', line)
+        if not m:
+            raise Exception('Could not determine version information for your Centos')
+        return m.group(1)
+
+    def _version_rhel(self):
+        try:
+            return self._osrelease['VERSION_ID']
+        except KeyError:
+            line = self._read('/etc/redhat-release').split('\n')[0].strip()
+            m = re.search(r'^Red Hat Enterprise .* ([\d.]+) \(.*\)$', line)
             if not m:
-                raise Exception('Could not determine version information for your Centos')
-            version = m.group(1)
-        elif self._name == 'amzn':
-            version = self._osrelease['VERSION_ID']
-        elif self._name == 'almalinux':
-            version = self._osrelease['VERSION_ID']
-        elif self._name == 'rocky':
-            version = self._osrelease['VERSION_ID']
-        elif self._name == 'rhel':
-            try:
-                version = self._osrelease['VERSION_ID']
-            except KeyError:
-                line = ''
-                with open('/etc/redhat-release') as cr:
-                    line = cr.readline().strip()
-                m = re.search(r'^Red Hat Enterprise .* ([\d.]+) \(.*\)$', line)
-                if not m:
-                    raise Exception('Could not determine version information for your RHEL6')
-                version = m.group(1)
-        elif self._name == 'rhcos':
-            version = self._osrelease['VERSION_ID']
-        elif self._name == 'xenenterprise':
-            version = self._osrelease['VERSION_ID']
-        elif self._name == 'ol':
-            version = self._osrelease['VERSION_ID']
-        elif self._name == 'sles' or self._name == 'opensuse-leap':
-            version = self._osrelease['VERSION_ID']
-        elif self._name == 'proxmox':
-            version = subprocess.check_output([Distribution._pveversion]).decode().strip().split('/')[1]
-            # this gave us something like 7.2-5, cut the '-' part
-            version = version.split('-')[0]
-        else:
-            raise Exception("Could not determine version information")
+                raise Exception('Could not determine version information for your RHEL6')
+            return m.group(1)
+
+    def _version_proxmox(self):
+        version = self._pveversion_output().strip().split('/')[1]
+        # this gave us something like 7.2-5, cut the '-' part
+        return version.split('-')[0]
+
+    # every supported ID not listed here uses VERSION_ID
+    _version_parsers = {
+        'debian': _version_debian,
+        'ubuntu': _version_ubuntu,
+        'centos': _version_centos,
+        'rhel': _version_rhel,
+        'proxmox': _version_proxmox,
+    }
 
-        self._version = version
+    def _update_version(self):
+        if self._name not in self._supported_dist_IDs:
+            raise Exception("Could not determine version information")
+        self._version = self._version_parsers.get(self._name, Distribution._version_id)(self)
 
     def _update_family(self):
         family = None
@@ -229,61 +330,97 @@ class LinbitDistribution(Distribution):
     def __init__(self, osreleasepath='/etc/os-release'):
         super(LinbitDistribution, self).__init__(osreleasepath)
 
+    def _repo_version(self):
+        return self._version
+
+    def _repo_rhel(self):
+        d = 'rhel'
+        if self._name == 'amzn':
+            d = 'amazonlinux'
+
+        v = self._version
+        if '.' in v:
+            v = v.split('.')
+            v = v[0] + '.' + v[1]
+        else:
+            v += '.0'
+        return '{0}{1}'.format(d, v)
+
+    def _repo_major(self):
+        d = self._name
+        if self._name == 'xenenterprise':
+            d = 'xenserver'
+        v = self._version
+        if '.' in v:
+            v = v.split('.')[0]
+        return '{0}{1}'.format(d, v)
+
+    def _repo_sles(self):
+        v = self._version
+        if '.' in v:
+            v = v.split('.')
+            v = v[0] + '-sp' + v[1]
+        # else: TODO(rck): actually I don't know how non SPx looks like
+        # in the repo it is just like "sles12"
+        return 'sles{0}'.format(v)
+
+    def _repo_proxmox(self):
+        v = self._version
+        if '.' in v:
+            v = v.split('.')
+            v = v[0]
+        return 'proxmox-{0}'.format(v)
+
+    def _repo_rhcos(self):
+        osrel_ver = self._osrelease.get('RHEL_VERSION')
+        vs = {
+            '4.1': '8.0',
+            '4.2': '8.0',
+            '4.3': '8.1',
+            '4.4': '8.1',
+            '4.5': '8.2',
+            '4.6': '8.2',
+            '4.7': '8.3',
+        }
+        return 'rhel{0}'.format(vs.get(self._version) or osrel_ver or '8.6')
+
+    _repo_names = {
+        'debian': _repo_version,
+        'ubuntu': _repo_version,
+        'rhel': _repo_rhel,
+        'centos': _repo_rhel,
+        'amzn': _repo_rhel,
+        'almalinux': _repo_rhel,
+        'rocky': _repo_rhel,
+        'xenenterprise': _repo_major,
+        'ol': _repo_major,
+        'sles': _repo_sles,
+        'opensuse-leap': _repo_sles,
+        'proxmox': _repo_proxmox,
+        'rhcos': _repo_rhcos,
+    }
+
     @property
     def repo_name(self):
         # use '{0}' instead of '{}', RHEL 6 does not handle the modern version
-        if self._name in ('debian', 'ubuntu'):
-            return self._version
-        elif self._name in ('rhel', 'centos', 'amzn', 'almalinux', 'rocky'):
-            d = 'rhel'
-            if self._name == 'amzn':
-                d = 'amazonlinux'
-
-            v = self._version
-            if '.' in v:
-                v = v.split('.')
-                v = v[0] + '.' + v[1]
-            else:
-                v += '.0'
-            return '{0}{1}'.format(d, v)
-        elif self._name in ('xenenterprise', 'ol'):
-            d = self._name
-            if self._name == 'xenenterprise':
-                d = 'xenserver'
-            v = self._version
-            if '.' in v:
-                v = v.split('.')[0]
-            return '{0}{1}'.format(d, v)
-        elif self._name == 'sles' or self._name == 'opensuse-leap':
-            v = self._version
-            if '.' in v:
-                v = v.split('.')
-                v = v[0] + '-sp' + v[1]
-            # else: TODO(rck): actually I don't know how non SPx looks like
-            # in the repo it is just like "sles12"
-            return 'sles{0}'.format(v)
-        elif self._name == 'proxmox':
-            v = self._version
-            if '.' in v:
-                v = v.split('.')
-                v = v[0]
-            return 'proxmox-{0}'.format(v)
-        elif self._name == 'rhcos':
-            osrel_ver = self.osrelease.get('RHEL_VERSION')
-            vs = {
-                '4.1': '8.0',
-                '4.2': '8.0',
-                '4.3': '8.1',
-                '4.4': '8.1',
-                '4.5': '8.2',
-                '4.6': '8.2',
-                '4.7': '8.3',
-            }
-            return 'rhel{0}'.format(vs.get(self._version) or osrel_ver or '8.6')
-        else:
+        repo_name = self._repo_names.get(self._name)
+        if repo_name is None:
             raise Exception("Could not determine repository information")
+        return repo_name(self)
+
+    @property
+    def registration_name(self):
+        # the distribution as sent to my.linbit.com
+        if self._family == 'debian' and self._name != 'proxmox':
+            return '{0}-{1}'.format(self._name, self._version)
+        return self.repo_name
 
-    def epilogue(self, with_pacemaker=False):
+    def epilogue(self, with_pacemaker=False, kmod_resolver=None, kernel_release=None):
+        """
+        :param bool with_pacemaker: add hints for pacemaker
+        :param Optional[BestKmodResolver] kmod_resolver: an already started resolver for the kernel module
+        :param Optional[str] kernel_release: as in "uname -r", defaults to the running kernel
+        """
         # we want to support old Python, "which" is easy enough
         def is_in_path(executable):
             path = os.getenv('PATH')
@@ -310,31 +447,22 @@ class LinbitDistribution(Distribution):
             return '<your package manager install>'
 
         def get_best_module():
-            uname_r = os.uname()[2]
+            uname_r = kernel_release or os.uname()[2]
             if self._family == 'debian':
                 return 'drbd-module-{0} # or drbd-dkms'.format(uname_r)
-            # something bestkernelmodule should be able to handle
-            # it is fine if this is something bestkernelmodule does not handle,
-            # it will raise an exception and we return the default kmod-drbd
-            os_release = open(self._osreleasepath)
-            data = os_release.read()
-            os_release.close()
-            # TODO: give it a dedicated subdomain with standard port
-            req = Request('http://drbd.io:3030/api/v1/best/'+uname_r, data=data.encode())
-            try:
-                resp = urlopen(req, timeout=5)
-                best = resp.read().decode()
-                # returns a file name including .rpm, split that off
+            resolver = kmod_resolver or BestKmodResolver(self, uname_r=uname_r)
+            best = resolver.best()
+            if best:
+                # a file name including .rpm, split that off
                 # pkgmanagers like dnf don't like extensions/look for local files,...
-                return os.path.splitext(best)[0]
-            except Exception:
-                # sles or rhel alike:
-                kmod = '<no default kernel module for your distribution>'
-                if self._family == 'rhel':
-                    kmod = 'kmod-drbd'
-                elif self._family == 'sles':
-                    kmod = 'drbd-kmp'
-                return kmod
+                return os.path.splitext(os.path.basename(best))[0]
+            # sles or rhel alike:
+            kmod = '<no default kernel module for your distribution>'
+            if self._family == 'rhel':
+                kmod = 'kmod-drbd'
+            elif self._family == 'sles':
+                kmod = 'drbd-kmp'
+            return kmod
 
         def add_controller_satellite(tool, satellite_extra):
             return '\nIf this is an SDS controller node you might want to install:\n' \
@@ -385,31 +513,157 @@ class LinbitDistribution(Distribution):
         # choices should be kernel module packages, they are allowed to have a path prefix
         # the best matching one, or None is returned
         if not name:
-            name = cls(osreleasepath)._name
+            name = cls.detect(osreleasepath).name
+        if not cls._has_kmods(name):
+            return None
+
+        if not hostkernel:
+            hostkernel = os.uname()[2]
+        return KmodIndex(choices, sles=name.startswith('sles')).best(hostkernel)
+
+    @classmethod
+    def best_drbd_kmods(cls, choices, hostkernels, osreleasepath='/etc/os-release', name=None):
+        # like best_drbd_kmod(), but for many host kernels at once
+        # returns a dict with the best matching module (or None) per kernel
+        if not name:
+            name = cls.detect(osreleasepath).name
+        if not cls._has_kmods(name):
+            return dict((k, None) for k in hostkernels)
+        return KmodIndex(choices, sles=name.startswith('sles')).best_many(hostkernels)
 
+    @staticmethod
+    def _has_kmods(name):
         # keep as startswith, which allows forcing rhel by setting the family as name
-        if not (name.startswith('rhel') or name.startswith('centos') or
+        return (name.startswith('rhel') or name.startswith('centos') or
                 name.startswith('almalinux') or name.startswith('rocky') or
-                name.startswith('sles')):
+                name.startswith('sles'))
+
+
+class BestKmodResolver(object):
+    """
+    Finds the best kernel module package for the running kernel.
+
+    A local package list (LB_KMOD_LIST, a file with one package per line or a directory of packages)
+    is preferred, then an answer of drbd.io remembered in the download cache for BEST_KMOD_TTL seconds.
+    Only if both are missing drbd.io is asked, the request is started in the background right away, so it
+    does not block the caller. Only the answer for the running kernel and os-release is remembered, so
+    newly published builds are picked up after the TTL and the state does not grow with every kernel.
+    """
+    REMOTE_URL = 'http://drbd.io:3030/api/v1/best/'
+    REMOTE_TIMEOUT = 5
+
+    def __init__(self, lbd, cache=None, kmod_list=None, uname_r=None):
+        self._lbd = lbd
+        self._cache = cache
+        self._uname_r = uname_r or os.uname()[2]
+        self._best = None
+        self._task = None
+
+        if lbd.family not in ('rhel', 'sles'):
+            return
+
+        if kmod_list is None:
+            kmod_list = os.getenv('LB_KMOD_LIST')
+        if kmod_list:
+            self._best = self._local(kmod_list)
+            if self._best:
+                return
+
+        if cache:
+            state = cache.load_state('best-kmod')
+            if state and state.get('key') == self._cache_key() and \
+                    0 <= time.time() - state.get('checked', 0) < BEST_KMOD_TTL:
+                self._best = state.get('best')
+        if not self._best:
+            self._task = BackgroundTask(self._remote)
+
+    def _local(self, kmod_list):
+        try:
+            if os.path.isdir(kmod_list):
+                choices = os.listdir(kmod_list)
+            else:
+                with open(kmod_list) as infile:
+                    choices = [line.strip() for line in infile if line.strip()]
+        except (IOError, OSError):
             return None
+        return LinbitDistribution.best_drbd_kmod(choices, name=self._lbd.name, hostkernel=self._uname_r)
+
+    def _cache_key(self):
+        try:
+            osrelease = self._lbd.osrelease_text
+        except (IOError, OSError):
+            osrelease = ''
+        return self._uname_r + ' ' + hashlib.sha256(osrelease.encode('utf-8')).hexdigest()
+
+    def _remote(self):
+        # something bestkernelmodule should be able to handle
+        # it is fine if this is something bestkernelmodule does not handle,
+        # it will raise an exception and we return the default kmod-drbd
+        data = self._lbd.osrelease_text
+        # TODO: give it a dedicated subdomain with standard port
+        req = urllib_request.Request(self.REMOTE_URL + self._uname_r, data=data.encode())
+        # the span records the latency for --profile
+        with PROFILER.span('POST drbd.io/api/v1/best', 'http'):
+            resp = urllib_request.urlopen(req, timeout=self.REMOTE_TIMEOUT)
+            return resp.read().decode().strip()
+
+    def best(self):
+        """
+        :return: the best package name, None if there is none or it is unknown
+        :rtype: Optional[str]
+        """
+        if self._task is not None:
+            try:
+                self._best = self._task.result()
+            except Exception:
+                self._best = None
+            self._task = None
+            if self._best and self._cache:
+                self._cache.save_state('best-kmod', {'key': self._cache_key(), 'best': self._best,
+                                                     'checked': time.time()})
+        return self._best
+
+
+class ProbedDistribution(LinbitDistribution):
+    """
+    Distribution detected from collected files instead of the local ones, see HostFacts and probe_host().
+
+    :param Dict[str, str] files: path -> content, the content for the pveversion path is the output of pveversion
+    """
+    def __init__(self, files):
+        self._files = files
+        super(ProbedDistribution, self).__init__()
+
+    def _exists(self, path):
+        return path in self._files
+
+    def _read(self, path):
+        if path not in self._files:
+            raise IOError("{0} was not collected".format(path))
+        return self._files[path]
+
+    def _pveversion_output(self):
+        return self._read(Distribution._pveversion)
 
-        if not hostkernel:
-            hostkernel = platform.uname()[2]
-        hostkernelsplit = hostkernel.replace('-', '.')
-        hostkernelsplit = hostkernelsplit.split('.')[::-1]
-        # strip x86, -default,... from the end
-        for i, e in enumerate(hostkernelsplit):
-            if e.isdigit():
-                hostkernelsplit = hostkernelsplit[i:][::-1]
-                break
 
-        kmap = {}
+class KmodIndex(object):
+    """
+    Kernel module packages indexed by the kernel (major, minor, patch) they are built for.
+
+    Build it once from a package list and query it for as many host kernels as needed.
+    The best module for a host kernel is the one with the same kernel version and the closest
+    release that is not newer than the host one, or the closest newer one if there is none.
+    """
+    def __init__(self, choices, sles=False):
+        # (major, minor, patch) -> list of (release as int tuple, package), in order of first appearance
+        self._kernels = {}
+        releases = {}
         for c in choices:
             kpart = os.path.basename(c)
             if not (kpart.startswith('kmod-drbd') or kpart.startswith('drbd-kmp')):
                 continue
             kpart = '_'.join(kpart.split('_')[1:])  # strip kmod-drbd-x.y.z_ prefix
-            if name.startswith('sles') and kpart[0] == 'k':  # strip k from k4.12.14_197.29-1
+            if sles and kpart.startswith('k'):  # strip k from k4.12.14_197.29-1
                 kpart = kpart[1:]
 
             kpart = kpart.split('-')[0]  # strip revision and everything past it
@@ -419,211 +673,503 @@ class LinbitDistribution(Distribution):
 
             kps = kpart.split('.')
             # the weird stuff should now be at the end of the array (arch, el*)
-            kps = list(filter(lambda a: a.isdigit(), kps))
+            kps = [a for a in kps if a.isdigit()]
             if len(kps) < 3:  # first 3 are the kernel
                 continue
-            valid = True
-
-            for i in range(3):
-                if hostkernelsplit[i] != kps[i]:
-                    valid = False
-                    break
-            if not valid:
-                continue
 
-            kmap['.'.join(kps[3:])] = c
+            kernel = tuple(kps[:3])
+            release = tuple(int(a) for a in kps[3:])
+            bucket = releases.setdefault(kernel, {})
+            if release not in bucket:
+                self._kernels.setdefault(kernel, []).append(release)
+            bucket[release] = c  # the last package for the same release wins
+        self._packages = releases
 
-        hostkernelsplit = hostkernelsplit[3:]
+    def best(self, hostkernel):
+        """
+        :param str hostkernel: as in "uname -r"
+        :return: the best matching package or None
+        :rtype: Optional[str]
+        """
+        hostkernelsplit = hostkernel.replace('-', '.')
+        hostkernelsplit = hostkernelsplit.split('.')[::-1]
+        # strip x86, -default,... from the end
+        for i, e in enumerate(hostkernelsplit):
+            if e.isdigit():
+                hostkernelsplit = hostkernelsplit[i:][::-1]
+                break
 
-        def kcmp(v1, v2):
-            v1s, v2s = v1.split('.'), v2.split('.')
-            hks = hostkernelsplit
+        kernel = tuple(hostkernelsplit[:3])
+        candidates = self._kernels.get(kernel)
+        if not candidates:
+            return None
 
-            ml = max(len(hks), len(v1s), len(v2s))
-            for lst in (v1s, v2s, hks):
-                lst += [0]*(ml-len(lst))
+        hks = [int(e) for e in hostkernelsplit[3:]]
+        ml = max(len(hks), max(len(r) for r in candidates))
+        hks += [0] * (ml - len(hks))
 
+        def rank(release):
+            # per position: releases at or below the host one first, the closer the better
+            key = []
             for i, e in enumerate(hks):
-                e = int(e)
-                d1 = e - int(v1s[i])
-                d2 = e - int(v2s[i])
-                if d1 == d2:
-                    continue
-                # smaller positive one
-                if d1 >= 0 and d2 >= 0:
-                    if d1 < d2:
-                        return v1
-                    else:
-                        return v2
-                elif d1 >= 0 and d2 < 0:
-                    return v1
-                elif d1 < 0 and d2 >= 0:
-                    return v2
-                else:  # both negative and therefore higher
-                    if d1 < d2:
-                        return v2
-                    else:
-                        return v1
-
-            # no winner as there was no early return
-            return v1
-
-        keys = kmap.keys()
-        if not keys:
-            return None
-        return kmap[reduce(kcmp, keys)]
+                d = e - (release[i] if i < len(release) else 0)
+                key.append((0, d) if d >= 0 else (1, -d))
+            return key
+
+        return self._packages[kernel][min(candidates, key=rank)]
+
+    def best_many(self, hostkernels):
+        """
+        :param Iterable[str] hostkernels:
+        :return: the best matching package (or None) per host kernel
+        :rtype: Dict[str, Optional[str]]
+        """
+        best = {}
+        for k in hostkernels:
+            if k not in best:
+                best[k] = self.best(k)
+        return best
 
 
 # Utility Functions that might need update (e.g., if we add distro-types)
-def getHostInfo():
-    if platform.system() != "Linux":
-        err(E_FAIL, "You have to run this script on a GNU/Linux based system")
-
-    hostname = platform.node().strip().split('.')[0]
-
-    # it seems really hard to get MAC addresses if you want:
-    # a python only solution, e.g., no extra C code
-    # no extra non-built-in modules
-    # support for legacy python versions
-    macs = set()
-    # we are Linux-only anyways...
-    CLASSNET = "/sys/class/net"
-    if os.path.isdir(CLASSNET):
-        for dev in os.listdir(CLASSNET):
-            devpath = os.path.join(CLASSNET, dev)
-
-            if not os.path.islink(devpath):
-                continue
+def usable_nic(name, dev_type, addr_assign_type):
+    """
+    Decides if the MAC address of a network device identifies the node.
 
-            with open(os.path.join(devpath, "type")) as t:
-                dev_type = t.readline().strip()
-                if dev_type != '1':  # this filters for example ib/lo devs
-                    continue
+    :param str name: device name
+    :param str dev_type: content of /sys/class/net/<name>/type
+    :param Optional[str] addr_assign_type: content of /sys/class/net/<name>/addr_assign_type,
+            None on very old kernels that do not have it
+    :rtype: bool
+    """
+    if dev_type != '1':  # this filters for example ib/lo devs
+        return False
 
-            # try to filter non permanent interfaces
-            # very old kernels do not have /sys/class/net/*/addr_assign_type
-            addr_assign_path = os.path.join(devpath, "addr_assign_type")
-            if os.path.isfile(addr_assign_path):
-                with open(addr_assign_path) as a:
-                    dev_aatype = a.readline().strip()
-                    if dev_aatype != '0' and dev_aatype != '3':  # NET_ADDR_PERM/dev_set_mac_address
-                        continue
-            else:  # try our best to manually filter them
-                if dev.startswith("vir") or \
-                   dev.startswith("vnet") or \
-                   dev.startswith("bond"):
-                    continue
+    # try to filter non permanent interfaces
+    if addr_assign_type is not None:
+        return addr_assign_type in ('0', '3')  # NET_ADDR_PERM/dev_set_mac_address
+
+    # try our best to manually filter them
+    return not (name.startswith("vir") or name.startswith("vnet") or name.startswith("bond"))
+
+
+class HostFacts(object):
+    """
+    Facts about the host that gets configured: hostname, MAC addresses, kernel and the files
+    its distribution is detected from.
 
-            with open(os.path.join(devpath, "address")) as addr:
-                mac = addr.readline().strip()
+    The facts are gathered once per run, either by collect() from a (possibly fake) root file system,
+    or injected as JSON by load(), which also understands Ansible facts.
+    """
+    FORMAT = 1
+    # the content of the pveversion path is the output of pveversion, see ProbedDistribution
+    DIST_FILES = ('/etc/os-release', '/etc/centos-release', '/etc/redhat-release')
+
+    _ansible_ids = {
+        'Debian': 'debian',
+        'Ubuntu': 'ubuntu',
+        'RedHat': 'rhel',
+        'CentOS': 'centos',
+        'Rocky': 'rocky',
+        'AlmaLinux': 'almalinux',
+        'OracleLinux': 'ol',
+        'Amazon': 'amzn',
+        'SLES': 'sles',
+        'openSUSE Leap': 'opensuse-leap',
+        'XenServer': 'xenenterprise',
+    }
+    _ansible_families = {'Debian': 'debian', 'RedHat': 'rhel', 'Suse': 'sles'}
+
+    def __init__(self, facts):
+        self._facts = facts
+        self._lbd = None
+
+    @classmethod
+    def collect(cls, root='/'):
+        """
+        Gathers the facts of this host, or of the fake root file system root.
+
+        In a fake root the hostname and kernel are read from proc/sys/kernel, MAC addresses from sys/class/net.
+        Binaries of a fake root are never run, so Proxmox is only detected there from injected facts.
+        """
+        if root == '/':
+            if not sys.platform.startswith('linux'):
+                err(E_FAIL, "You have to run this script on a GNU/Linux based system")
+            uname = os.uname()
+        else:
+            def kernel(name):
+                try:
+                    with open(os.path.join(root, 'proc/sys/kernel', name)) as f:
+                        return f.read().strip()
+                except (IOError, OSError):
+                    return ''
+            uname = ('Linux', kernel('hostname'), kernel('osrelease'), kernel('version'), os.uname()[4])
+
+        files = {}
+        for path in cls.DIST_FILES:
+            try:
+                with open(os.path.join(root, path.lstrip('/'))) as f:
+                    files[path] = f.read()
+            except (IOError, OSError):
+                pass
+        if root == '/' and os.path.exists(Distribution._pveversion):
+            try:
+                files[Distribution._pveversion] = subprocess.check_output([Distribution._pveversion]).decode()
+            except (OSError, subprocess.CalledProcessError):
+                pass
+
+        # it seems really hard to get MAC addresses if you want:
+        # a python only solution, e.g., no extra C code
+        # no extra non-built-in modules
+        # support for legacy python versions
+        macs = node_macs(os.path.join(root, 'sys/class/net'))
+
+        return cls({
+            "format": cls.FORMAT,
+            "collected": time.time(),
+            "hostname": uname[1].strip().split('.')[0],
+            "mac_addresses": sorted(macs),
+            "kernel_release": uname[2],
+            "uname": " ".join(uname),
+            "files": files,
+        })
+
+    @classmethod
+    def from_ansible(cls, facts):
+        """
+        Converts the facts gathered by Ansible's setup module.
+
+        Ansible does not provide the os-release file, an equivalent one is generated.
+        Proxmox hosts are reported as Debian by Ansible and can not be told apart.
+
+        :param Dict[str, Any] facts: the "ansible_facts" of a host
+        """
+        name = facts.get('ansible_distribution', '')
+        version = facts.get('ansible_distribution_version', '')
+        release = facts.get('ansible_distribution_release', '')
+        osrelease = [
+            'ID={0}'.format(cls._ansible_ids.get(name, name.lower())),
+            'VERSION_ID="{0}"'.format(version),
+            'VERSION="{0} ({1})"'.format(facts.get('ansible_distribution_major_version', version), release),
+            'VERSION_CODENAME={0}'.format(release),
+        ]
+        family = cls._ansible_families.get(facts.get('ansible_os_family'))
+        if family:
+            osrelease.append('ID_LIKE={0}'.format(family))
+
+        macs = set()
+        for dev in facts.get('ansible_interfaces', []):
+            iface = facts.get('ansible_' + re.sub(r'[^A-Za-z0-9_]', '_', dev), {})
+            mac = iface.get('macaddress')
+            # Ansible does not report addr_assign_type
+            if mac and usable_nic(dev, '1' if iface.get('type') == 'ether' else '', None):
                 macs.add(mac)
 
-    return hostname, macs
+        return cls({
+            "format": cls.FORMAT,
+            "collected": time.time(),
+            "hostname": facts.get('ansible_hostname', ''),
+            "mac_addresses": sorted(macs),
+            "kernel_release": facts.get('ansible_kernel', ''),
+            "uname": " ".join(facts.get(k, '') for k in ('ansible_system', 'ansible_nodename', 'ansible_kernel',
+                                                       'ansible_kernel_version', 'ansible_machine')),
+            "files": {'/etc/os-release': '\n'.join(osrelease) + '\n'},
+        })
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads injected facts, as written by save() or gathered by Ansible.
 
+        :param str path: JSON file, '-' reads from stdin
+        """
+        if path == '-':
+            facts = json.load(sys.stdin)
+        else:
+            with open(path) as infile:
+                facts = json.load(infile)
 
-def setup_repo_config(urlhandler, dist, family, repos, free_running=False, enable_repos=None):
+        if 'ansible_facts' in facts:  # output of the setup module
+            return cls.from_ansible(facts['ansible_facts'])
+        if any(k.startswith('ansible_') for k in facts):  # fact cache
+            return cls.from_ansible(facts)
+        if facts.get("format") != cls.FORMAT:
+            raise ValueError("unknown facts format")
+        return cls(facts)
+
+    @classmethod
+    def load_cached(cls, path, ttl):
+        """
+        :return: the facts saved in path if they are younger than ttl seconds, or None
+        :rtype: Optional[HostFacts]
+        """
+        try:
+            facts = cls.load(path)
+        except (IOError, OSError, ValueError):
+            return None
+        if not 0 <= time.time() - facts._facts.get("collected", 0) < ttl:
+            return None
+        return facts
+
+    def save(self, path):
+        dirname = os.path.dirname(path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        atomic_write(path, [file_content(self._facts, asjson=True)])
+
+    @property
+    def hostname(self):
+        return self._facts["hostname"]
+
+    @property
+    def mac_addresses(self):
+        return set(self._facts["mac_addresses"])
+
+    @property
+    def kernel_release(self):
+        return self._facts["kernel_release"]
+
+    @property
+    def uname(self):
+        # as in "uname -a"
+        return self._facts["uname"]
+
+    def distribution(self):
+        """
+        :return: the distribution described by the collected files
+        :rtype: ProbedDistribution
+        :raises Exception: if it is not supported
+        """
+        if self._lbd is None:
+            self._lbd = ProbedDistribution(self._facts["files"])
+        return self._lbd
+
+
+def host_facts(facts_file=None, root='/', ttl=FACTS_TTL):
     """
-    Asks user which repos to enable and write the correct deb/yum repository configuration.
+    Returns the facts of the host this run configures.
 
-    :param urlhandler:
-    :param str dist:
-    :param str family:
-    :param Dict[str, Repo] repos:
-    :param bool free_running:
-    :param Optional[list[str]] enable_repos: list of repos to enable without asking
-    :return:
+    Injected facts (facts_file) are used as they are. Facts of this host are cached in FACTS_CACHE
+    and reused for ttl seconds, a ttl of 0 collects them every time and does not touch the cache.
+
+    :rtype: HostFacts
     """
-    # Write repository configuration
-    if family == "debian":
-        repo_file = "/etc/apt/sources.list.d/linbit.list"
-    elif family == "rhel":
-        repo_file = "/etc/yum.repos.d/linbit.repo"
-    elif family == "sles":
-        repo_file = "/etc/zypp/repos.d/linbit.repo"
+    if facts_file:
+        return HostFacts.load(facts_file)
+    if root != '/':
+        return HostFacts.collect(root)
+    if ttl <= 0:
+        return HostFacts.collect()
+
+    facts = HostFacts.load_cached(FACTS_CACHE, ttl)
+    if facts is None:
+        facts = HostFacts.collect()
+        if isRoot():
+            try:
+                facts.save(FACTS_CACHE)
+            except (IOError, OSError):
+                pass
+    return facts
+
+
+def node_macs(classnet="/sys/class/net", workers=1):
+    """
+    Collects the MAC addresses of the network devices that identify the node, see usable_nic().
+
+    Only symlinks are considered and "lo" is skipped by name. Every attribute is read with a single
+    open/read relative to classnet. Devices that vanish while they are read are skipped, other read errors
+    are raised, a device must not silently drop out of the node identity.
+
+    :param str classnet:
+    :param int workers: number of devices read concurrently
+    :rtype: Set[str]
+    """
+    if not os.path.isdir(classnet):
+        return set()
+
+    if hasattr(os, 'scandir'):
+        devs = [e.name for e in os.scandir(classnet) if e.is_symlink() and e.name != 'lo']
     else:
-        return err(E_FAIL, "Unknown distribution family '{}'".format(family))
+        devs = [d for d in os.listdir(classnet) if d != 'lo' and os.path.islink(os.path.join(classnet, d))]
 
-    if not free_running:
-        printcolour("Repository configuration:\n", GREEN)
-        print("It is perfectly fine if you do not want to enable any repositories now.")
-        print("The configuration for disabled repositories gets written,")
-        print("but the repositories are disabled for now.")
-        print("You can edit the configuration (e.g., {0}) file later to enable them.\n".format(repo_file))
+    dirfd = None
+    if hasattr(os, 'supports_dir_fd') and os.open in os.supports_dir_fd:
+        dirfd = os.open(classnet, os.O_RDONLY)
+
+    def read(dev, attr):
+        if dirfd is not None:
+            fd = os.open(dev + '/' + attr, os.O_RDONLY, dir_fd=dirfd)
+        else:
+            fd = os.open(os.path.join(classnet, dev, attr), os.O_RDONLY)
+        try:
+            value = os.read(fd, 4096)
+        finally:
+            os.close(fd)
+        if not isinstance(value, str):  # python 3
+            value = value.decode('ascii', 'replace')
+        return value.strip()
+
+    def mac(dev):
+        try:
+            dev_type = read(dev, 'type')
+            if dev_type != '1':  # skip the other reads, usable_nic() would reject it anyways
+                return None
+            try:
+                dev_aatype = read(dev, 'addr_assign_type')
+            except OSError as e:
+                # very old kernels do not have /sys/class/net/*/addr_assign_type
+                if e.errno != errno.ENOENT:
+                    raise
+                dev_aatype = None
+            if not usable_nic(dev, dev_type, dev_aatype):
+                return None
+            return read(dev, 'address')
+        except OSError as e:
+            if e.errno not in (errno.ENOENT, errno.ENODEV, errno.ENXIO):
+                raise
+            return None
+
+    try:
+        if workers > 1:
+            found = parallel_map(mac, devs, workers)
+        else:
+            found = [mac(dev) for dev in devs]
+    finally:
+        if dirfd is not None:
+            os.close(dirfd)
+    return set(m for m in found if m)
 
+
+def yum_plugin_location(dist):
+    """
+    Returns where to download the LINBIT yum plugin from and where to install it.
+
+    :param str dist: the repo name of the distribution (e.g., rhel8.6)
+    :return: plugin URL and destination directory
+    :rtype: Tuple[str, str]
+    """
+    def is_rhelish(major):
+        if dist.startswith('xenserver'):
+            # xenserver 8 has rhel7 userland
+            if major == 7 and dist == 'xenserver8':
+                return True
+            # let's assume the other xenserver versions behave saner
+            return dist == 'xenserver{}'.format(major)
+
+        # this is the .repo_name, so we can assume major.minor for rhel
+        return dist.startswith('rhel{0}.'.format(major)) \
+            or dist == 'ol{}'.format(major)
+
+    plugin_dst = '/usr/share/yum-plugins'
+    final_plugin = LINBIT_PLUGIN
+    if is_rhelish(6):
+        final_plugin += '.6'
+    elif is_rhelish(7):
+        final_plugin += '.7'
+    elif is_rhelish(8):
+        final_plugin += '.8'
+        plugin_dst = '/usr/lib/python3.6/site-packages/dnf-plugins'
+    elif is_rhelish(9):
+        final_plugin += '.8'  # they are compatible
+        plugin_dst = '/usr/lib/python3.9/site-packages/dnf-plugins'
+
+    return final_plugin, plugin_dst
+
+
+REPO_FILES = {
+    "debian": "/etc/apt/sources.list.d/linbit.list",
+    "rhel": "/etc/yum.repos.d/linbit.repo",
+    "sles": "/etc/zypp/repos.d/linbit.repo",
+}
+
+
+def repo_config_content(family, configs, enabled):
+    """
+    Generates the content of the repository configuration file REPO_FILES[family].
+
+    :param str family:
+    :param Dict[str, str] configs: repo name -> config line from my.linbit.com
+    :param Dict[str, bool] enabled: repo name -> enabled
+    :return: lines of the file
+    :rtype: List[str]
+    """
     repo_content = []
-    repo_names = {}
-    for k in repos:
-        repo_names[k] = k in enable_repos if enable_repos else free_running
-    enabled = ask_enable(repo_names, free_running)
     if family == "debian":
         enabled_keys = [x for x in enabled if enabled[x]]
         disabled_keys = [x for x in enabled if not enabled[x]]
         if enabled_keys:
             repo_content.append("{u} {e} # {d}\n\n".format(
-                u=repos[enabled_keys[0]].config,
+                u=configs[enabled_keys[0]],
                 e=" ".join(enabled_keys),
                 d=" ".join(disabled_keys)))
 
     elif family == "rhel" or family == "sles":
-        for repo in repos:
+        for repo in configs:
             repo_content.append("[{0}]\n".format(repo))
             repo_content.append("name=LINBIT Packages for {0} - $basearch\n".format(repo))
-            repo_content.append("{0}\n".format(repos[repo].config))
+            repo_content.append("{0}\n".format(configs[repo]))
             repo_content.append("enabled={0}\n".format("1" if enabled.get(repo) else "0"))
             repo_content.append("gpgkey=file:///etc/pki/rpm-gpg/RPM-GPG-KEY-linbit\n")
             repo_content.append("gpgcheck=1\n")
             repo_content.append("priority=90\n")
             repo_content.append("\n")
 
-    printcolour("Writing repository config:\n", GREEN)
     if len(repo_content) == 0:
-        if not repos:
+        if not configs:
             repo_content.append("# Could not find any repositories for your distribution\n")
             repo_content.append("# Please contact support@linbit.com\n")
         else:
             repo_content.append("# Repositories found, but none enabled\n")
+    return repo_content
+
+
+def setup_repo_config(urlhandler, dist, family, repos, free_running=False, enable_repos=None):
+    """
+    Asks user which repos to enable and write the correct deb/yum repository configuration.
+
+    :param urlhandler:
+    :param str dist:
+    :param str family:
+    :param Dict[str, Repo] repos:
+    :param bool free_running:
+    :param Optional[list[str]] enable_repos: RepoSelector rules of the repos to enable without asking
+    :return:
+    """
+    # Write repository configuration
+    repo_file = REPO_FILES.get(family)
+    if repo_file is None:
+        return err(E_FAIL, "Unknown distribution family '{}'".format(family))
+
+    if not free_running:
+        printcolour("Repository configuration:\n", GREEN)
+        print("It is perfectly fine if you do not want to enable any repositories now.")
+        print("The configuration for disabled repositories gets written,")
+        print("but the repositories are disabled for now.")
+        print("You can edit the configuration (e.g., {0}) file later to enable them.\n".format(repo_file))
+
+    enabled = ask_enable(select_repos(repos, enable_repos, free_running), free_running)
+    repo_content = repo_config_content(family, dict((k, v.config) for k, v in repos.items()), enabled)
+
+    printcolour("Writing repository config:\n", GREEN)
     success = writeFile(repo_file, repo_content, free_running=free_running)
     if success:
-        OK('Repository configuration written')
+        if FILE_CHANGES.get(repo_file, True):
+            OK('Repository configuration written')
+        else:
+            OK('Repository configuration unchanged')
+    EVENTS.emit('repo_config', path=repo_file, written=success, changed=FILE_CHANGES.get(repo_file, False),
+                enabled=sorted(name for name, e in enabled.items() if e),
+                disabled=sorted(name for name, e in enabled.items() if not e))
 
     # Download yum plugin on yum based systems
     if family == "rhel":
-        def is_rhelish(major):
-            if dist.startswith('xenserver'):
-                # xenserver 8 has rhel7 userland
-                if major == 7 and dist == 'xenserver8':
-                    return True
-                # let's assume the other xenserver versions behave saner
-                return dist == 'xenserver{}'.format(major)
-
-            # this is the .repo_name, so we can assume major.minor for rhel
-            return dist.startswith('rhel{0}.'.format(major)) \
-                or dist == 'ol{}'.format(major)
-
-        plugin_dst = '/usr/share/yum-plugins'
-        final_plugin = LINBIT_PLUGIN
-        if is_rhelish(6):
-            final_plugin += '.6'
-        elif is_rhelish(7):
-            final_plugin += '.7'
-        elif is_rhelish(8):
-            final_plugin += '.8'
-            plugin_dst = '/usr/lib/python3.6/site-packages/dnf-plugins'
-        elif is_rhelish(9):
-            final_plugin += '.8'  # they are compatible
-            plugin_dst = '/usr/lib/python3.9/site-packages/dnf-plugins'
+        final_plugin, plugin_dst = yum_plugin_location(dist)
 
         printcolour("Downloading LINBIT yum plugin\n", GREEN)
-        f = urlhandler.fileHandle(final_plugin)
-        plugin = [pluginline for pluginline in f]
-        writeFile(os.path.join(plugin_dst, 'linbit.py'), plugin,
-                  showcontent=False, askforwrite=False, free_running=free_running)
+        downloadFile(urlhandler, final_plugin, os.path.join(plugin_dst, 'linbit.py'))
 
         printcolour("Downloading LINBIT yum plugin config\n", GREEN)
-        f = urlhandler.fileHandle(LINBIT_PLUGIN_CONF)
-        cfg = [cfgline for cfgline in f]
-        writeFile("/etc/yum/pluginconf.d/linbit.conf", cfg,
-                  showcontent=False, askforwrite=False, free_running=free_running)
+        downloadFile(urlhandler, LINBIT_PLUGIN_CONF, "/etc/yum/pluginconf.d/linbit.conf")
 
     return True
 
@@ -632,33 +1178,573 @@ def write_proxy_license(license_blob, free_running):
     if not free_running:
         printcolour("Writing proxy license:\n", GREEN)
     lic = [x + '\n' for x in base64.b64decode(license_blob).decode('utf-8').split('\n')]
-    writeFile("/etc/drbd-proxy.license", lic,
-              showcontent=False, free_running=free_running)
+    name = "/etc/drbd-proxy.license"
+    writeFile(name, lic, showcontent=False, free_running=free_running)
+    EVENTS.emit('license', path=name, changed=FILE_CHANGES.get(name, False))
 
 
-def main():
-    py_major, py_minor = sys.version_info[:2]
-    if py_major < 2 or (py_major == 2 and py_minor < 6):
-        warn('Your Python version ({0}.{1}) is too old, manually add your nodes via https://my.linbit.com'.format(py_major, py_minor))
-        warn('If you need further help, contact us:\n')
-        contactInfo('', is_issue=False)
-        sys.exit(1)
-    free_running = False
-    proxy_only = False
-    non_interactive = False
-    exclude_info_only = False
-    hints_only = False
+def registration_is_current(reg_data, hostname, macs, dist, cluster_id, hidden_repos, ttl=REGISTRATION_TTL):
+    """
+    Checks if the stored registration data still describes this node.
+
+    The stored repos are only trusted for ttl seconds after the registration, so repos that my.linbit.com
+    adds, removes or changes get picked up by the next registration.
+
+    :param Optional[Dict[str, Any]] reg_data: content of NODE_REG_DATA
+    :param str hostname:
+    :param Set[str] macs:
+    :param str dist:
+    :param Optional[int] cluster_id: requested cluster id, -1, 0 and None accept any cluster
+    :param bool hidden_repos: hidden repos are requested
+    :param int ttl: in seconds, 0 always registers again
+    :rtype: bool
+    """
+    if not reg_data or "repos" not in reg_data or "registered_at" not in reg_data:  # registered by an older version
+        return False
+    if not 0 <= time.time() - reg_data["registered_at"] < ttl:
+        return False
+    if cluster_id is not None and cluster_id > 0 and str(cluster_id) != reg_data["cluster_id"]:
+        return False
+    return (reg_data["hostname"] == hostname and
+            set(reg_data["mac_addresses"].split(",")) == set(macs) and
+            reg_data["distribution"] == dist and
+            reg_data.get("hidden_repos") == hidden_repos)
+
+
+def refresh_registration(urlhandler, headers, reg_data, hostname, macs, dist, family, enable_repos, contract_id=None):
+    """
+    Refreshes the license, the repository configuration and the keyring of an unchanged registered node.
+
+    The credentials are still checked by the login before, but no new registration is needed.
+
+    :param Optional[int] contract_id: used if reg_data was written by a version that did not store it
+    """
+    answer = urlhandler.post_license_from_nodehash(
+        headers,
+        reg_data["nodehash"],
+        mac_addresses=list(macs),
+        hostname=hostname,
+        contract_id=reg_data.get("contract_id", contract_id),
+        cluster_id=int(reg_data["cluster_id"]))
+    EVENTS.emit('registration', nodehash=reg_data["nodehash"], cluster_id=int(reg_data["cluster_id"]),
+                repos=sorted(reg_data["repos"]), refreshed=True)
+    if not answer.is_error() and answer.data().license_file_content:
+        write_proxy_license(answer.data().license_file_content, True)
+
+    repos = dict((k, Repo({"config": v})) for k, v in reg_data["repos"].items())
+    setup_repo_config(urlhandler, dist, family, repos=repos, free_running=True, enable_repos=enable_repos)
+    add_linbit_keyring(family, urlhandler, True)
+
+
+def read_inventory(path):
+    """
+    Reads the node inventory for fleet registration.
+
+    The inventory is either a JSON list of objects with the keys "hostname", "mac_addresses" and
+    "distribution" (and optionally "cluster_id"), or a text file with one node per line:
+    "hostname mac1,mac2 distribution [cluster_id]". Empty lines and lines starting with '#' are ignored.
+
+    :param str path: path to the inventory, '-' reads from stdin
+    :return: list of node dicts
+    :rtype: List[Dict[str, Any]]
+    """
+    if path == '-':
+        content = sys.stdin.read()
+    else:
+        with open(path) as infile:
+            content = infile.read()
+
+    nodes = []
+    if content.lstrip().startswith('['):
+        for node in json.loads(content):
+            macs = node.get("mac_addresses", [])
+            if not isinstance(macs, list):
+                macs = macs.split(',')
+            nodes.append({
+                "hostname": node["hostname"],
+                "mac_addresses": macs,
+                "distribution": node.get("distribution", "Unknown"),
+                "cluster_id": node.get("cluster_id"),
+            })
+    else:
+        for line in content.splitlines():
+            line = line.strip()
+            if len(line) == 0 or line[0] == '#':
+                continue
+            fields = line.split()
+            if len(fields) < 3:
+                raise Exception('Invalid inventory line: "{0}"'.format(line))
+            nodes.append({
+                "hostname": fields[0],
+                "mac_addresses": fields[1].split(','),
+                "distribution": fields[2],
+                "cluster_id": int(fields[3]) if len(fields) > 3 else None,
+            })
+
+    for node in nodes:
+        if node["cluster_id"] is not None:
+            node["cluster_id"] = int(node["cluster_id"])
+        if len(node["mac_addresses"]) == 0:
+            raise Exception('No MAC addresses for node "{0}"'.format(node["hostname"]))
+    return nodes
+
+
+def fleet_register(urlhandler, nodes, username, password, contract_id=None, cluster_id=None,
+                   workers=FLEET_WORKERS, hidden_repos=False, token_cache=None, placement=None):
+    """
+    Registers all nodes of an inventory with a single login.
+
+    The bearer token, the contract and the cluster lookups are shared by all nodes,
+    the per node requests are done by a bounded pool of worker threads.
+
+    :param urlhandler:
+    :param List[Dict[str, Any]] nodes: as returned by read_inventory()
+    :param str username:
+    :param str password:
+    :param Optional[int] contract_id: if not set, the only contract of the account is used
+    :param Optional[int] cluster_id: same semantics as LB_CLUSTER_ID, used for nodes without cluster_id.
+            -1 (or None) creates one new cluster for the whole batch, 0 appends to the last cluster
+    :param int workers: maximum number of concurrent registrations
+    :param bool hidden_repos: request hidden repos from backend
+    :param Optional[TokenCache] token_cache: reuse/store the login token
+    :param Optional[ClusterPlacement] placement: tried before cluster_id for nodes that are not registered,
+            the placed nodes are added to the index, so a cluster created for one node is found for the next ones
+    :return: list of per node result dicts in inventory order
+    :rtype: List[Dict[str, Any]]
+    """
+    headers = create_headers(username)
+    if urlhandler.login(headers, username, password, token_cache) == 401:
+        err(E_WRONG_CREDS, "Username and/or Credential are wrong")
+    OK("Login successful")
+
+    if contract_id is None:
+        contracts_list = urlhandler.get_contracts(headers).list
+        if len(contracts_list) == 0:
+            err(E_FAIL, "Sorry, but you do not have any valid contract for this credential")
+        elif len(contracts_list) > 1:
+            err(E_NEED_PARAMS, "Your account has more than one contract, please set LB_CONTRACT_ID")
+        contract_id = contracts_list[0].id
+
+    # clusters are looked up/created at most once for the whole batch, and only if a node needs it
+    batch_clusters = {}
+    batch_index = []
+    lock = threading.Lock()
+
+    def get_index():
+        if not batch_index:
+            index = placement.index() if placement is not None else ClusterIndex(())
+            batch_index.append(urlhandler.get_cluster_index(headers, contract_id, index))
+        return batch_index[0]
+
+    def place(hostname, mode):
+        # one node at a time, every lookup is O(1) and only creating a cluster needs a request
+        with lock:
+            new_id, rule = placement.place(get_index(), hostname) if placement is not None else (None, None)
+            if new_id == -1:
+                new_id = urlhandler.post_create_cluster(headers, contract_id).id
+            elif new_id is None:
+                if mode not in batch_clusters:
+                    batch_clusters[mode] = get_index().last if mode == 0 else None
+                    if batch_clusters[mode] is None:
+                        batch_clusters[mode] = urlhandler.post_create_cluster(headers, contract_id).id
+                new_id = batch_clusters[mode]
+            if placement is not None:
+                get_index().add_node(new_id, hostname)
+            return new_id, rule
+
+    def register(node):
+        hostname = node["hostname"]
+        macs = node["mac_addresses"]
+        result = {"hostname": hostname, "success": False}
+        try:
+            node_cluster = node["cluster_id"] if node["cluster_id"] is not None else cluster_id
+            if node_cluster is None or node_cluster in [-1, 0]:
+                reg_node = urlhandler.post_is_node_registered(
+                    headers,
+                    contract_id=contract_id,
+                    hostname=hostname,
+                    mac_addresses=macs)
+                if reg_node is None:
+                    node_cluster, rule = place(hostname, 0 if node_cluster == 0 else -1)
+                    if rule is not None:
+                        result["placement"] = rule
+                else:
+                    node_cluster = reg_node.cluster_id
+
+            answer = urlhandler.post_register_node(
+                headers,
+                contract_id=contract_id,
+                cluster_id=node_cluster,
+                hostname=hostname,
+                distribution=node["distribution"],
+                mac_addresses=macs,
+                register_version=REMOTEVERSION,
+                hidden_repos=hidden_repos)
+            if answer.is_error():
+                if answer.error_code() == 1100:
+                    result["error"] = "Sorry, but you do not have any nodes left for this contract"
+                else:
+                    result["error"] = answer.error_msg()
+                return result
+            ret = answer.data()
+            result["nodehash"] = ret.nodehash
+            result["contract_id"] = contract_id
+            result["cluster_id"] = ret.cluster_id
+            result["repos"] = ret.configs
+
+            answer = urlhandler.post_license_from_nodehash(
+                headers,
+                ret.nodehash,
+                mac_addresses=macs,
+                hostname=hostname,
+                contract_id=contract_id,
+                cluster_id=ret.cluster_id)
+            if not answer.is_error():
+                result["license_file_content"] = answer.data().license_file_content
+            result["success"] = True
+        except SystemExit as e:
+            # err() already printed the reason, do not let one node abort the batch
+            result["error"] = "exit code {0}".format(e.code)
+        except Exception as e:
+            result["error"] = str(e)
+        return result
+
+    return parallel_map(register, nodes, workers)
+
+
+def print_fleet_report(results, report_file=None):
+    """
+    Prints one line per node and optionally writes all results as JSON.
+
+    :param List[Dict[str, Any]] results: as returned by fleet_register()
+    :param Optional[str] report_file:
+    :return: number of failed registrations
+    :rtype: int
+    """
+    failed = 0
+    for r in results:
+        EVENTS.emit('node', **r)
+        if r["success"]:
+            OK("{0}: registered in cluster {1} (nodehash: {2})".format(r["hostname"], r["cluster_id"], r["nodehash"]))
+            if "changed" in r:
+                print("  changed: {0}".format(", ".join(r["changed"]) or "nothing"))
+        else:
+            failed += 1
+            warn("{0}: {1}".format(r["hostname"], r.get("error")))
+    print("{0} of {1} nodes registered".format(len(results) - failed, len(results)))
+    EVENTS.emit('fleet', registered=len(results) - failed, failed=failed)
+
+    if report_file:
+        with open(report_file, "w") as outfile:
+            json.dump(results, outfile, indent=2)
+        OK("Report written to {0}".format(report_file))
+
+    return failed
+
+
+class SSHTransport(object):
+    """
+    Runs shell scripts on remote hosts.
+
+    command is split like a shell would do it, the host and "sh -s" get appended and the script is passed on stdin.
+    Anything that behaves like ssh can be used, e.g. a local stub that runs the script in a test directory.
+    """
+    def __init__(self, command=SSH_COMMAND):
+        self._argv = shlex.split(command)
+
+    def run(self, host, script, timeout=SSH_TIMEOUT):
+        """
+        :param str host: destination as understood by the command, e.g. "root@node1"
+        :param str script:
+        :param float timeout: seconds until the command gets killed
+        :return: stdout of the script
+        :rtype: str
+        :raises RuntimeError: if the command fails or times out
+        """
+        # own session, so that a timeout also kills whatever the command started. preexec_fn is not safe
+        # while other threads run, python 3 creates the session without it
+        if sys.version_info[0] >= 3:
+            session = {'start_new_session': True}
+        else:
+            session = {'preexec_fn': os.setsid}
+        proc = subprocess.Popen(self._argv + [host, 'sh -s'],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **session)
+        timed_out = []
+
+        def kill():
+            timed_out.append(True)
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+        try:
+            out, errout = proc.communicate(script.encode('utf-8'))
+        finally:
+            timer.cancel()
+        if timed_out:
+            raise RuntimeError("timed out after {0}s".format(timeout))
+        if proc.returncode != 0:
+            msg = errout.decode('utf-8', 'replace').strip()
+            raise RuntimeError(msg or "exit code {0}".format(proc.returncode))
+        return out.decode('utf-8', 'replace')
+
+
+def read_ssh_hosts(path):
+    """
+    Reads the hosts for SSH registration, one "destination [cluster_id]" per line.
+
+    Empty lines and lines starting with '#' are ignored.
+
+    :param str path: path to the host list, '-' reads from stdin
+    :rtype: List[Dict[str, Any]]
+    """
+    if path == '-':
+        content = sys.stdin.read()
+    else:
+        with open(path) as infile:
+            content = infile.read()
+
+    hosts = []
+    for line in content.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split()
+        hosts.append({
+            "host": fields[0],
+            "cluster_id": int(fields[1]) if len(fields) > 1 else None,
+        })
+    return hosts
+
+
+PROBE_MARK = "@@lmn "
+# everything HostFacts.collect() looks at, the NICs are filtered by usable_nic() afterwards
+PROBE_SCRIPT = """
+echo "@@lmn hostname"
+uname -n
+for f in /etc/os-release /etc/centos-release /etc/redhat-release; do
+    [ -f "$f" ] && echo "@@lmn file $f" && cat "$f"
+done
+[ -x /usr/bin/pveversion ] && echo "@@lmn file /usr/bin/pveversion" && /usr/bin/pveversion
+echo "@@lmn net"
+for d in /sys/class/net/*; do
+    [ -L "$d" ] || continue
+    printf '%s %s %s %s\\n' "${d##*/}" "$(cat "$d/type")" "$(cat "$d/addr_assign_type" 2>/dev/null || echo -)" \\
+        "$(cat "$d/address")"
+done
+exit 0
+"""
+
+
+def probe_host(transport, host, timeout=SSH_TIMEOUT):
+    """
+    Collects the registration data of a remote host in a single round trip.
+
+    :return: node dict as returned by read_inventory(), with the additional keys "host" and "family"
+    :rtype: Dict[str, Any]
+    """
+    sections = {}
+    lines = None
+    for line in transport.run(host, PROBE_SCRIPT, timeout).splitlines():
+        if line.startswith(PROBE_MARK):
+            lines = sections.setdefault(line[len(PROBE_MARK):], [])
+        elif lines is not None:
+            lines.append(line)
+
+    hostname = sections.get("hostname", [""])[0].strip().split('.')[0]
+    if not hostname:
+        raise RuntimeError("could not determine the hostname")
+
+    macs = []
+    for line in sections.get("net", []):
+        fields = line.split()
+        if len(fields) != 4:
+            continue
+        name, dev_type, aatype, mac = fields
+        if usable_nic(name, dev_type, None if aatype == '-' else aatype) and mac not in macs:
+            macs.append(mac)
+    if not macs:
+        raise RuntimeError("could not detect MAC addresses")
+
+    files = dict((k[len("file "):], '\n'.join(v) + '\n') for k, v in sections.items() if k.startswith("file "))
+    try:
+        lbd = ProbedDistribution(files)
+        dist = lbd.registration_name
+    except Exception as e:
+        raise RuntimeError("could not determine the distribution: {0}".format(e))
+
+    return {
+        "host": host,
+        "hostname": hostname,
+        "mac_addresses": macs,
+        "distribution": dist,
+        "family": lbd.family,
+    }
+
+
+def push_script(files):
+    """
+    Generates a script that writes files on a remote host.
+
+    Files that already have the content are left alone, the others are replaced atomically.
+    The script prints "changed <path>" or "unchanged <path>" for every file.
+
+    The script runs with umask 077, so the temporary files (e.g., of the proxy license) and created
+    directories are private. Like atomic_write(), replaced files keep their mode and new files get 0644.
+
+    :param List[Tuple[str, bytes]] files: path and content
+    :rtype: str
+    """
+    def quote(arg):
+        return "'" + arg.replace("'", "'\\''") + "'"
+
+    lines = ["umask 077"]
+    for path, data in files:
+        p, t = quote(path), quote(path + '.lmn-tmp')
+        lines.append(
+            "mkdir -p {d} && rm -f {t} && echo {b} | base64 -d > {t} && "
+            "if cmp -s {t} {p}; then rm -f {t}; echo unchanged {p}; "
+            "else {{ chmod --reference={p} {t} 2>/dev/null || chmod 0644 {t}; }} && "
+            "mv -f {t} {p} && echo changed {p}; fi || exit 1".format(
+                d=quote(os.path.dirname(path)), b=base64.b64encode(data).decode('ascii'), t=t, p=p))
+    return '\n'.join(lines) + '\n'
+
+
+def registered_node_files(node, result, enable_repos):
+    """
+    The files a registered node gets, as written by a local run in non-interactive mode.
+
+    :param Dict[str, Any] node: as returned by probe_host()
+    :param Dict[str, Any] result: successful result of fleet_register() for the node
+    :param Optional[List[str]] enable_repos: RepoSelector rules of the repos to enable, all if None
+    :return: path and content
+    :rtype: List[Tuple[str, bytes]]
+    """
+    configs = result["repos"]
+    enabled = select_repos(configs, enable_repos, True)
+    files = [(REPO_FILES[node["family"]], file_content(repo_config_content(node["family"], configs, enabled)))]
+
+    if result.get("license_file_content"):
+        files.append(("/etc/drbd-proxy.license", base64.b64decode(result["license_file_content"])))
+
+    reg_data = {
+        "nodehash": result["nodehash"],
+        "contract_id": result.get("contract_id"),
+        "cluster_id": str(result["cluster_id"]),
+        "hostname": node["hostname"],
+        "distribution": node["distribution"],
+        "mac_addresses": ",".join(node["mac_addresses"]),
+        "hidden_repos": enable_repos is not None,
+        "repos": configs,
+        "registered_at": int(time.time()),
+    }
+    files.append((NODE_REG_DATA, file_content(reg_data, asjson=True)))
+    return files
+
+
+def ssh_register(urlhandler, transport, hosts, username, password, contract_id=None, cluster_id=None,
+                 workers=FLEET_WORKERS, timeout=SSH_TIMEOUT, enable_repos=None, token_cache=None, placement=None):
+    """
+    Registers remote hosts over SSH, only this host talks to my.linbit.com.
+
+    All hosts are probed with probe_host(), registered by fleet_register() and then get their
+    repository configuration, proxy license and NODE_REG_DATA written back.
+    At most workers hosts are probed/written at once, every SSH command is killed after timeout seconds.
+
+    :param SSHTransport transport:
+    :param List[Dict[str, Any]] hosts: as returned by read_ssh_hosts()
+    :param Optional[List[str]] enable_repos: same semantics as LB_REPOS, also requests hidden repos if set
+    :return: per host result dicts as fleet_register(), with the additional keys "host" and "changed"
+    :rtype: List[Dict[str, Any]]
+    """
+    def probe(host):
+        try:
+            node = probe_host(transport, host["host"], timeout)
+            node["cluster_id"] = host["cluster_id"]
+            return node, None
+        except Exception as e:
+            return None, {"host": host["host"], "hostname": host["host"], "success": False,
+                          "error": "probe failed: {0}".format(e)}
+
+    probed = parallel_map(probe, hosts, workers)
+    nodes = [node for node, _ in probed if node is not None]
+    if not nodes:
+        return [failed for _, failed in probed]
+    registered = iter(fleet_register(urlhandler, nodes, username, password,
+                                     contract_id=contract_id, cluster_id=cluster_id, workers=workers,
+                                     hidden_repos=enable_repos is not None, token_cache=token_cache,
+                                     placement=placement))
+
+    def push(item):
+        node, result = item
+        result["host"] = node["host"]
+        if not result["success"]:
+            return result
+        try:
+            out = transport.run(node["host"], push_script(registered_node_files(node, result, enable_repos)), timeout)
+            result["changed"] = [line.split(' ', 1)[1] for line in out.splitlines() if line.startswith("changed ")]
+        except Exception as e:
+            result["success"] = False
+            result["error"] = "registered, but writing the configuration failed: {0}".format(e)
+        return result
+
+    pushed = iter(parallel_map(push, [(node, next(registered)) for node in nodes], workers))
+    return [next(pushed) if node is not None else failed for node, failed in probed]
+
+
+def main():
+    py_major, py_minor = sys.version_info[:2]
+    if py_major < 2 or (py_major == 2 and py_minor < 6):
+        warn('Your Python version ({0}.{1}) is too old, manually add your nodes via https://my.linbit.com'.format(py_major, py_minor))
+        warn('If you need further help, contact us:\n')
+        contactInfo('', is_issue=False)
+        sys.exit(1)
+    free_running = False
+    proxy_only = False
+    non_interactive = False
+    exclude_info_only = False
+    hints_only = False
     contract_id = None  # type: Optional[int]
     cluster_id = None  # type: Optional[int]
     nodehash = None  # type: Optional[str]
 
     # urlhandler = requestsHandler()
-    urlhandler = UrllibHandler()
-
+    pool = HTTPConnectionPool(retry_policy=RetryPolicy(attempts=env_number('LMN_HTTP_RETRIES', HTTP_RETRIES)))
+    urlhandler = UrllibHandler(pool=pool, cache=DownloadCache.open(os.getenv('LMN_CACHE_DIR', CACHE_DIR)),
+                               cluster_page_size=env_number('LMN_CLUSTER_PAGE_SIZE', CLUSTER_PAGE_SIZE),
+                               metadata=MetadataCache.open(ttl=env_number('LB_METADATA_TTL', METADATA_TTL)))
+    if os.getenv('LMN_HTTP_STATS'):
+        atexit.register(print_connection_stats, urlhandler)
+
+    reg_data = None
     if os.path.isfile(NODE_REG_DATA):
         with open(NODE_REG_DATA) as infile:
-            jsondata = json.load(infile)
-            nodehash = jsondata["nodehash"]
+            reg_data = json.load(infile)
+            nodehash = reg_data["nodehash"]
+
+    inventory = pop_opt_value("--inventory")
+    facts_file = pop_opt_value("--facts")
+    facts_root = pop_opt_value("--facts-root") or '/'
+    ssh_hosts = pop_opt_value("--ssh-hosts")
+    profile_json = pop_opt_value("--profile-json")
+    if "--no-color" in sys.argv:
+        sys.argv.remove("--no-color")
+        global NO_COLOUR
+        NO_COLOUR = True
+    if "--json" in sys.argv:
+        sys.argv.remove("--json")
+        # stdout only carries the events, everything meant for humans goes to stderr
+        EVENTS.enable(sys.stdout)
+        sys.stdout = sys.stderr
+
+    if profile_json or "--profile" in sys.argv:
+        if "--profile" in sys.argv:
+            sys.argv.remove("--profile")
+        PROFILER.enable(profile_json)
+        atexit.register(PROFILER.report)
 
     opts = sys.argv[1:]
     for opt in opts:
@@ -673,6 +1759,11 @@ def main():
         elif opt == "--hints":
             hints_only = True
 
+    # the configuration, license and registration data would be written to this host, not the described one
+    if (facts_file or facts_root != '/') and not (hints_only or exclude_info_only):
+        err(E_NEED_PARAMS, '"--facts" and "--facts-root" describe another host, '
+                           'they can only be used with "--hints" or "--exclude-info"')
+
     e_user = os.getenv('LB_USERNAME', None)
     e_pwd = os.getenv('LB_PASSWORD', None)
     """
@@ -682,47 +1773,118 @@ def main():
     >0  add the node to this cluster id
     """
     e_cluster = os.getenv('LB_CLUSTER_ID', None)
+    """
+    LB_CLUSTER_PLACEMENT
+    Comma separated rules of ClusterPlacement (e.g., "hostname,prefix,new"), tried for nodes that are not
+    registered yet before LB_CLUSTER_ID applies.
+    """
+    e_placement = os.getenv('LB_CLUSTER_PLACEMENT')
+    placement = None
+    if e_placement is not None:
+        try:
+            placement = ClusterPlacement(e_placement.split(','))
+        except ValueError as e:
+            err(E_NEED_PARAMS, "Invalid LB_CLUSTER_PLACEMENT: {0}".format(e))
     e_contract = os.getenv('LB_CONTRACT_ID', None)
     e_no_version_check = os.getenv('LB_NO_VERSION_CHECK', None)
     """
     LB_REPOS
     Comma separated list of repo names to pre-enable, if not set all enabled, if empty all disabled.
+    Besides names, the rules of RepoSelector can be used (e.g., "latest drbd-9.*,all pacemaker-*").
     In non_interactive mode this also will fetch "-only" repos
     """
     e_repos = os.getenv('LB_REPOS')  # type: Optional[list[str]]
     e_repos = e_repos.split(',') if e_repos is not None else None
+    if e_repos is not None:
+        try:
+            RepoSelector(e_repos)
+        except ValueError as e:
+            err(E_NEED_PARAMS, "Invalid LB_REPOS: {0}".format(e))
 
-    e_all = bool(e_user and e_pwd and (e_cluster or e_repos))
-    e_one = e_user or e_pwd or e_cluster or e_contract
+    if inventory:
+        if not (e_user and e_pwd):
+            err(E_NEED_PARAMS, 'Fleet registration requires LB_USERNAME and LB_PASSWORD')
+        try:
+            nodes = read_inventory(inventory)
+        except Exception as e:
+            err(E_FAIL, "Could not read inventory {0}: {1}".format(inventory, e))
+        with PROFILER.span('version check'):
+            if not e_no_version_check:
+                checkVersion(urlhandler)
+        with PROFILER.span('fleet registration'):
+            results = fleet_register(
+                urlhandler, nodes, e_user, e_pwd,
+                contract_id=env_number('LB_CONTRACT_ID'),
+                cluster_id=env_number('LB_CLUSTER_ID'),
+                workers=env_number('LB_FLEET_WORKERS', FLEET_WORKERS),
+                hidden_repos=e_repos is not None,
+                token_cache=TokenCache.open(),
+                placement=placement)
+        failed = print_fleet_report(results, os.getenv('LB_FLEET_REPORT'))
+        sys.exit(E_FAIL if failed else E_SUCC)
+
+    if ssh_hosts:
+        if not (e_user and e_pwd):
+            err(E_NEED_PARAMS, 'SSH registration requires LB_USERNAME and LB_PASSWORD')
+        try:
+            hosts = read_ssh_hosts(ssh_hosts)
+        except Exception as e:
+            err(E_FAIL, "Could not read host list {0}: {1}".format(ssh_hosts, e))
+        with PROFILER.span('version check'):
+            if not e_no_version_check:
+                checkVersion(urlhandler)
+        with PROFILER.span('ssh registration'):
+            results = ssh_register(
+                urlhandler, SSHTransport(os.getenv('LB_SSH_COMMAND', SSH_COMMAND)), hosts, e_user, e_pwd,
+                contract_id=env_number('LB_CONTRACT_ID'),
+                cluster_id=env_number('LB_CLUSTER_ID'),
+                workers=env_number('LB_FLEET_WORKERS', FLEET_WORKERS),
+                timeout=env_number('LB_SSH_TIMEOUT', SSH_TIMEOUT, float),
+                enable_repos=e_repos,
+                token_cache=TokenCache.open(),
+                placement=placement)
+        failed = print_fleet_report(results, os.getenv('LB_FLEET_REPORT'))
+        sys.exit(E_FAIL if failed else E_SUCC)
+
+    e_all = bool(e_user and e_pwd and (e_cluster or e_repos or e_placement))
+    e_one = e_user or e_pwd or e_cluster or e_contract or e_placement
 
     if e_one and not e_all:
-        err(E_NEED_PARAMS, 'You have to set all (or none) of the required environment variables (LB_USERNAME, LB_PASSWORD, and (LB_CLUSTER_ID or LB_REPOS)')
+        err(E_NEED_PARAMS, 'You have to set all (or none) of the required environment variables (LB_USERNAME, LB_PASSWORD, and (LB_CLUSTER_ID, LB_CLUSTER_PLACEMENT or LB_REPOS)')
     if e_all and proxy_only:
         err(E_FAIL, 'You are not allowed to mix "-p" and non-interactive mode')
 
     non_interactive = e_all
     free_running = proxy_only or non_interactive
+    if free_running:
+        buffer_stdout()
 
     headers = {}
 
     # these defaults are weird, but that is what it was
-    lbd, dist_name, dist, family, dist_version = None, '', '', False, ''
-    try:
-        lbd = LinbitDistribution()
-        dist_name = lbd.name
-        dist = lbd.repo_name
-        family = lbd.family
-        dist_version = lbd.version
-    except Exception:
-        pass  # benignly handled
+    with PROFILER.span('host detection'):
+        try:
+            facts = host_facts(facts_file, facts_root, env_number('LB_FACTS_TTL', FACTS_TTL))
+        except (IOError, OSError, ValueError, KeyError) as e:
+            err(E_FAIL, "Could not read host facts: {0}".format(e))
+
+        lbd, dist, family = None, '', False
+        try:
+            lbd = facts.distribution()
+            dist = lbd.registration_name
+            family = lbd.family
+        except Exception:
+            pass  # benignly handled
 
-    hostname, macs = getHostInfo()
-    if family == "debian" and dist_name != "proxmox":
-        dist = '{0}-{1}'.format(dist_name, dist_version)
+        hostname, macs = facts.hostname, facts.mac_addresses
+        EVENTS.emit('host', hostname=hostname, distribution=dist, family=family or None,
+                    mac_addresses=sorted(macs), kernel_release=facts.kernel_release)
 
     if hints_only:
-        hints = lbd.epilogue(with_pacemaker=False) if lbd else "No hints for distribution"
+        hints = lbd.epilogue(with_pacemaker=False, kernel_release=facts.kernel_release) if lbd \
+            else "No hints for distribution"
         print(hints)
+        EVENTS.emit('hints', text=hints if lbd else "")
         sys.exit(0)
 
     if exclude_info_only:
@@ -731,7 +1893,7 @@ def main():
 
     if non_interactive:
         contract_id = e_contract
-        cluster_id = int(e_cluster) if e_cluster is not None else None
+        cluster_id = env_number('LB_CLUSTER_ID')
 
     if len(macs) == 0:
         err(E_FAIL, "Could not detect MAC addresses of your node")
@@ -752,8 +1914,9 @@ def main():
     elif not exclude_info_only:
         force_user_input = False
         print("{0} (Version: {1})".format(MYNAME, VERSION))
-        if not e_no_version_check:
-            checkVersion(urlhandler)
+        with PROFILER.span('version check'):
+            if not e_no_version_check:
+                checkVersion(urlhandler)
 
         while True:
             username = e_user
@@ -765,7 +1928,10 @@ def main():
             # create a first request to test UN/PWD
             if not free_running:
                 print("Connecting to {0}".format(MYLINBIT))
-            status, jwt_token = urlhandler.post_login_request(headers, username, password)
+            with PROFILER.span('login'):
+                # only non-interactive runs reuse tokens, interactive users type their credentials anyways
+                status = urlhandler.login(headers, username, password,
+                                          TokenCache.open() if non_interactive else None)
             if status == 401:
                 msg = "Username and/or Credential are wrong"
                 if non_interactive:
@@ -775,12 +1941,12 @@ def main():
                 force_user_input = True
             else:
                 OK("Login successful")
-                headers['Authorization'] = "Bearer " + jwt_token
+                EVENTS.emit('login', username=username)
                 break
 
     if not dist and not free_running:
         print("Distribution information could not be retrieved")
-        contactInfo(executeCommand("uname -a"))
+        contactInfo(facts.uname)
         print("You can still register your node, but the script will not")
         print("write a repository configuration for this node")
         cont_or_exit()
@@ -800,6 +1966,15 @@ def main():
         print("")
         cont_or_exit()
 
+    if non_interactive and family and not os.getenv('LB_FORCE_REGISTER') and \
+            registration_is_current(reg_data, hostname, macs, dist, cluster_id, e_repos is not None,
+                                    env_number('LB_REGISTRATION_TTL', REGISTRATION_TTL)):
+        with PROFILER.span('refresh registration'):
+            refresh_registration(urlhandler, headers, reg_data, hostname, macs, dist, family, e_repos,
+                                 contract_id=contract_id)
+        print_file_changes()
+        sys.exit(0)
+
     # XXX
     # fake redhat
     # dist = "rhel7.2"
@@ -815,13 +1990,8 @@ def main():
     # XXX
 
     if contract_id is None:
-        answer = urlhandler.get_request(CONTRACT_URL, headers, ContractsResponse)
-
-        if answer.is_error():
-            err(E_FAIL, answer.error_msg())
-
-        contracts_resp = answer.data()  # type: ContractsResponse
-        contracts_list = contracts_resp.list
+        with PROFILER.span('contracts'):
+            contracts_list = urlhandler.get_contracts(headers).list
         contract_len = len(contracts_list)
         if contract_len == 0:
             err(E_FAIL, "Sorry, but you do not have any valid contract for this credential")
@@ -832,51 +2002,75 @@ def main():
             contract_id = getOptions(opts, what="contract")
         else:
             contract_id = contracts_list[0].id
+    EVENTS.emit('contract', contract_id=contract_id)
 
+    cluster_created = False
+    cluster_rule = None
     if cluster_id is None or cluster_id in [-1, 0]:
-        reg_node = urlhandler.post_is_node_registered(
-            headers,
-            contract_id=contract_id,
-            hostname=hostname,
-            mac_addresses=list(macs))
-        if reg_node is None:
-            ret = urlhandler.get_request(CLUSTER_URL.format(contract_id), headers, ClustersResponse)
-            if ret.is_error():
-                err(E_FAIL, ret.error_msg())
-            clusters = ret.data()  # type: ClustersResponse
-            cluster_list = clusters.list
-
-            if non_interactive:
-                if cluster_id == 0 and len(cluster_list) > 0:
-                    # append to last cluster
-                    cluster_id = cluster_list[len(cluster_list) - 1].id
+        with PROFILER.span('clusters'):
+            rules = placement
+            if rules is None and not non_interactive:
+                # only a suggestion, the question is asked anyway
+                rules = ClusterPlacement(CLUSTER_SUGGESTION.split(','))
+            index_task = None
+            if rules is not None or cluster_id == 0:
+                # we need the clusters if the node is not registered yet, fetch them in parallel
+                index_task = BackgroundTask(urlhandler.get_cluster_index, headers, contract_id,
+                                            rules.index() if rules is not None else ClusterIndex(()), fail=False)
+            reg_node = urlhandler.post_is_node_registered(
+                headers,
+                contract_id=contract_id,
+                hostname=hostname,
+                mac_addresses=list(macs))
+            if reg_node is None:
+                index = index_task.result() if index_task else None
+                if index is None and index_task:
+                    index = urlhandler.get_cluster_index(headers, contract_id,
+                                                         rules.index() if rules is not None else ClusterIndex(()))
+
+                if non_interactive:
+                    new_id, cluster_rule = placement.place(index, hostname) if placement is not None else (None, None)
+                    if new_id is None and cluster_id == 0:
+                        # append to last cluster
+                        new_id = index.last
+                    if new_id is None or new_id == -1:
+                        # create new cluster
+                        ret = urlhandler.post_create_cluster(headers, contract_id)
+                        new_id = ret.id
+                        cluster_created = True
+                    cluster_id = new_id
                 else:
-                    # create new cluster
-                    ret = urlhandler.post_create_cluster(headers, contract_id)
-                    cluster_id = ret.id
+                    cluster_id = -1
+                    # only ask for cluster if we have any at all
+                    if len(index) > 0:
+                        # large contracts have thousands of clusters, only the last ones and the suggestion are listed
+                        opts = {}
+                        for x in index.recent:
+                            opts[x.id] = " ".join(x.hostnames) if x.hostnames else None
+                        suggested, rule = rules.place(index, hostname)
+                        if suggested is not None and suggested != -1:
+                            opts[suggested] = '{0} [suggested by rule "{1}"]'.format(opts.get(suggested) or "...", rule)
+                        cluster_id = getOptions(opts, allow_new=True, what="cluster", all_keys=index)
+                        if cluster_id == suggested:
+                            cluster_rule = rule
+                    if cluster_id == -1:
+                        ret = urlhandler.post_create_cluster(headers, contract_id)
+                        cluster_id = ret.id
+                        cluster_created = True
             else:
-                opts = {}
-                cluster_id = -1
-                # only ask for cluster if we have any at all
-                if len(cluster_list) > 0:
-                    for x in cluster_list:
-                        opts[x.id] = " ".join([y.hostname for y in x.nodes]) if x.nodes else None
-                    cluster_id = getOptions(opts, allow_new=True, what="cluster")
-                if cluster_id == -1:
-                    ret = urlhandler.post_create_cluster(headers, contract_id)
-                    cluster_id = ret.id
-        else:
-            cluster_id = reg_node.cluster_id
+                cluster_id = reg_node.cluster_id
+    EVENTS.emit('cluster', cluster_id=cluster_id, created=cluster_created, placement=cluster_rule)
 
-    answer = urlhandler.post_register_node(
-        headers,
-        contract_id=contract_id,
-        cluster_id=cluster_id,
-        hostname=hostname,
-        distribution=dist,
-        mac_addresses=list(macs),
-        register_version=REMOTEVERSION,
-        hidden_repos=e_repos is not None)
+    with PROFILER.span('register node'):
+        answer = urlhandler.post_register_node(
+            headers,
+            contract_id=contract_id,
+            cluster_id=cluster_id,
+            hostname=hostname,
+            distribution=dist,
+            mac_addresses=list(macs),
+            register_version=REMOTEVERSION,
+            hidden_repos=e_repos is not None)
 
     if answer.is_error():
         if answer.error_code() == 1100:
@@ -884,81 +2078,126 @@ def main():
         else:
             err(E_FAIL, answer.error_msg())
     ret = answer.data()
+    EVENTS.emit('registration', nodehash=ret.nodehash, cluster_id=ret.cluster_id,
+                repos=sorted(ret.repos), refreshed=False)
 
     if not free_running:
         printcolour("Writing registration data:\n", GREEN)
     args_save = {
         "nodehash": ret.nodehash,
+        "contract_id": contract_id,
         "cluster_id": str(ret.cluster_id),  # stay compatible with old format
         "hostname": hostname,
         "distribution": dist,
         "mac_addresses": ",".join(macs),  # stay compatible with old format
+        # for reruns that do not need to register again, see registration_is_current()
+        "hidden_repos": e_repos is not None,
+        "repos": ret.configs,
+        "registered_at": int(time.time()),
     }
     writeFile(NODE_REG_DATA, args_save, showcontent=False,
               free_running=free_running, asjson=True)
     if dist != "Unknown" and family:
-        answer = urlhandler.post_license_from_nodehash(
+        # the license, the yum plugin and the keyring do not depend on each other, request them all at once
+        license_task = BackgroundTask(
+            urlhandler.post_license_from_nodehash,
             headers,
             ret.nodehash,
             mac_addresses=list(macs),
             hostname=hostname,
             contract_id=contract_id,
             cluster_id=cluster_id)
-        if not answer.is_error():
-            write_proxy_license(answer.data().license_file_content, free_running)
+        if family == "rhel" and (not free_running or non_interactive):
+            urlhandler.prefetch(yum_plugin_location(dist)[0])
+            urlhandler.prefetch(LINBIT_PLUGIN_CONF)
+        if isRoot() and keyring_info(family)[0]:
+            urlhandler.prefetch(keyring_info(family)[0])
+        kmod_resolver = BestKmodResolver(lbd, urlhandler.cache, uname_r=facts.kernel_release) \
+            if lbd and not free_running else None
+
+        with PROFILER.span('license'):
+            answer = license_task.result()
+            if not answer.is_error():
+                write_proxy_license(answer.data().license_file_content, free_running)
+            else:
+                EVENTS.emit('license', path=None, changed=False, error=answer.error_msg())
 
-        if not free_running or non_interactive:
-            setup_repo_config(urlhandler, dist, family,
-                              repos=ret.repos, free_running=non_interactive, enable_repos=e_repos)
+        with PROFILER.span('repo config'):
+            if not free_running or non_interactive:
+                setup_repo_config(urlhandler, dist, family,
+                                  repos=ret.repos, free_running=non_interactive, enable_repos=e_repos)
 
-        add_linbit_keyring(family, urlhandler, free_running)
+        with PROFILER.span('keyring'):
+            add_linbit_keyring(family, urlhandler, free_running)
 
         if not free_running:  # RCK THINK
-            # TODO: needs detection if user enabled pacemaker repos
-            lbd_epilogue = lbd.epilogue(with_pacemaker=False) if lbd else ""
-            epilogue(family, dist, lbd_epilogue, urlhandler)
-
+            with PROFILER.span('epilogue'):
+                # TODO: needs detection if user enabled pacemaker repos
+                lbd_epilogue = lbd.epilogue(with_pacemaker=False, kmod_resolver=kmod_resolver,
+                                            kernel_release=facts.kernel_release) if lbd else ""
+                epilogue(family, dist, lbd_epilogue, urlhandler)
+                EVENTS.emit('hints', text=lbd_epilogue)
+        elif EVENTS.enabled and lbd:
+            EVENTS.emit('hints', text=lbd.epilogue(with_pacemaker=False, kernel_release=facts.kernel_release))
+
+    print_file_changes()
     if not free_running:
         OK("Congratulations! Your node was successfully configured.")
     sys.exit(0)
 
 
 # Utility functions that are unlikely to require change
+def upstream_version(urlhandler):
+    """
+    Reads VERSION of the upstream script.
+
+    Only the beginning of the script is requested, the rest is only read if the server
+    ignores the range or VERSION is not within it.
+
+    :return: major and minor, (sys.maxsize, 0) if VERSION was not found
+    :rtype: Tuple[int, int]
+    """
+    p = re.compile(r'^VERSION\s*=\s*[\'"](\d+)\.(\d+)')
+
+    def find(f):
+        for line in f:
+            m = p.match(line.decode('utf-8').strip())
+            if m:
+                return int(m.group(1)), int(m.group(2))
+        return None
+
+    f = urlhandler.get_range(SELF, 0, VERSION_PROBE_SIZE - 1)
+    version = find(f)
+    if version is None and f.getcode() == 206:
+        version = find(urlhandler.fileHandle(SELF))
+    return version or (sys.maxsize, 0)
+
+
 def checkVersion(urlhandler):
-    import re
     printcolour("Checking if version is up to date\n", GREEN)
     outdated = False
 
     # we do not want to fail if anything is wrong here...
     try:
-        f = urlhandler.fileHandle(SELF)
-        selfpy = [selfline for selfline in f]
-        p = re.compile(r'^VERSION.*(\d+)\.(\d+).*')
-
-        upstream_major = sys.maxsize
-        upstream_minor = 0
-
-        for line in selfpy:
-            m = p.match(line.decode('utf-8').strip())
-            if m:
-                upstream_major = int(m.group(1))
-                upstream_minor = int(m.group(2))
-                break
+        cache = urlhandler.cache
+        state = cache.load_state('version-check') if cache else None
+        if state and state.get('url') == SELF and 0 <= time.time() - state['checked'] < VERSION_CHECK_TTL:
+            upstream = tuple(state['version'])
+        else:
+            upstream = upstream_version(urlhandler)
+            if cache:
+                cache.save_state('version-check', {'url': SELF, 'checked': time.time(), 'version': list(upstream)})
 
         v = VERSION.split('.')
-        my_major = int(v[0])
-        my_minor = int(v[1])
-
-        if my_major < upstream_major:
-            outdated = True
-        elif my_major == upstream_major and my_minor < upstream_minor:
+        if (int(v[0]), int(v[1])) < upstream:
             outdated = True
+        EVENTS.emit('version_check', version=VERSION, outdated=outdated,
+                    latest='{0}.{1}'.format(*upstream) if upstream[0] != sys.maxsize else None)
 
         if outdated:
             warn("Your version is outdated")
             tmpf = tempfile.mkstemp(suffix='_' + MYNAME)[1]
-            writeFile(tmpf, selfpy, showcontent=False, askforwrite=False,
-                      hinttocopy=False)
+            downloadFile(urlhandler, SELF, tmpf, hinttocopy=False)
             OK("New version downloaded to {0}".format(tmpf))
         else:
             OK("Your version is up to date")
@@ -969,7 +2208,63 @@ def checkVersion(urlhandler):
         sys.exit(0)
 
 
+def pop_opt_value(name):
+    """
+    Removes an option and its value from sys.argv.
+
+    :param str name: option name, e.g. "--inventory"
+    :return: the value or None if the option was not given
+    :rtype: Optional[str]
+    """
+    if name not in sys.argv:
+        return None
+    idx = sys.argv.index(name)
+    if idx + 1 >= len(sys.argv):
+        err(E_NEED_PARAMS, '"{0}" requires an argument'.format(name))
+    value = sys.argv[idx + 1]
+    del sys.argv[idx:idx + 2]
+    return value
+
+
+def parallel_map(func, items, workers):
+    """
+    Calls func for every item using at most workers threads.
+
+    func has to handle its own errors, an exception terminates the worker thread.
+
+    :return: list of the return values of func in the order of items
+    :rtype: list
+    """
+    items = list(items)
+    results = [None] * len(items)
+    queue = Queue()
+    for i, item in enumerate(items):
+        queue.put((i, item))
+
+    def worker():
+        while True:
+            try:
+                i, item = queue.get_nowait()
+            except Empty:
+                return
+            results[i] = func(item)
+
+    threads = [threading.Thread(target=worker) for _ in range(max(1, min(workers, len(items))))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def print_connection_stats(urlhandler):
+    stats = urlhandler.connection_stats()
+    sys.stderr.write("HTTP connections: {0} new, {1} reused\n".format(stats["new"], stats["reused"]))
+
+
 def _executeCommand(command):
+    sys.stdout.flush()  # keep our output in front of whatever the command writes to stderr
     pyvers = sys.version_info
     if pyvers[0] == 2 and pyvers[1] == 6:
         output = subprocess.Popen(command, shell=True,
@@ -990,12 +2285,115 @@ def executeCommand(command):
 
 
 # content is a list of of lines
+def file_content(content, asjson=False):
+    """
+    Serializes content as writeFile() writes it.
+
+    :param content: list of lines (str or bytes), or an object if asjson is set
+    :rtype: bytes
+    """
+    if asjson:
+        content = [json.dumps(content)]
+    data = []
+    for line in content:
+        if not isinstance(line, bytes):
+            line = line.encode('utf-8')
+        data.append(line)
+    return b''.join(data)
+
+
+def file_sha256(name):
+    """
+    :return: hex sha256 of the file, read in chunks of DOWNLOAD_CHUNK
+    :rtype: str
+    """
+    h = hashlib.sha256()
+    with open(name, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(DOWNLOAD_CHUNK), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_is_current(name, data):
+    try:
+        if os.path.getsize(name) != len(data):
+            return False
+        return file_sha256(name) == hashlib.sha256(data).hexdigest()
+    except (IOError, OSError):
+        return False
+
+
+# os.umask() can only be read by setting it, that is done once at import while there is only one thread
+UMASK = os.umask(0o022)
+os.umask(UMASK)
+
+
+def atomic_write(name, chunks):
+    """
+    Replaces name with the concatenated chunks, readers either see the old or the new content.
+
+    The mode of an existing file is kept, new files get the default mode (0666 & ~umask).
+
+    :param str name:
+    :param Iterable[bytes] chunks:
+    """
+    dirname = os.path.dirname(name)
+    try:
+        mode = os.stat(name).st_mode & 0o7777
+    except OSError:
+        mode = 0o666 & ~UMASK
+
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.' + os.path.basename(name) + '.')
+    try:
+        with os.fdopen(fd, 'wb') as outfile:
+            for chunk in chunks:
+                outfile.write(chunk)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.chmod(tmp, mode)
+        os.rename(tmp, name)
+    except Exception:
+        os.unlink(tmp)
+        raise
+
+    try:
+        dirfd = os.open(dirname, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dirfd)
+    except OSError:
+        pass
+    finally:
+        os.close(dirfd)
+
+
+# file name -> True if writeFile() changed it, False if it already had the content
+FILE_CHANGES = {}
+
+
 def writeFile(name, content, showcontent=True, askforwrite=True,
               free_running=False, asjson=False, hinttocopy=True):
+    """
+    Writes content to name, files that already have the content are not touched.
+
+    If not run as root, the file gets written to /tmp. Whether the file changed is recorded in FILE_CHANGES.
+
+    :return: False if the user declined to write the file
+    :rtype: bool
+    """
     origname = name
     if not isRoot():
         name = os.path.join("/tmp", os.path.basename(name))
 
+    data = file_content(content, asjson)
+    if file_is_current(name, data):
+        FILE_CHANGES[origname] = False
+        EVENTS.emit('file', path=origname, written=name, changed=False)
+        if not free_running:
+            print("File {0} is up to date".format(name))
+        return True
+
     if showcontent and not free_running:
         print("Content:")
         for line in content:
@@ -1015,17 +2413,9 @@ def writeFile(name, content, showcontent=True, askforwrite=True,
     if not os.path.exists(dirname):
         os.makedirs(dirname)
 
-    with open(name, "w") as outfile:
-        if asjson:
-            json.dump(content, outfile)
-        else:
-            for line in content:
-                try:
-                    # py 3, when it is bytes
-                    line = line.decode('utf-8')
-                except Exception:
-                    pass
-                outfile.write(line)
+    atomic_write(name, [data])
+    FILE_CHANGES[origname] = True
+    EVENTS.emit('file', path=origname, written=name, changed=True)
 
     if not isRoot() and hinttocopy:
         printcolour("Important: ", MAGENTA)
@@ -1035,33 +2425,87 @@ def writeFile(name, content, showcontent=True, askforwrite=True,
     return True
 
 
-def get_token(force_user_input):
-    if len(sys.argv) == 1 or force_user_input:
-        import getpass
-        while True:
-            username = get_input("Username: ")
-            if username:
-                break
+def downloadFile(urlhandler, url, name, hinttocopy=True):
+    """
+    Downloads url to name without asking, see writeFile().
 
-        while True:
-            pwd = getpass.getpass("Credential (will not be echoed): ")
-            if pwd:
-                break
-        return username.strip(), pwd.strip()
-    elif len(sys.argv) == 2:
-        return sys.argv[-1], ""
+    The content is streamed to the file instead of being held in memory.
+    """
+    origname = name
+    if not isRoot():
+        name = os.path.join("/tmp", os.path.basename(name))
+
+    dirname = os.path.dirname(name)
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+
+    FILE_CHANGES[origname] = urlhandler.download(url, name)
+    EVENTS.emit('file', path=origname, written=name, changed=FILE_CHANGES[origname], url=url)
+
+    if not isRoot() and hinttocopy:
+        printcolour("Important: ", MAGENTA)
+        print()
+        print("Please review {0} and copy file to {1}".format(name, origname))
+
+    return True
+
+
+def print_file_changes():
+    """
+    Prints which files this run changed, package manager metadata only needs a refresh if one of them did.
+    """
+    changed = sorted(name for name, c in FILE_CHANGES.items() if c)
+    if changed:
+        OK("Changed files: {0}".format(", ".join(changed)))
+    elif FILE_CHANGES:
+        OK("All files up to date")
+
+
+def get_token(force_user_input):
+    if len(sys.argv) == 1 or force_user_input:
+        import getpass
+        while True:
+            username = get_input("Username: ")
+            if username:
+                break
+
+        while True:
+            pwd = getpass.getpass("Credential (will not be echoed): ")
+            if pwd:
+                break
+        return username.strip(), pwd.strip()
+    elif len(sys.argv) == 2:
+        return sys.argv[-1], ""
     return "", ""
 
 
 def err(e, string):
-    printcolour("ERR: ", RED)
-    print(string)
+    EVENTS.emit('error', code=e, message=string)
+    sys.stdout.write('{0}{1}\n'.format(colourise("ERR: ", RED), string))
     sys.exit(e)
 
 
+def env_number(name, default=None, convert=int):
+    """
+    Reads a numeric environment variable, ends the script if it is set to something else.
+
+    :param str name:
+    :param default: if the variable is not set or empty
+    :param convert: int or float
+    """
+    value = os.getenv(name)
+    if not value:
+        return default
+    try:
+        return convert(value)
+    except ValueError:
+        err(E_NEED_PARAMS, "Invalid {0}: {1} is not {2}".format(
+            name, value, "an integer" if convert is int else "a number"))
+
+
 def warn(string):
-    printcolour("W: ", MAGENTA)
-    print(string)
+    EVENTS.emit('warning', message=string)
+    sys.stdout.write('{0}{1}\n'.format(colourise("W: ", MAGENTA), string))
 
 
 def contactInfo(args, is_issue=True):
@@ -1125,12 +2569,14 @@ def isRoot():
     return os.getuid() == 0
 
 
-def getOptions(options, allow_new=False, what="contract"):
+def getOptions(options, allow_new=False, what="contract", all_keys=None):
     # dicts have no guaranteed order, so we use an array to keep track of the
     # keys
     lst = []
     new = 0
     e = -1  # set it in case len(options) == 0
+    # all_keys may hold more keys than listed, those can be entered as "#KEY"
+    hidden = len(all_keys) - len(options) if all_keys is not None else 0
 
     print("Will this node form a cluster with...\n")
     for e, k in enumerate(sorted(options)):
@@ -1145,13 +2591,20 @@ def getOptions(options, allow_new=False, what="contract"):
     if allow_new:
         printcolour("{0}) *Be first node of a new cluster*\n".format(e + 2), CYAN)
         new = 1
+    if hidden > 0:
+        print("{0} more {1}s are not listed, enter \"#<ID>\" to choose one of them".format(hidden, what))
     print("")
 
     while True:
         printcolour("--> ", CYAN)
         nr = get_input("Please enter a number in range and press return: ")
         try:
-            nr = int(nr.strip()) - 1  # we are back to CS/array notion
+            nr = nr.strip()
+            if hidden > 0 and nr.startswith('#'):
+                if int(nr[1:]) in all_keys:
+                    return int(nr[1:])
+                continue
+            nr = int(nr) - 1  # we are back to CS/array notion
             if nr >= 0 and nr < len(options) + new:
                 if allow_new and nr == e + 1:
                     return -1
@@ -1212,29 +2665,32 @@ def print_yum_dnf_info(family, dist):
         printcolour("Please make sure to use 'yum', and *not* 'dnf' on RHEL7-alikes\n", YELLOW)
 
 
+def keyring_info(family):
+    # returns keyring URL, file name and the install command, or Nones for unknown families
+    if family == "rhel" or family == "sles":
+        return GPG_KEYRING_RPM, GPG_KEYRING_RPM_NAME, "rpm --replacepkgs -i {f}"
+    elif family == "debian":
+        return GPG_KEYRING_DEB, GPG_KEYRING_DEB_NAME, "dpkg -i {f}"
+    return None, None, None
+
+
 def add_linbit_keyring(family, urlhandler, free_running=False):
     if (isRoot() and
        (free_running or askYesNo("Add LINBIT signing keyring?"))):
-        gpg_url, key_ring_name, addkey_cmd = None, None, None
-        if family == "rhel" or family == "sles":
-            gpg_url = GPG_KEYRING_RPM
-            key_ring_name = GPG_KEYRING_RPM_NAME
-            addkey_cmd = "rpm --replacepkgs -i {f}"
-        elif family == "debian":
-            gpg_url = GPG_KEYRING_DEB
-            key_ring_name = GPG_KEYRING_DEB_NAME
-            addkey_cmd = "dpkg -i {f}"
+        gpg_url, key_ring_name, addkey_cmd = keyring_info(family)
 
         if addkey_cmd and gpg_url and key_ring_name:
-            tmpf = os.path.join('/tmp', key_ring_name) 
-            urlretrieve(gpg_url, tmpf)
+            tmpf = os.path.join('/tmp', key_ring_name)
+            urlhandler.download(gpg_url, tmpf)
             addkey = addkey_cmd.format(f=tmpf)
             output = executeCommand(addkey)
             if (not free_running) and (output != ""):
                 print(output)
+            EVENTS.emit('keyring', url=gpg_url, installed=True)
     else:
         if not free_running:
             print("Download linbit-keyring.deb/rpm from {0} and install it manually!".format(GPG_KEYRING_BASE))
+        EVENTS.emit('keyring', url=keyring_info(family)[0], installed=False)
 
 
 def epilogue(family, dist, lbd_epilogue, urlhandler):
@@ -1249,16 +2705,38 @@ def epilogue(family, dist, lbd_epilogue, urlhandler):
 
 
 class APIAnswer(object):
+    """
+    Answer of my.linbit.com, "data" is decoded into a data_type record once.
+
+    A "data" that does not match data_type ends the script right away, instead of
+    failing with a KeyError wherever a missing field would be used first.
+    """
     def __init__(self, answer, data_type):
         self._answer = answer
         if not isinstance(answer.get('data', {}), dict):
             err(E_FAIL, "Expected object type in APIAnswer.data: " + str(answer["data"]))
         self._data_type = data_type
+        self._data = None
+        if 'data' in answer and not self.is_error():
+            self._data = self._decode()
 
-    def data(self):
-        if 'data' in self._answer:
+    def _decode(self):
+        try:
             return self._data_type(self._answer['data'])
-        return None
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            err(E_FAIL, "Unexpected {0} in APIAnswer.data: {1!r}".format(self._data_type.__name__, e))
+
+    def data(self):
+        if self._data is None and 'data' in self._answer:
+            self._data = self._decode()  # error answers are only decoded on demand
+        return self._data
+
+    def raw(self):
+        """
+        :return: the answer as it was received, e.g. to cache it
+        :rtype: Dict[str, Any]
+        """
+        return self._answer
 
     def error_msg(self):
         if self.is_error():
@@ -1281,176 +2759,1344 @@ class APIAnswer(object):
 
 
 class Response(object):
-    def __init__(self, response):
-        self._resp = response
+    """
+    Record of an API object, the fields are decoded once in __init__.
 
-    def __str__(self):
-        return str(self._resp)
+    Fields that are only shown to the user are optional, everything the registration depends on is required.
+    """
+    __slots__ = ()
+
+    def __repr__(self):
+        return "{0}({1})".format(type(self).__name__, ", ".join(
+            "{0}={1!r}".format(name, getattr(self, name)) for name in self.__slots__ if not name.startswith('_')))
+
+    __str__ = __repr__
 
 
 class LoginResponse(Response):
-    def __init__(self, response):
-        super(LoginResponse, self).__init__(response)
+    __slots__ = ('access_token',)
 
-    @property
-    def access_token(self):
-        return self._resp["access_token"]
+    def __init__(self, response):
+        self.access_token = response["access_token"]
 
 
 class CreateFromNodeHashResponse(Response):
-    def __init__(self, response):
-        super(CreateFromNodeHashResponse, self).__init__(response)
+    __slots__ = ('license_file_content',)
 
-    @property
-    def license_file_content(self):
-        return self._resp.get("license_file_content")
+    def __init__(self, response):
+        self.license_file_content = response.get("license_file_content")
 
 
 class IsNodeRegisteredResponse(Response):
+    """
+    cluster_id and nodehash of a registered node, both are None if the node is not registered.
+    """
+    __slots__ = ('cluster_id', 'nodehash')
+
     def __init__(self, response):
-        super(IsNodeRegisteredResponse, self).__init__(response)
+        self.cluster_id = response.get("cluster_id")
+        self.nodehash = response.get("nodehash")
 
     def is_registered(self):
-        return "cluster_id" in self._resp
+        return self.cluster_id is not None
 
-    @property
-    def cluster_id(self):
-        """
 
-        :return: cluster_id of registered node
-        :rtype: int
-        """
-        return self._resp["cluster_id"]
+class Repo(Response):
+    __slots__ = ('config',)
+
+    def __init__(self, response):
+        self.config = response["config"]
+
+
+class RegisteredNodeResponse(Response):
+    __slots__ = ('nodehash', 'cluster_id', 'repo_config', 'repos', '_configs')
+
+    def __init__(self, response):
+        self.nodehash = response["nodehash"]
+        self.cluster_id = response["cluster_id"]
+        self.repo_config = response.get("repo_config")
+        self.repos = dict((k, Repo(v)) for k, v in response["repos"].items())  # type: Dict[str, Repo]
+        self._configs = None
 
     @property
-    def nodehash(self):
+    def configs(self):
         """
-
-        :return: nodehash of registered node
-        :rtype: str
+        :return: repo name -> config line, as stored in NODE_REG_DATA
+        :rtype: Dict[str, str]
         """
-        return self._resp["nodehash"]
+        if self._configs is None:
+            self._configs = dict((k, v.config) for k, v in self.repos.items())
+        return self._configs
 
 
-class Repo(Response):
+class CreateClusterResponse(Response):
+    __slots__ = ('id',)
+
     def __init__(self, response):
-        super(Repo, self).__init__(response)
+        self.id = response["id"]
 
-    @property
-    def config(self):
-        return self._resp["config"]
 
+class Contract(Response):
+    __slots__ = ('id', 'kind_name', 'support_until')
 
-class RegisteredNodeResponse(Response):
     def __init__(self, response):
-        super(RegisteredNodeResponse, self).__init__(response)
+        self.id = response["id"]
+        self.kind_name = response.get("kind_name")
+        self.support_until = response.get("support_until")
 
-    @property
-    def nodehash(self):
-        return self._resp["nodehash"]
 
-    @property
-    def repo_config(self):
-        return self._resp["repo_config"]
+class ContractsResponse(Response):
+    __slots__ = ('list',)
 
-    @property
-    def repos(self):
-        """
-        Returns possible repos from registered node.
+    def __init__(self, response):
+        self.list = [Contract(x) for x in response["list"]]
 
-        :return:
-        :rtype: Dict[str, Repo]
-        """
-        reps = {}
-        for k, v in self._resp["repos"].items():
-            reps[k] = Repo(v)
-        return reps
 
-    @property
-    def cluster_id(self):
-        return self._resp["cluster_id"]
+class Node(Response):
+    __slots__ = ('hostname',)
 
+    def __init__(self, response):
+        self.hostname = response["hostname"]
+
+
+class Cluster(Response):
+    __slots__ = ('id', 'customer_id', 'nodes', '_hostnames')
 
-class CreateClusterResponse(Response):
     def __init__(self, response):
-        super(CreateClusterResponse, self).__init__(response)
+        self.id = response["id"]
+        self.customer_id = response.get("customer_id")
+        self.nodes = [Node(x) for x in response.get("nodes") or ()]
+        self._hostnames = None
 
     @property
-    def id(self):
-        return self._resp["id"]
+    def hostnames(self):
+        """
+        :rtype: List[str]
+        """
+        if self._hostnames is None:
+            self._hostnames = [x.hostname for x in self.nodes]
+        return self._hostnames
 
 
-class Contract(Response):
+class ClustersResponse(Response):
+    __slots__ = ('list',)
+
     def __init__(self, response):
-        super(Contract, self).__init__(response)
+        self.list = [Cluster(x) for x in response["list"]]
 
-    @property
-    def id(self):
-        return self._resp["id"]
 
-    @property
-    def kind_name(self):
-        return self._resp["kind_name"]
+class ClusterIndex(object):
+    """
+    Maps the node hostnames and hostname prefixes of a contract to cluster ids.
 
-    @property
-    def support_until(self):
-        return self._resp["support_until"]
+    The clusters are added page by page while they are fetched, only the ids, the index entries and the
+    last listed records are kept. Adding a node and every lookup are O(1), so placing a batch of nodes
+    does not scan all clusters for every node.
 
+    :param prefix_lengths: prefixes to index, see prefix()
+    :param int recent: number of the last listed clusters to keep, e.g. for the cluster question
+    """
+    _number_re = re.compile(r'[-_.]?[0-9]+$')
 
-class ContractsResponse(Response):
-    def __init__(self, response):
-        super(ContractsResponse, self).__init__(response)
+    def __init__(self, prefix_lengths=(None,), recent=CLUSTER_OPTIONS_MAX):
+        self.last = None
+        self.recent = []  # type: List[Cluster]
+        self._recent_max = recent
+        self._prefix_lengths = tuple(prefix_lengths)
+        self._ids = set()
+        self._by_hostname = {}
+        # (length, prefix) -> (nodes, cluster id) of the cluster with the most nodes of that prefix
+        self._by_prefix = {}
+        self._prefix_nodes = {}  # (length, prefix, cluster id) -> nodes
 
-    @property
-    def list(self):
-        return [Contract(x) for x in self._resp["list"]]
+    def __len__(self):
+        return len(self._ids)
 
+    def __contains__(self, cluster_id):
+        return cluster_id in self._ids
 
-class Node(Response):
-    def __init__(self, response):
-        super(Node, self).__init__(response)
+    @classmethod
+    def prefix(cls, hostname, length=None):
+        """
+        Prefix of the short hostname, by default without its trailing number ("db-node-03" -> "db-node").
 
-    @property
-    def hostname(self):
-        return self._resp["hostname"]
+        :param str hostname:
+        :param Optional[int] length: use the first length characters instead
+        :return: None if the hostname has no such prefix
+        :rtype: Optional[str]
+        """
+        short = hostname.split('.')[0].lower()
+        if length is not None:
+            return short[:length] if len(short) >= length else None
+        prefix = cls._number_re.sub('', short)
+        return prefix if prefix and prefix != short else None
 
+    def update(self, clusters):
+        """
+        :param Iterable[Cluster] clusters: clusters that are already indexed are skipped
+        :return: number of added clusters
+        :rtype: int
+        """
+        added = 0
+        for cluster in clusters:
+            if cluster.id in self._ids:
+                continue
+            for hostname in cluster.hostnames:
+                self.add_node(cluster.id, hostname)
+            self._ids.add(cluster.id)
+            self.last = cluster.id
+            self.recent.append(cluster)
+            added += 1
+        if len(self.recent) > self._recent_max:
+            del self.recent[:len(self.recent) - self._recent_max]
+        return added
+
+    def add_node(self, cluster_id, hostname):
+        """
+        Indexes a node, e.g. one that just got placed. An unknown cluster_id becomes the last cluster.
 
-class Cluster(Response):
-    def __init__(self, response):
-        super(Cluster, self).__init__(response)
+        :param int cluster_id:
+        :param str hostname:
+        """
+        if cluster_id not in self._ids:
+            self._ids.add(cluster_id)
+            self.last = cluster_id
+        self._by_hostname[hostname.lower()] = cluster_id
+        for length in self._prefix_lengths:
+            prefix = self.prefix(hostname, length)
+            if prefix is None:
+                continue
+            key = (length, prefix, cluster_id)
+            nodes = self._prefix_nodes.get(key, 0) + 1
+            self._prefix_nodes[key] = nodes
+            best = self._by_prefix.get((length, prefix))
+            # on a tie the cluster listed later wins, like LB_CLUSTER_ID=0 does
+            if best is None or nodes >= best[0]:
+                self._by_prefix[(length, prefix)] = (nodes, cluster_id)
+
+    def by_hostname(self, hostname):
+        """
+        :rtype: Optional[int]
+        """
+        return self._by_hostname.get(hostname.lower())
 
-    @property
-    def id(self):
-        return self._resp["id"]
+    def by_prefix(self, hostname, length=None):
+        """
+        :return: the cluster with the most nodes that share the prefix of hostname
+        :rtype: Optional[int]
+        """
+        best = self._by_prefix.get((length, self.prefix(hostname, length)))
+        return best[1] if best is not None else None
 
-    @property
-    def nodes(self):
-        return [Node(x) for x in self._resp["nodes"]]
 
-    @property
-    def customer_id(self):
-        return self._resp["customer_id"]
+class ClusterPlacement(object):
+    """
+    Chooses the cluster of a node that is not registered yet by rules, the first rule that matches wins.
 
+    "hostname" joins the cluster that already has a node of that name (e.g. a reinstalled node),
+    "prefix" the cluster with the most nodes that share the hostname prefix (see ClusterIndex.prefix()),
+    "prefix:N" does the same for the first N characters of the hostname,
+    "last" joins the last cluster of the contract and "new" creates a new cluster.
+    """
+    _rule_re = re.compile(r'^(hostname|prefix(?::([1-9][0-9]*))?|last|new)$')
 
-class ClustersResponse(Response):
-    def __init__(self, response):
-        super(ClustersResponse, self).__init__(response)
+    def __init__(self, rules):
+        """
+        :param List[str] rules: empty rules are ignored
+        :raises ValueError: for invalid rules
+        """
+        self._rules = []
+        for rule in rules:
+            rule = rule.strip()
+            if not rule:
+                continue
+            m = self._rule_re.match(rule)
+            if not m:
+                raise ValueError('invalid rule "{0}"'.format(rule))
+            self._rules.append((rule, rule.split(':')[0], int(m.group(2)) if m.group(2) else None))
 
     @property
-    def list(self):
-        return [Cluster(x) for x in self._resp["list"]]
+    def prefix_lengths(self):
+        """
+        :rtype: List[Optional[int]]
+        """
+        return [length for _, kind, length in self._rules if kind == 'prefix']
 
+    def index(self):
+        """
+        :return: an empty index with the prefixes the rules need
+        :rtype: ClusterIndex
+        """
+        return ClusterIndex(self.prefix_lengths)
 
-class UrllibHandler(object):
+    def place(self, index, hostname):
+        """
+        :param ClusterIndex index:
+        :param str hostname:
+        :return: (cluster id or -1 for a new cluster, the matching rule), (None, None) if no rule matched
+        :rtype: Tuple[Optional[int], Optional[str]]
+        """
+        for rule, kind, length in self._rules:
+            if kind == 'hostname':
+                cluster_id = index.by_hostname(hostname)
+            elif kind == 'prefix':
+                cluster_id = index.by_prefix(hostname, length)
+            elif kind == 'last':
+                cluster_id = index.last
+            else:
+                cluster_id = -1
+            if cluster_id is not None:
+                return cluster_id, rule
+        return None, None
+
+
+class Span(object):
+    """
+    Times a "with" block, the block can add transferred bytes and retries.
+    """
+    def __init__(self, profiler, name, kind):
+        self.name = name
+        self.kind = kind
+        self.bytes = 0
+        self.retries = 0
+        self.error = None
+        self.start = None
+        self.duration = None
+        self._profiler = profiler
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = time.time() - self.start
+        if exc_type is not None:
+            self.error = exc_type.__name__
+        self._profiler.record(self)
+        return False
+
+
+class NullSpan(object):
+    # used while profiling is disabled
+    bytes = 0
+    retries = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class Profiler(object):
+    """
+    Collects spans of the registration phases ("phase") and of every HTTP request ("http").
+    """
     def __init__(self):
-        pass
+        self.enabled = False
+        self.spans = []
+        self._jsonl = None
+        self._lock = threading.Lock()
+
+    def enable(self, jsonl_path=None):
+        """
+        :param Optional[str] jsonl_path: if set, every span is appended as JSON line to this file
+        """
+        self.enabled = True
+        if jsonl_path:
+            self._jsonl = open(jsonl_path, 'a')
+
+    def span(self, name, kind='phase'):
+        if not self.enabled:
+            return NullSpan()
+        return Span(self, name, kind)
+
+    def record(self, span):
+        with self._lock:
+            if span.kind == 'phase':
+                # a phase accounts for the requests started while it was running
+                end = span.start + span.duration
+                for other in self.spans:
+                    if other.kind == 'http' and span.start <= other.start <= end:
+                        span.bytes += other.bytes
+                        span.retries += other.retries
+            self.spans.append(span)
+            if self._jsonl is not None:
+                self._jsonl.write(json.dumps({
+                    'kind': span.kind,
+                    'name': span.name,
+                    'start': span.start,
+                    'duration': span.duration,
+                    'bytes': span.bytes,
+                    'retries': span.retries,
+                    'error': span.error,
+                }) + '\n')
+                self._jsonl.flush()
+
+    def report(self, stream=sys.stderr):
+        # one line per (kind, name) in order of first appearance
+        rows = []
+        summary = {}
+        for span in self.spans:
+            key = (span.kind, span.name)
+            if key not in summary:
+                summary[key] = {'count': 0, 'total': 0.0, 'max': 0.0, 'bytes': 0, 'retries': 0, 'errors': 0}
+                rows.append(key)
+            row = summary[key]
+            row['count'] += 1
+            row['total'] += span.duration
+            row['max'] = max(row['max'], span.duration)
+            row['bytes'] += span.bytes
+            row['retries'] += span.retries
+            row['errors'] += 1 if span.error else 0
+
+        fmt = "{0:<6} {1:<50} {2:>5} {3:>10} {4:>10} {5:>10} {6:>7} {7:>6}\n"
+        stream.write(fmt.format('kind', 'name', 'count', 'total ms', 'max ms', 'bytes', 'retries', 'errors'))
+        for key in rows:
+            row = summary[key]
+            stream.write(fmt.format(key[0], key[1][:50], row['count'], '{0:.1f}'.format(row['total'] * 1000),
+                                    '{0:.1f}'.format(row['max'] * 1000), row['bytes'], row['retries'],
+                                    row['errors']))
+
+
+PROFILER = Profiler()
+
+
+class EventLog(object):
+    """
+    Writes the results of the registration phases as JSON lines (--json).
+
+    Every record is an object with at least "event" and "time". The last record is the "summary" of the run,
+    it repeats the last record of every phase, so consumers that only need the outcome can read a single line.
+    """
+    # events that are part of the summary
+    PHASES = ('host', 'version_check', 'login', 'contract', 'cluster', 'registration', 'license', 'repo_config',
+              'keyring', 'hints', 'fleet', 'error')
+
+    def __init__(self):
+        self.enabled = False
+        self.counts = {}
+        self.results = {}
+        self._stream = None
+        self._start = time.time()
+        self._lock = threading.Lock()
+
+    def enable(self, stream):
+        self.enabled = True
+        self._stream = stream
+
+    def emit(self, event, **fields):
+        if not self.enabled:
+            return
+        record = {'event': event, 'time': time.time()}
+        record.update(fields)
+        line = json.dumps(record, sort_keys=True) + '\n'
+        with self._lock:
+            self.counts[event] = self.counts.get(event, 0) + 1
+            if event in self.PHASES:
+                self.results[event] = fields
+            self._stream.write(line)
+
+    def finish(self, exit_code):
+        """
+        Writes the summary, nothing gets written afterwards.
+
+        :param int exit_code:
+        """
+        if not self.enabled:
+            return
+        self.emit('summary',
+                  status='success' if exit_code == E_SUCC else 'failure',
+                  exit_code=exit_code,
+                  duration=time.time() - self._start,
+                  events=dict(self.counts),
+                  results=dict(self.results),
+                  changed_files=sorted(name for name, c in FILE_CHANGES.items() if c),
+                  unchanged_files=sorted(name for name, c in FILE_CHANGES.items() if not c))
+        self._stream.flush()
+        self.enabled = False
+
+
+EVENTS = EventLog()
+
+
+class HTTPHeaders(dict):
+    # response headers, keys are stored lower case
+    def get(self, key, default=None):
+        return super(HTTPHeaders, self).get(key.lower(), default)
+
+
+class PooledResponse(object):
+    """
+    Fully read response of a pooled request, behaves like the file object returned by urlopen().
+    """
+    def __init__(self, url, status, headers, body, reason=''):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self._fp = io.BytesIO(body)
+
+    def read(self, size=-1):
+        return self._fp.read(size)
+
+    def readline(self):
+        return self._fp.readline()
+
+    def __iter__(self):
+        return iter(self._fp)
+
+    def getcode(self):
+        return self.status
+
+    def info(self):
+        return self.headers
+
+    def close(self):
+        self._fp.close()
+
+
+class StreamedResponse(object):
+    """
+    Response of a pooled request whose body is read from the connection on demand.
+
+    The connection goes back to the pool once the body was read completely, close() drops it before that.
+    """
+    def __init__(self, url, resp, headers, gzipped, span, release):
+        self.url = url
+        self.status = resp.status
+        self.reason = resp.reason
+        self.headers = headers
+        self._resp = resp
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+        self._span = span
+        self._release = release
+        self._buf = b''
+
+    def _finish(self, reusable):
+        release, self._release = self._release, None
+        if release is not None:
+            release(reusable)
+
+    def _fill(self):
+        # reads the next chunk into the buffer, False at the end of the body
+        if self._release is None:
+            return False
+        try:
+            data = self._resp.read(DOWNLOAD_CHUNK)
+        except (httplib.HTTPException, socket.error) as e:
+            self._finish(False)
+            raise urllib_error.URLError(e)
+        if not data:
+            if self._decompressor is not None:
+                self._buf += self._decompressor.flush()
+            self._finish(True)
+            return True
+        self._span.bytes += len(data)
+        if self._decompressor is not None:
+            data = self._decompressor.decompress(data)
+        self._buf += data
+        return True
+
+    def read(self, size=-1):
+        while (size < 0 or len(self._buf) < size) and self._fill():
+            pass
+        if size < 0:
+            size = len(self._buf)
+        data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+    def getcode(self):
+        return self.status
+
+    def info(self):
+        return self.headers
+
+    def close(self):
+        self._buf = b''
+        self._finish(False)
+
+
+class RetryPolicy(object):
+    """
+    Decides if and when a failed request is sent again.
+
+    Connection errors and the status codes in RETRY_STATUS are retried with exponential backoff and full jitter,
+    a Retry-After header of the server is honored (up to max_backoff).
+    """
+    RETRY_STATUS = (429, 502, 503, 504)
+
+    def __init__(self, attempts=HTTP_RETRIES, backoff=0.5, max_backoff=30.0):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def is_transient(self, e):
+        if isinstance(e, urllib_error.HTTPError):
+            return e.code in self.RETRY_STATUS
+        return isinstance(e.reason, (socket.error, httplib.HTTPException))
+
+    def delay(self, attempt, retry_after=None):
+        """
+        :param int attempt: number of the failed attempt, starting at 0
+        :param Optional[str] retry_after: value of the Retry-After header
+        :return: seconds to wait before the next attempt
+        :rtype: float
+        """
+        if retry_after:
+            try:
+                return min(self.max_backoff, max(0.0, float(retry_after)))
+            except ValueError:
+                from email.utils import parsedate_tz, mktime_tz
+                date = parsedate_tz(retry_after)
+                if date is not None:
+                    return min(self.max_backoff, max(0.0, mktime_tz(date) - time.time()))
+        return random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt)))
+
+
+class CircuitBreaker(object):
+    """
+    Fails requests to a host fast after it failed threshold times in a row.
+
+    After cooldown seconds a single trial request is let through, the others still fail fast until it
+    ends. If the trial succeeds the circuit closes, if it fails the circuit opens again.
+    """
+    def __init__(self, threshold=5, cooldown=30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._failures = {}
+        self._opened = {}
+        self._trials = set()
+        self._lock = threading.Lock()
+
+    def check(self, host):
+        """
+        :return: whether the request is the trial of an open circuit, its outcome has to be reported with
+                success(), failure() or release()
+        :rtype: bool
+        """
+        with self._lock:
+            opened = self._opened.get(host)
+            if opened is None:
+                return False
+            if time.time() - opened < self.cooldown:
+                raise urllib_error.URLError('{0} is unavailable, not trying again for {1:.0f}s'.format(
+                    host, self.cooldown - (time.time() - opened)))
+            if host in self._trials:
+                raise urllib_error.URLError('{0} is unavailable, waiting for a trial request'.format(host))
+            self._trials.add(host)
+            return True
+
+    def success(self, host):
+        with self._lock:
+            self._failures.pop(host, None)
+            self._opened.pop(host, None)
+            self._trials.discard(host)
+
+    def failure(self, host):
+        with self._lock:
+            failures = self._failures.get(host, 0) + 1
+            self._failures[host] = failures
+            if failures >= self.threshold:
+                self._opened[host] = time.time()
+            self._trials.discard(host)
+
+    def release(self, host):
+        """
+        Ends a trial request whose error says nothing about the host, the next request is the trial.
+        """
+        with self._lock:
+            self._trials.discard(host)
+
+
+class HTTPConnectionPool(object):
+    """
+    Keeps HTTP/1.1 connections alive per (scheme, host, port) and reuses them for later requests.
+
+    Errors are raised as HTTPError/URLError, so callers can handle them exactly like the ones of urlopen().
+    Requests that have to go through a proxy are handed to urlopen().
+    """
+    MAX_REDIRECTS = 5
+
+    def __init__(self, gzip=True, max_idle=4, retry_policy=None, breaker=None):
+        self._gzip = gzip
+        self._max_idle = max_idle
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self._idle = {}
+        self._lock = threading.Lock()
+        self.stats = {"new": 0, "reused": 0}
+
+    def _get(self, key, timeout, reuse=True):
+        if timeout is None:
+            timeout = socket.getdefaulttimeout()
+        with self._lock:
+            idle = self._idle.get(key) if reuse else None
+            if idle:
+                self.stats["reused"] += 1
+                conn = idle.pop()
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+            self.stats["new"] += 1
+
+        scheme, host, port = key
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, port, timeout=timeout), False
+        return httplib.HTTPConnection(host, port, timeout=timeout), False
+
+    def _put(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self._max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for conn in idle:
+                    conn.close()
+            self._idle = {}
+
+    def request(self, method, url, body=None, headers=None, timeout=None, retry=None, stream=False):
+        """
+        Sends a request and follows redirects.
+
+        :param str method:
+        :param str url:
+        :param Optional[bytes] body:
+        :param Optional[Dict[str, str]] headers:
+        :param Optional[float] timeout: socket timeout in seconds, None for the global default
+        :param Optional[bool] retry: the request may be sent more than once, i.e. transient errors are retried and
+                idle connections are reused. By default only GET and HEAD requests are
+        :param bool stream: read the body of a successful response on demand instead of at once
+        :return: the final response, fully read unless stream is set
+        :rtype: PooledResponse or StreamedResponse
+        """
+        if retry is None:
+            retry = method in ('GET', 'HEAD')
+        parts = urlsplit(url)
+        host = parts.netloc
+        policy = self.retry_policy
+        with PROFILER.span('{0} {1}{2}'.format(method, parts.hostname, re.sub(r'/\d+(?=/|$)', '/{id}', parts.path)),
+                           'http') as span:
+            attempt = 0
+            while True:
+                trial = self.breaker.check(host)
+                retry_after = None
+                try:
+                    resp = self._request(method, url, body, headers, timeout, span, stream, retry)
+                    self.breaker.success(host)
+                    return resp
+                except urllib_error.URLError as e:
+                    if not policy.is_transient(e):
+                        if isinstance(e, urllib_error.HTTPError):  # the server answered, so it is up
+                            self.breaker.success(host)
+                        elif trial:
+                            self.breaker.release(host)
+                        raise
+                    if isinstance(e, urllib_error.HTTPError):
+                        retry_after = e.info().get('Retry-After')
+                    self.breaker.failure(host)
+                    if not retry or attempt + 1 >= policy.attempts:
+                        raise
+                except Exception:
+                    if trial:
+                        self.breaker.release(host)
+                    raise
+                span.retries += 1
+                time.sleep(policy.delay(attempt, retry_after))
+                attempt += 1
+
+    def _request(self, method, url, body, headers, timeout, span, stream=False, retry=True):
+        hdrs = dict(headers or {})
+        # a range of a compressed body is a truncated gzip stream, so ranges are always requested uncompressed
+        if self._gzip and not set(h.lower() for h in hdrs) & set(['accept-encoding', 'range']):
+            hdrs['Accept-Encoding'] = 'gzip'
+
+        for _ in range(self.MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            if parts.scheme not in ('http', 'https'):
+                raise urllib_error.URLError('unsupported URL scheme: ' + url)
+            if parts.scheme in urllib_request.getproxies() and not urllib_request.proxy_bypass(parts.hostname):
+                return urllib_request.urlopen(urllib_request.Request(url, data=body, headers=headers or {}),
+                                              timeout=timeout)
+
+            resp = self._request_once(method, parts, body, hdrs, timeout, span, stream, retry)
+
+            location = resp.headers.get('location')
+            if resp.status in (301, 302, 303, 307, 308) and location:
+                url = urljoin(url, location)
+                if resp.status == 303 or (resp.status in (301, 302) and method == 'POST'):
+                    method, body = 'GET', None
+                continue
+            if resp.status >= 400:
+                raise urllib_error.HTTPError(url, resp.status, resp.reason, resp.headers, io.BytesIO(resp.read()))
+            return resp
+
+        raise urllib_error.URLError('too many redirects: ' + url)
+
+    def _request_once(self, method, parts, body, headers, timeout, span, stream=False, retry=True):
+        """
+        :param bool retry: the request may be sent twice. Requests that may not are never sent on an idle
+                connection, a server that closed it could already have processed them when we notice.
+        """
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        while True:
+            conn, reused = self._get(key, timeout, reuse=retry)
+            try:
+                conn.request(method, path, body, headers)
+            except (httplib.HTTPException, socket.error) as e:
+                conn.close()
+                if reused:  # the server closed the idle connection before the request, try the next one
+                    span.retries += 1
+                    continue
+                raise urllib_error.URLError(e)
+            try:
+                resp = conn.getresponse()
+                streamed = stream and 200 <= resp.status < 300
+                data = b'' if streamed else resp.read()
+            except httplib.BadStatusLine as e:
+                # closed without a byte of response (RemoteDisconnected on python3), the usual end of an idle connection
+                conn.close()
+                if reused:
+                    span.retries += 1
+                    continue
+                raise urllib_error.URLError(e)
+            except (httplib.HTTPException, socket.error) as e:
+                conn.close()
+                raise urllib_error.URLError(e)
+            break
+        span.bytes += len(body or b'') + len(data)
+
+        resp_headers = HTTPHeaders((k.lower(), v) for k, v in resp.getheaders())
+        gzipped = resp_headers.get('content-encoding') == 'gzip'
+        if streamed:
+            def release(reusable):
+                if reusable and not resp.will_close:
+                    self._put(key, conn)
+                else:
+                    conn.close()
+            return StreamedResponse(parts.geturl(), resp, resp_headers, gzipped, span, release)
+
+        if resp.will_close:
+            conn.close()
+        else:
+            self._put(key, conn)
+
+        if gzipped:
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        return PooledResponse(parts.geturl(), resp.status, resp_headers, data, resp.reason)
+
+
+class BackgroundTask(object):
+    """
+    Runs func(*args, **kwargs) in a daemon thread.
+
+    result() waits for the call to finish and returns its return value or re-raises its exception,
+    this includes the SystemExit of err(), so errors still end the script in the main thread.
+    """
+    def __init__(self, func, *args, **kwargs):
+        self._result = None
+        self._exc = None
+        self._done = threading.Event()
+
+        def run():
+            try:
+                self._result = func(*args, **kwargs)
+            except BaseException as e:
+                self._exc = e
+            self._done.set()
+
+        t = threading.Thread(target=run)
+        t.daemon = True
+        t.start()
+
+    def result(self):
+        # wait with a timeout, otherwise python2 would not deliver KeyboardInterrupt
+        while not self._done.is_set():
+            self._done.wait(0.1)
+        if self._exc is not None:
+            raise self._exc
+        return self._result
+
+
+class DownloadCache(object):
+    """
+    Content addressed cache for downloaded artifacts.
+
+    Objects are stored by their sha256 and verified on every read, index.json maps an URL to its object
+    and to the ETag/Last-Modified validators of the response. The least recently used entries are evicted
+    when the objects grow larger than max_size.
+    """
+    def __init__(self, path, max_size=CACHE_MAX_SIZE):
+        self._path = path
+        self._objects = os.path.join(path, 'objects')
+        self._index_path = os.path.join(path, 'index.json')
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._index = None
+
+    @classmethod
+    def open(cls, path, max_size=CACHE_MAX_SIZE):
+        """
+        :return: the cache, or None if path is empty or not writable
+        :rtype: Optional[DownloadCache]
+        """
+        if not path:
+            return None
+        try:
+            objects = os.path.join(path, 'objects')
+            if not os.path.isdir(objects):
+                os.makedirs(objects, 0o700)
+        except OSError:
+            return None
+        if not os.access(objects, os.W_OK):
+            return None
+        return cls(path, max_size)
+
+    def load_state(self, name):
+        """
+        :return: the JSON document stored via save_state(), or None
+        """
+        try:
+            with open(os.path.join(self._path, name + '.json')) as infile:
+                return json.load(infile)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def save_state(self, name, data):
+        try:
+            fd, tmp = tempfile.mkstemp(dir=self._path)
+            with os.fdopen(fd, 'w') as outfile:
+                json.dump(data, outfile)
+            os.rename(tmp, os.path.join(self._path, name + '.json'))
+        except (IOError, OSError):
+            pass
+
+    def _load(self):
+        if self._index is None:
+            try:
+                with open(self._index_path) as infile:
+                    self._index = json.load(infile)
+            except (IOError, OSError, ValueError):
+                self._index = {}
+        return self._index
+
+    def _save(self):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self._index_path))
+        with os.fdopen(fd, 'w') as outfile:
+            json.dump(self._index, outfile)
+        os.rename(tmp, self._index_path)
+
+    def _object_path(self, digest):
+        return os.path.join(self._objects, digest)
+
+    def get(self, url):
+        """
+        :return: the index entry and the path of the verified content, or (None, None)
+        :rtype: Tuple[Optional[Dict[str, Any]], Optional[str]]
+        """
+        with self._lock:
+            entry = self._load().get(url)
+            if entry is None:
+                return None, None
+            path = self._object_path(entry['sha256'])
+            try:
+                digest = file_sha256(path)
+            except (IOError, OSError):
+                digest = None
+            if digest != entry['sha256']:
+                del self._index[url]
+                return None, None
+            return entry, path
+
+    def spool(self):
+        """
+        Creates a temporary file for put().
+
+        :return: file descriptor and path, or (None, None)
+        :rtype: Tuple[Optional[int], Optional[str]]
+        """
+        try:
+            return tempfile.mkstemp(dir=self._objects)
+        except OSError:
+            return None, None
+
+    def put(self, url, tmp, digest, headers):
+        """
+        Moves the spool() file tmp into the cache as the content of url.
+
+        headers provide the ETag/Last-Modified validators.
+
+        :param str digest: hex sha256 of the content
+        :return: the path of the cached content, None if it was not cached and tmp still exists
+        :rtype: Optional[str]
+        """
+        path = self._object_path(digest)
+        with self._lock:
+            try:
+                size = os.path.getsize(tmp)
+                if size > self._max_size:
+                    return None
+                os.rename(tmp, path)
+                self._load()[url] = {
+                    'sha256': digest,
+                    'size': size,
+                    'etag': headers.get('ETag'),
+                    'last_modified': headers.get('Last-Modified'),
+                    'used': time.time(),
+                }
+                self._evict(keep=url)
+                self._save()
+                return path
+            except (IOError, OSError):
+                # the cache is an optimization, never fail because of it
+                return path if not os.path.exists(tmp) else None
+
+    def touch(self, url):
+        with self._lock:
+            entry = self._load().get(url)
+            if entry is not None:
+                entry['used'] = time.time()
+                try:
+                    self._save()
+                except (IOError, OSError):
+                    pass
+
+    def _evict(self, keep=None):
+        index = self._index
+        sizes = {}
+        for entry in index.values():
+            sizes[entry['sha256']] = entry['size']
+        total = sum(sizes.values())
+
+        for url in sorted(index, key=lambda u: index[u]['used']):
+            if total <= self._max_size:
+                break
+            if url == keep:
+                continue
+            digest = index.pop(url)['sha256']
+            if digest not in [e['sha256'] for e in index.values()]:
+                total -= sizes[digest]
+                try:
+                    os.remove(self._object_path(digest))
+                except OSError:
+                    pass
+
+
+class TokenCache(object):
+    """
+    Keeps my.linbit.com access tokens between runs, per API base and user.
+
+    The file is only accessible by root. A token is used until shortly before the expiry in its "exp" claim,
+    tokens without a readable expiry are not cached. Every token is stored with a salted hash of the password
+    it was issued for and only handed out for that password, a wrong password still fails the login.
+    The hash is PBKDF2-HMAC-SHA256, pythons without hashlib.pbkdf2_hmac() (before 2.7.8) store a single
+    HMAC-SHA256 instead.
+    """
+    EXPIRY_MARGIN = 60
+    PBKDF2_ITERATIONS = 100000
+
+    def __init__(self, path=TOKEN_CACHE):
+        self._path = path
+        self._lock = threading.Lock()
+
+    @classmethod
+    def open(cls, path=TOKEN_CACHE):
+        """
+        :return: the cache, or None if we are not root
+        :rtype: Optional[TokenCache]
+        """
+        if not isRoot():
+            return None
+        return cls(path)
+
+    @staticmethod
+    def expiry(token):
+        """
+        :return: the "exp" claim of a JWT, None if it can not be decoded
+        :rtype: Optional[float]
+        """
+        try:
+            payload = token.split('.')[1]
+            payload += '=' * (-len(payload) % 4)
+            return float(json.loads(base64.urlsafe_b64decode(payload.encode('ascii')).decode('utf-8'))['exp'])
+        except Exception:
+            return None
+
+    def _load(self):
+        try:
+            with open(self._path) as infile:
+                return json.load(infile)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _save(self, tokens):
+        dirname = os.path.dirname(self._path)
+        try:
+            if not os.path.exists(dirname):
+                os.makedirs(dirname, 0o700)
+            else:
+                os.chmod(dirname, 0o700)  # writeFile() creates it with the default mode
+            fd, tmp = tempfile.mkstemp(dir=dirname)  # mode 0600
+            with os.fdopen(fd, 'w') as outfile:
+                json.dump(tokens, outfile)
+            os.rename(tmp, self._path)
+        except (IOError, OSError):
+            pass
+
+    @staticmethod
+    def _key(username):
+        return MYLINBIT + ' ' + username
+
+    @staticmethod
+    def _hash(salt, password, iterations):
+        """
+        :param int iterations: of PBKDF2, 0 for a single HMAC
+        :rtype: str
+        """
+        salt, password = salt.encode('ascii'), password.encode('utf-8')
+        if iterations:
+            digest = hashlib.pbkdf2_hmac('sha256', password, salt, iterations)
+        else:
+            digest = hmac.new(salt, password, hashlib.sha256).digest()
+        return base64.b16encode(digest).decode('ascii')
+
+    def get(self, username, password):
+        """
+        :return: a token that is still valid and was issued for password, or None
+        :rtype: Optional[str]
+        """
+        with self._lock:
+            entry = self._load().get(self._key(username))
+        if not entry or entry['exp'] - self.EXPIRY_MARGIN <= time.time():
+            return None
+        iterations = entry.get('iterations')  # None for entries of older versions
+        if iterations is None or (iterations and not hasattr(hashlib, 'pbkdf2_hmac')):
+            return None
+        if not getattr(hmac, 'compare_digest', operator.eq)(self._hash(entry['salt'], password, iterations),
+                                                             entry['password']):
+            return None
+        return entry['token']
+
+    def put(self, username, password, token):
+        exp = self.expiry(token)
+        if exp is None:
+            return
+        salt = base64.b16encode(os.urandom(16)).decode('ascii')
+        iterations = self.PBKDF2_ITERATIONS if hasattr(hashlib, 'pbkdf2_hmac') else 0
+        digest = self._hash(salt, password, iterations)
+        with self._lock:
+            tokens = self._load()
+            now = time.time()
+            for k in [k for k in tokens if tokens[k]['exp'] < now]:
+                del tokens[k]
+            tokens[self._key(username)] = {'token': token, 'exp': exp, 'salt': salt, 'iterations': iterations,
+                                           'password': digest}
+            self._save(tokens)
+
+    def invalidate(self, username):
+        with self._lock:
+            tokens = self._load()
+            if tokens.pop(self._key(username), None) is not None:
+                self._save(tokens)
+
+
+class MetadataCache(object):
+    """
+    Keeps the contract and cluster lists of my.linbit.com between runs, per API base and user.
+
+    The file is only accessible by root and read once per run, entries are used for ttl seconds.
+    The clusters of a contract are dropped as soon as a cluster gets created or a node registered in it.
+    """
+    def __init__(self, path=METADATA_CACHE, ttl=METADATA_TTL):
+        self._path = path
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = None
+
+    @classmethod
+    def open(cls, path=METADATA_CACHE, ttl=METADATA_TTL):
+        """
+        :return: the cache, or None if we are not root or ttl is 0
+        :rtype: Optional[MetadataCache]
+        """
+        if ttl <= 0 or not isRoot():
+            return None
+        return cls(path, ttl)
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                with open(self._path) as infile:
+                    self._entries = json.load(infile)
+            except (IOError, OSError, ValueError):
+                self._entries = {}
+            if not isinstance(self._entries, dict):
+                self._entries = {}
+        return self._entries
+
+    def _save(self):
+        now = time.time()
+        entries = dict((k, v) for k, v in self._entries.items()
+                       if isinstance(v, dict) and 0 <= now - v.get('time', 0) < self._ttl)
+        dirname = os.path.dirname(self._path)
+        try:
+            if not os.path.exists(dirname):
+                os.makedirs(dirname, 0o700)
+            else:
+                os.chmod(dirname, 0o700)  # writeFile() creates it with the default mode
+            fd, tmp = tempfile.mkstemp(dir=dirname)  # mode 0600
+            with os.fdopen(fd, 'w') as outfile:
+                json.dump(entries, outfile)
+            os.rename(tmp, self._path)
+        except (IOError, OSError):
+            pass
 
     @staticmethod
-    def post_login_request(headers, username, password):
+    def _key(username, what, contract_id=None):
+        key = [MYLINBIT, username, what]
+        if contract_id is not None:
+            key.append(str(contract_id))
+        return ' '.join(key)
+
+    def get(self, username, what, contract_id=None):
+        """
+        :param str username:
+        :param str what: "contracts", or "clusters" of contract_id
+        :param Optional[int] contract_id:
+        :return: the cached list, None if there is none or it is older than ttl
+        :rtype: Optional[List[Dict[str, Any]]]
+        """
+        with self._lock:
+            entry = self._load().get(self._key(username, what, contract_id))
+        if isinstance(entry, dict) and 0 <= time.time() - entry.get('time', 0) < self._ttl:
+            return entry.get('list')
+        return None
+
+    def put(self, username, what, lst, contract_id=None):
+        with self._lock:
+            self._load()[self._key(username, what, contract_id)] = {'time': time.time(), 'list': lst}
+            self._save()
+
+    def invalidate(self, username, what, contract_id=None):
+        with self._lock:
+            if self._load().pop(self._key(username, what, contract_id), None) is not None:
+                self._save()
+
+
+class UrllibHandler(object):
+    def __init__(self, pool=None, cache=None, cluster_page_size=CLUSTER_PAGE_SIZE, metadata=None):
+        self._pool = pool if pool is not None else HTTPConnectionPool()
+        self._cache = cache
+        self._cluster_page_size = cluster_page_size
+        self._metadata = metadata
+        self._prefetched = {}
+        self._credentials = None
+        self._login_lock = threading.Lock()
+
+    def _urlopen(self, url, data=None, headers=None, timeout=None, method=None, retry=None, stream=False):
+        if method is None:
+            method = 'GET' if data is None else 'POST'
+        try:
+            return self._pool.request(method, url, body=data, headers=headers, timeout=timeout, retry=retry,
+                                      stream=stream)
+        except urllib_error.HTTPError as e:
+            # the (cached) token expired or got revoked, log in again and send the request once more
+            if e.code != 401 or url == AUTH_URL or self._credentials is None or 'Authorization' not in headers:
+                raise
+            if not self._relogin(headers, headers['Authorization']):
+                raise
+            return self._pool.request(method, url, body=data, headers=headers, timeout=timeout, retry=retry,
+                                      stream=stream)
+
+    def _relogin(self, headers, failed_auth):
+        username, password, token_cache = self._credentials
+        with self._login_lock:
+            if headers['Authorization'] != failed_auth:  # another thread already did it
+                return True
+            if token_cache is not None:
+                token_cache.invalidate(username)
+            login_headers = dict(headers)
+            del login_headers['Authorization']
+            status, jwt_token = self.post_login_request(login_headers, username, password)
+            if status != 200:
+                return False
+            if token_cache is not None:
+                token_cache.put(username, password, jwt_token)
+            headers['Authorization'] = "Bearer " + jwt_token
+            return True
+
+    def login(self, headers, username, password, token_cache=None):
+        """
+        Sets the Authorization header, using a cached token if possible.
+
+        Requests that fail with 401 later log in again with the same credentials
+        and update the Authorization header of their headers.
+
+        :param Dict[str, str] headers: headers of the following requests, updated in place
+        :param str username:
+        :param str password:
+        :param Optional[TokenCache] token_cache:
+        :return: 200 or 401 if the credentials are wrong
+        :rtype: int
+        """
+        jwt_token = token_cache.get(username, password) if token_cache is not None else None
+        if jwt_token is None:
+            status, jwt_token = self.post_login_request(headers, username, password)
+            if status != 200:
+                return status
+            if token_cache is not None:
+                token_cache.put(username, password, jwt_token)
+        headers['Authorization'] = "Bearer " + jwt_token
+        self._credentials = (username, password, token_cache)
+        return 200
+
+    @property
+    def cache(self):
+        return self._cache
+
+    def _cached(self, what, contract_id=None):
+        # only after login(), so the entries of a user are never used without the credentials of that user
+        if self._metadata is None or self._credentials is None:
+            return None
+        return self._metadata.get(self._credentials[0], what, contract_id)
+
+    def _store(self, what, lst, contract_id=None):
+        if self._metadata is not None and self._credentials is not None:
+            self._metadata.put(self._credentials[0], what, lst, contract_id)
+
+    def _invalidate(self, what, contract_id=None):
+        if self._metadata is not None and self._credentials is not None:
+            self._metadata.invalidate(self._credentials[0], what, contract_id)
+
+    def get_range(self, url, start, end):
+        """
+        Requests the bytes start to end (inclusive) of url, bypassing the download cache.
+
+        Servers are free to ignore the range, check getcode() for 206.
+        """
+        return self._urlopen(url, headers={'Range': 'bytes={0}-{1}'.format(start, end), 'Accept-Encoding': 'identity'})
+
+    def connection_stats(self):
+        """
+        :return: number of "new" and "reused" connections of this handler
+        :rtype: Dict[str, int]
+        """
+        return dict(self._pool.stats)
+
+    def post_login_request(self, headers, username, password):
         payload = {"user": username, "pass": password}
-        r = Request(AUTH_URL, data=json.dumps(payload).encode('utf-8'), headers=headers)
         try:
-            f = urlopen(r)
+            f = self._urlopen(AUTH_URL, data=json.dumps(payload).encode('utf-8'), headers=headers, retry=True)
 
             ret = f.read()
             ret = json.loads(ret)
@@ -1459,38 +4105,123 @@ class UrllibHandler(object):
             if answer.is_error():
                 err(E_FAIL, "API returned error: " + answer.error_msg())
             return 200, answer.data().access_token
-        except URLError as e:
+        except urllib_error.URLError as e:
             if str(e).startswith("HTTP Error 401"):
                 return 401, None
             else:
                 err(E_FAIL, "urllib returned: " + str(e))
 
-    @staticmethod
-    def get_request(path, headers, answer_data_type):
+    def get_request(self, path, headers, answer_data_type, fail=True):
         """
         Does a simple GET request to the given path.
 
         :param str path:
         :param Dict[str, str] headers:
         :param answer_data_type: data type in APIAnswer object
+        :param bool fail: if False, return None instead of exiting on HTTP errors
         :return: ApiAnswer for successful HTTP requests, otherwise exits the script
         :rtype: APIAnswer
         """
-        r = Request(path, headers=headers)
         try:
-            f = urlopen(r)
+            f = self._urlopen(path, headers=headers)
             ret = f.read()
             ret = json.loads(ret)
 
             return APIAnswer(ret, answer_data_type)
-        except URLError as e:
+        except urllib_error.URLError as e:
+            if not fail:
+                return None
             if str(e).startswith("HTTP Error 401"):
                 err(E_FAIL, "unauthorized")
             else:
                 err(E_FAIL, "urllib returned: " + str(e))
 
-    @staticmethod
-    def post_license_from_nodehash(headers, nodehash, mac_addresses, hostname=None, contract_id=None, cluster_id=None):
+    def get_contracts(self, headers):
+        """
+        Gets the contracts of the logged in user, from the metadata cache if possible.
+
+        :param Dict[str, str] headers:
+        :return: the contracts, exits the script on errors
+        :rtype: ContractsResponse
+        """
+        cached = self._cached('contracts')
+        if cached is not None:
+            try:
+                return ContractsResponse({'list': cached})
+            except (KeyError, TypeError, ValueError, AttributeError):
+                pass
+        answer = self.get_request(CONTRACT_URL, headers, ContractsResponse)
+        if answer.is_error():
+            err(E_FAIL, answer.error_msg())
+        self._store('contracts', answer.raw()['data']['list'])
+        return answer.data()
+
+    def get_cluster_index(self, headers, contract_id, index, fail=True):
+        """
+        Fetches the clusters of a contract page by page into index.
+
+        Every page is decoded and indexed before the next one is requested, so the records of large contracts
+        are never all in memory at once. If the API rejects offset/limit with 400, the whole list is requested
+        instead, if it ignores them, the first answer already has all clusters and the next one adds nothing.
+
+        Listings of up to METADATA_MAX_CLUSTERS clusters are kept for the metadata cache while they are paged,
+        larger ones are not cached, which would need all of them in memory.
+
+        :param Dict[str, str] headers:
+        :param int contract_id:
+        :param ClusterIndex index:
+        :param bool fail: if False, return None instead of exiting on errors
+        :return: index
+        :rtype: Optional[ClusterIndex]
+        """
+        cached = self._cached('clusters', contract_id)
+        if cached is not None:
+            try:
+                index.update(ClustersResponse({'list': cached}).list)
+                return index
+            except (KeyError, TypeError, ValueError, AttributeError):
+                pass
+        url = CLUSTER_URL.format(contract_id)
+        page_size = self._cluster_page_size
+        offset = 0
+        clusters = []  # as received, for the metadata cache, None once there are too many
+        seen = set()
+        while True:
+            paged = page_size > 0
+            try:
+                f = self._urlopen('{0}?offset={1}&limit={2}'.format(url, offset, page_size) if paged else url,
+                                  headers=headers)
+                answer = APIAnswer(json.loads(f.read()), ClustersResponse)
+            except urllib_error.URLError as e:
+                if paged and offset == 0 and getattr(e, 'code', None) == 400:
+                    # offset/limit are not supported, remembered so the next listing does not try again
+                    self._cluster_page_size = page_size = 0
+                    continue
+                if not fail:
+                    return None
+                if str(e).startswith("HTTP Error 401"):
+                    err(E_FAIL, "unauthorized")
+                err(E_FAIL, "urllib returned: " + str(e))
+            if answer.is_error():
+                if not fail:
+                    return None
+                err(E_FAIL, answer.error_msg())
+            page = answer.data().list
+            added = index.update(page)
+            if added and clusters is not None:
+                for x in answer.raw()['data']['list']:
+                    if x['id'] not in seen:
+                        seen.add(x['id'])
+                        clusters.append(x)
+                if len(clusters) > METADATA_MAX_CLUSTERS:
+                    clusters = seen = None
+            if added == 0 or not paged or len(page) != page_size:
+                if clusters is not None:
+                    self._store('clusters', clusters, contract_id)
+                return index
+            offset += len(page)
+
+    def post_license_from_nodehash(self, headers, nodehash, mac_addresses, hostname=None, contract_id=None, cluster_id=None):
         """
         Gets the license file content from nodehash and mac addresses.
 
@@ -1512,19 +4243,17 @@ class UrllibHandler(object):
             payload["contract_id"] = int(contract_id)
         if cluster_id:
             payload["cluster_id"] = int(cluster_id)
-        r = Request(LICENSE_URL, data=json.dumps(payload).encode('utf-8'), headers=headers)
         try:
-            f = urlopen(r)
+            f = self._urlopen(LICENSE_URL, data=json.dumps(payload).encode('utf-8'), headers=headers, retry=True)
 
             ret = f.read()
             ret = json.loads(ret)
 
             return APIAnswer(ret, CreateFromNodeHashResponse)
-        except URLError as e:
+        except urllib_error.URLError as e:
             err(E_FAIL, "Error license-from-nodehash: " + str(e))
 
-    @staticmethod
-    def post_is_node_registered(headers, contract_id, hostname, mac_addresses):
+    def post_is_node_registered(self, headers, contract_id, hostname, mac_addresses):
         """
 
         :param headers:
@@ -1538,23 +4267,20 @@ class UrllibHandler(object):
             "hostname": hostname,
             "mac_addresses": mac_addresses}
         url = urljoin(MYLINBIT, "/v1/my/contracts/{c}/is-node-registered".format(c=contract_id))
-        r = Request(url,
-                    data=json.dumps(payload).encode('utf-8'),
-                    headers=headers)
         try:
-            f = urlopen(r)
+            # read only, safe to replay
+            f = self._urlopen(url, data=json.dumps(payload).encode('utf-8'), headers=headers, retry=True)
             ret = f.read()
             ret = json.loads(ret)
             answer = APIAnswer(ret, IsNodeRegisteredResponse)
             if answer.is_error():
                 err(E_FAIL, answer.error_msg())
             return answer.data() if answer.data().is_registered() else None
-        except URLError as e:
+        except urllib_error.URLError as e:
             err(E_FAIL, "Error is-node-registered: " + str(e))
 
-    @staticmethod
     def post_register_node(
-            headers, contract_id, cluster_id, hostname, distribution, mac_addresses, register_version, hidden_repos):
+            self, headers, contract_id, cluster_id, hostname, distribution, mac_addresses, register_version, hidden_repos):
         """
         Do a POST request to the register-node endpoint.
 
@@ -1577,21 +4303,20 @@ class UrllibHandler(object):
             "hidden_repos": hidden_repos}
         url = urljoin(MYLINBIT, "v1/my/contracts/{co}/clusters/{cl}/register-node".format(
             co=contract_id, cl=cluster_id))
-        r = Request(url,
-                    data=json.dumps(payload).encode('utf-8'),
-                    headers=headers)
+        # the nodes of the clusters change, even if we do not learn whether the request succeeded
+        self._invalidate('clusters', contract_id)
         try:
-            f = urlopen(r)
+            # registering the same node again is what every rerun does, so this is safe to replay
+            f = self._urlopen(url, data=json.dumps(payload).encode('utf-8'), headers=headers, retry=True)
 
             ret = f.read()
             ret = json.loads(ret)
             answer = APIAnswer(ret, RegisteredNodeResponse)
             return answer
-        except URLError as e:
+        except urllib_error.URLError as e:
             err(E_FAIL, "Error register-node({u}): {e}".format(u=url, e=e))
 
-    @staticmethod
-    def post_create_cluster(headers, contract_id):
+    def post_create_cluster(self, headers, contract_id):
         """
 
         :param headers:
@@ -1600,9 +4325,11 @@ class UrllibHandler(object):
         :rtype: CreateClusterResponse
         """
         payload = {}
-        r = Request(CLUSTER_URL.format(contract_id), data=json.dumps(payload).encode('utf-8'), headers=headers)
+        self._invalidate('clusters', contract_id)
         try:
-            f = urlopen(r)
+            # not retried, a replay could create a second cluster
+            f = self._urlopen(CLUSTER_URL.format(contract_id), data=json.dumps(payload).encode('utf-8'),
+                              headers=headers, retry=False)
 
             ret = f.read()
             ret = json.loads(ret)
@@ -1610,74 +4337,300 @@ class UrllibHandler(object):
             if answer.is_error():
                 err(E_FAIL, "Error: " + answer.error_msg())
             return answer.data()
-        except URLError as e:
+        except urllib_error.URLError as e:
             err(E_FAIL, "Error create-cluster: " + str(e))
 
+    def prefetch(self, url):
+        """
+        Starts downloading url in the background, a later fileHandle(url) or download(url) uses the result.
+
+        Without a download cache there is no place to keep the content, nothing is prefetched then.
+
+        :param str url:
+        """
+        if self._cache is not None and url not in self._prefetched:
+            self._prefetched[url] = BackgroundTask(self._fetch, url)
+
+    def _fetch(self, url):
+        """
+        Downloads url to a local file, at most DOWNLOAD_CHUNK bytes of it are held in memory.
+
+        Cached content is revalidated with the server and only downloaded again if it changed.
+
+        :param str url:
+        :return: path and hex sha256 of the content, and whether the file is temporary and has to be removed
+        :rtype: Tuple[str, str, bool]
+        """
+        entry, path = self._cache.get(url) if self._cache is not None else (None, None)
+        headers = {}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        try:
+            f = self._urlopen(url, headers=headers, stream=True)
+        except urllib_error.HTTPError as e:
+            # urlopen() (proxied requests) reports 304 as error
+            if e.code != 304 or entry is None:
+                raise
+            f = None
+        if entry is not None and (f is None or f.getcode() == 304):
+            self._cache.touch(url)
+            return path, entry['sha256'], False
+
+        fd, tmp = self._cache.spool() if self._cache is not None else (None, None)
+        spooled = fd is not None
+        if not spooled:
+            fd, tmp = tempfile.mkstemp(suffix='_' + MYNAME)
+        h = hashlib.sha256()
+        try:
+            with os.fdopen(fd, 'wb') as outfile:
+                for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK), b''):
+                    h.update(chunk)
+                    outfile.write(chunk)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        finally:
+            f.close()
+
+        digest = h.hexdigest()
+        if spooled:
+            path = self._cache.put(url, tmp, digest, f.info())
+            if path is not None:
+                return path, digest, False
+        return tmp, digest, True
+
+    def _fetched(self, url):
+        task = self._prefetched.pop(url, None)
+        if task is not None:
+            return task.result()
+        return self._fetch(url)
+
     def fileHandle(self, url):
-        return urlopen(url)
+        """
+        :return: binary file object with the content of url
+        """
+        path, _, temporary = self._fetched(url)
+        f = open(path, 'rb')
+        if temporary:
+            os.unlink(path)  # the open file stays readable
+        return f
+
+    def download(self, url, dst):
+        """
+        Downloads url to the local file dst.
+
+        The content is streamed in chunks, dst is replaced atomically and only if its content differs.
+
+        :param str url:
+        :param str dst:
+        :return: True if dst changed
+        :rtype: bool
+        """
+        path, digest, temporary = self._fetched(url)
+        try:
+            if os.path.isfile(dst) and file_sha256(dst) == digest:
+                return False
+            with open(path, 'rb') as infile:
+                atomic_write(dst, iter(lambda: infile.read(DOWNLOAD_CHUNK), b''))
+            return True
+        finally:
+            if temporary:
+                os.unlink(path)
 
 
 # following from Python cookbook, #475186
 BLACK, RED, GREEN, YELLOW, BLUE, MAGENTA, CYAN, WHITE = list(range(8))
 
 
+# https://no-color.org/, also set by --no-color
+NO_COLOUR = bool(os.getenv('NO_COLOR'))
+# file descriptor -> result of has_colours(), terminal capabilities do not change while we run
+_colour_support = {}
+
+
 def has_colours(stream):
-    if not hasattr(stream, "isatty"):
+    if NO_COLOUR or not hasattr(stream, "isatty"):
         return False
+    try:
+        key = stream.fileno()
+    except Exception:
+        key = id(stream)
+    if key not in _colour_support:
+        _colour_support[key] = _detect_colours(stream)
+    return _colour_support[key]
+
+
+def _detect_colours(stream):
     if not stream.isatty():
         return False  # auto color only on TTYs
     try:
         import curses
-        curses.setupterm()
+        curses.setupterm(fd=stream.fileno())
         return curses.tigetnum("colors") > 2
     except Exception:
         # guess false in case of error
         return False
 
 
-def printcolour(text, colour=WHITE, stream=sys.stdout):
-    if has_colours(stream):
-        seq = "\x1b[1;{0}m{1}\x1b[0m".format(30+colour, text)
-        stream.write(seq)
+def colourise(text, colour=WHITE, stream=None):
+    if has_colours(stream or sys.stdout):
+        return "\x1b[1;{0}m{1}\x1b[0m".format(30+colour, text)
+    return text
+
+
+def printcolour(text, colour=WHITE, stream=None):
+    stream = stream or sys.stdout
+    stream.write(colourise(text, colour, stream))
+
+
+def buffer_stdout():
+    """
+    Switches stdout from line buffering (on a terminal) to block buffering.
+
+    Only meant for runs that do not ask questions, get_input() flushes stdout anyways.
+    """
+    try:
+        if not sys.stdout.isatty():
+            return  # already block buffered
+        fd = sys.stdout.fileno()
+    except Exception:
+        return
+    sys.stdout.flush()
+    if sys.version_info[0] >= 3:
+        sys.stdout = io.TextIOWrapper(io.open(os.dup(fd), 'wb'),
+                                      encoding=sys.stdout.encoding, errors=sys.stdout.errors)
     else:
-        stream.write(text)
+        sys.stdout = os.fdopen(os.dup(fd), 'w', io.DEFAULT_BUFFER_SIZE)
 
 
 def OK(text):
-    sys.stdout.write('[')
-    printcolour("OK", GREEN)
-    sys.stdout.write('] ')
-    print(text)
+    sys.stdout.write('[{0}] {1}\n'.format(colourise("OK", GREEN), text))
+
+
+def repo_version(name):
+    """
+    :return: the version in a repo name, e.g. (9, 1) for "drbd-9.1", () if there is none
+    :rtype: Tuple[int, ...]
+    """
+    m = re.search(r'-(\d+(?:\.\d+)*)', name)
+    if not m:
+        return ()
+    return tuple(int(x) for x in m.group(1).split('.'))
+
+
+class RepoSelector(object):
+    """
+    Enables/disables repos by rules, the rules are applied in order.
+
+    A rule is "[!][all|latest] PATTERN [OP VERSION]":
+    PATTERN is a repo name, a shell glob ("pacemaker-*") or a regular expression in slashes ("/^drbd-9[.][0-9]+$/"),
+    "all" without a pattern matches every repo. OP VERSION (e.g., ">=9.1") restricts the matches to repos
+    with a version (see repo_version()) in that range. "latest" only selects the match with the highest version.
+    Matching repos get enabled, or disabled if the rule starts with "!".
+    """
+    _rule_re = re.compile(r'^(?P<neg>!)?\s*(?:(?P<quant>all|latest)(?:\s+|$))?(?P<pattern>/.*/|[^\s<>=]+)?'
+                          r'\s*(?:(?P<op>>=|<=|==|>|<)\s*(?P<version>\d+(?:\.\d+)*))?$')
+    _ops = {'>=': operator.ge, '<=': operator.le, '==': operator.eq, '>': operator.gt, '<': operator.lt}
+
+    def __init__(self, rules):
+        """
+        :param List[str] rules: empty rules are ignored
+        :raises ValueError: for invalid rules
+        """
+        self._rules = []
+        for rule in rules:
+            rule = rule.strip()
+            if not rule:
+                continue
+            m = self._rule_re.match(rule)
+            if not m or not (m.group('pattern') or m.group('quant') == 'all'):
+                raise ValueError('invalid rule "{0}"'.format(rule))
+
+            pattern = m.group('pattern') or '*'
+            if pattern.startswith('/'):
+                try:
+                    match = re.compile(pattern[1:-1]).search
+                except re.error as e:
+                    raise ValueError('invalid regular expression in "{0}": {1}'.format(rule, e))
+            else:
+                match = re.compile(fnmatch.translate(pattern)).match
+
+            op = self._ops[m.group('op')] if m.group('op') else None
+            version = tuple(int(x) for x in m.group('version').split('.')) if op else None
+            self._rules.append((bool(m.group('neg')), m.group('quant') == 'latest', match, op, version))
+
+    def apply(self, enabled):
+        """
+        :param Dict[str, bool] enabled: repo name -> enabled, updated in place
+        :return: enabled
+        :rtype: Dict[str, bool]
+        """
+        for neg, latest, match, op, version in self._rules:
+            hits = [n for n in enabled if match(n) and (op is None or op(repo_version(n), version))]
+            if latest and hits:
+                # on equal versions prefer "drbd-9.2" over "drbd-9.2-only"
+                hits = [max(hits, key=lambda n: (repo_version(n), -len(n), n))]
+            for n in hits:
+                enabled[n] = not neg
+        return enabled
+
+    def select(self, names):
+        """
+        :return: repo name -> enabled, for repos that no rule enabled False
+        :rtype: Dict[str, bool]
+        """
+        return self.apply(dict((n, False) for n in names))
+
+
+def select_repos(names, rules, default):
+    """
+    :param Iterable[str] names:
+    :param Optional[List[str]] rules: RepoSelector rules, if None all repos are set to default
+    :param bool default:
+    :rtype: Dict[str, bool]
+    """
+    if rules is None:
+        return dict((n, default) for n in names)
+    return RepoSelector(rules).select(names)
+
+
+def clear_screen():
+    # an escape sequence instead of spawning "clear"
+    if sys.stdout.isatty():
+        sys.stdout.write("\033[H\033[2J")
 
 
 def ask_enable(names, free_running=False):
     """
     Asks the user which repos they wish to enable.
 
+    Every answer can toggle several repos by number ("1 3 5-7"), or set them by RepoSelector rules
+    ("latest drbd-9.*, !pacemaker-*").
+
     :param Dict[str, bool] names: A dict of repo name keys and bool if enabled/disabled.
     :param bool free_running: indicating if there will be no user input.
     :return: An array of dicts, keys are repo names, values are True if repo is
             enabled.
     :rtype: Dict[str, bool]
     """
-    repos = []
+    repo_map = dict(names)
     # Sort reverse to try to show newest versions first.
-    for name in sorted(names.keys(), reverse=True):
-        repos.append([name, names[name]])
+    repos = sorted(repo_map.keys(), reverse=True)
 
     # Skip asking questions in non-interacting mode.
     while not free_running:
         idx_offset = 1  # For converting between zero and one indexed arrays.
-        os.system("clear")
+        clear_screen()
         print("\n  Here are the repositories you can enable:\n")
-        for index, repo in enumerate(repos):
-
-            name, value = repo
-
+        for index, name in enumerate(repos):
             status = "Disabled"
             display_color = RED
 
-            if value:
+            if repo_map[name]:
                 status = "Enabled"
                 display_color = GREEN
 
@@ -1686,47 +4639,49 @@ def ask_enable(names, free_running=False):
                 display_color
             )
 
-        print("\n  Enter the number of the repository you "
-              "wish to enable/disable. Hit 0 when you are done.\n")
-        choice = get_input("  Enable/Disable: ")
+        print("\n  Enter the numbers of the repositories you wish to enable/disable (e.g., 1 3 5-7),")
+        print('  or rules like "latest drbd-9.*, all pacemaker-*, !drbd-proxy-*". Hit 0 when you are done.\n')
+        choice = get_input("  Enable/Disable: ").strip()
 
         # Ignore random button mashing.
         if not choice:
             continue
 
-        try:
-            choice = int(choice.strip())
-        except ValueError:
-            print("\n  You must enter a number!\n")
-            time.sleep(1)
-            continue
-
-        if choice == 0:
+        if choice == '0':
             break
 
-        choice_idx = choice - idx_offset
-        try:
-            # Toggle Enabled/Disabled
-            repos[choice_idx][1] = not repos[choice_idx][1]
-        except IndexError:
-            # User will see if state of the repos change,
-            # No need to complain.
-            pass
+        numbers = re.split(r'[\s,]+', choice)
+        if all(re.match(r'^\d+(-\d+)?$', n) for n in numbers):
+            for n in numbers:
+                first, _, last = n.partition('-')
+                for choice_idx in range(int(first) - idx_offset, int(last or first) - idx_offset + 1):
+                    # User will see if state of the repos change,
+                    # No need to complain.
+                    if 0 <= choice_idx < len(repos):
+                        repo_map[repos[choice_idx]] = not repo_map[repos[choice_idx]]
+            continue
 
-    repo_map = {}
-    for repo in repos:
-        name, enabled = repo
-        repo_map[name] = enabled
+        try:
+            RepoSelector(choice.split(',')).apply(repo_map)
+        except ValueError as e:
+            print("\n  {0}\n".format(e))
+            time.sleep(1)
 
     return repo_map
 
 
 if __name__ == "__main__":
+    exit_code = E_FAIL
     try:
         main()
+    except SystemExit as e:
+        exit_code = e.code or E_SUCC
+        raise
     except KeyboardInterrupt:
         print("")
         warn("Received Keyboard Interrupt signal, exiting...")
     except EOFError:
         print("")
         warn("Reached EOF waiting for input, exiting...")
+    finally:
+        EVENTS.finish(exit_code)
@@ -0,0 +1,428 @@
+"""
+Tests of linbit-manage-node.py against the mock of linbit-manage-node-bench.py.
+
+Runs with python3 -m pytest or python -m unittest, the mock is started in-process.
+"""
+
+import json
+import os
+import shutil
+import socket
+import stat
+import tempfile
+import threading
+import time
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def load(path, name):
+    # the scripts have dashes in their names, so they are not importable
+    namespace = {"__name__": name, "__file__": path}
+    with open(path) as f:
+        exec(compile(f.read(), path, "exec"), namespace)
+    return namespace
+
+
+bench = load(os.path.join(HERE, "linbit-manage-node-bench.py"), "linbit_manage_node_bench")
+
+
+class StaleServer(object):
+    """
+    Answers only the first request of every connection, later requests on a kept-alive connection are
+    read and the connection is closed without an answer, like a server that timed out the idle connection
+    while the request was on its way.
+    """
+    def __init__(self):
+        self.requests = []
+        self._sock = socket.socket()
+        self._sock.bind(("127.0.0.1", 0))
+        self._sock.listen(8)
+        self.url = "http://127.0.0.1:{0}/".format(self._sock.getsockname()[1])
+        thread = threading.Thread(target=self._serve)
+        thread.daemon = True
+        thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except socket.error:
+                return
+            thread = threading.Thread(target=self._handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _handle(self, conn):
+        answered = False
+        while True:
+            data = b""
+            while b"\r\n\r\n" not in data:
+                chunk = conn.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+            if not data:
+                break
+            self.requests.append(data.split(b" ")[0].decode("ascii"))
+            if answered:
+                break
+            conn.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+            answered = True
+        conn.close()
+
+    def close(self):
+        self._sock.close()
+
+
+class MockTestCase(unittest.TestCase):
+    MOCK_ARGS = ["--gzip"]
+
+    @classmethod
+    def setUpClass(cls):
+        args = bench["build_parser"]().parse_args(["serve"] + cls.MOCK_ARGS)
+        cls.server = bench["start_mock"](args)
+        cls.lmn = bench["load_client"](bench["CLIENT"], cls.server.url)
+        cls.state = cls.server.state
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def handler(self):
+        return self.lmn["UrllibHandler"](pool=self.lmn["HTTPConnectionPool"]())
+
+    def requests(self, endpoint):
+        return self.state.snapshot(self.state.stats)["endpoints"].get(endpoint, 0)
+
+
+class TokenCacheTest(MockTestCase):
+    def test_cached_token(self):
+        cache = self.lmn["TokenCache"](os.path.join(self.tmp, "lmn", "token.json"))
+        logins = self.requests("login")
+
+        headers = {}
+        self.assertEqual(self.handler().login(headers, "bench", "bench", cache), 200)
+        self.assertEqual(self.requests("login"), logins + 1)
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.join(self.tmp, "lmn")).st_mode), 0o700)
+        with open(os.path.join(self.tmp, "lmn", "token.json")) as f:
+            entry = list(json.load(f).values())[0]
+        self.assertEqual(entry["iterations"], self.lmn["TokenCache"].PBKDF2_ITERATIONS)
+        self.assertNotIn("bench", entry["password"])
+
+        cached = {}
+        self.assertEqual(self.handler().login(cached, "bench", "bench", cache), 200)
+        self.assertEqual(cached, headers)
+        self.assertEqual(self.requests("login"), logins + 1)
+        self.assertTrue(self.state.authorized(cached["Authorization"]))
+
+    def test_wrong_password(self):
+        cache = self.lmn["TokenCache"](os.path.join(self.tmp, "token.json"))
+        self.assertEqual(self.handler().login({}, "bench", "bench", cache), 200)
+        logins = self.requests("login")
+
+        headers = {}
+        self.assertEqual(self.handler().login(headers, "bench", "wrong", cache), 401)
+        self.assertNotIn("Authorization", headers)
+        self.assertEqual(self.requests("login"), logins + 1)
+        # the token of the right password is still cached
+        self.assertIsNotNone(cache.get("bench", "bench"))
+
+    def test_unsalted_entry(self):
+        # entries of older versions have no PBKDF2 iterations and are not used
+        path = os.path.join(self.tmp, "token.json")
+        cache = self.lmn["TokenCache"](path)
+        self.assertEqual(self.handler().login({}, "bench", "bench", cache), 200)
+        with open(path) as f:
+            tokens = json.load(f)
+        for entry in tokens.values():
+            del entry["iterations"]
+        with open(path, "w") as f:
+            json.dump(tokens, f)
+        self.assertIsNone(cache.get("bench", "bench"))
+
+    def test_existing_directory(self):
+        os.chmod(self.tmp, 0o755)
+        cache = self.lmn["TokenCache"](os.path.join(self.tmp, "token.json"))
+        self.assertEqual(self.handler().login({}, "bench", "bench", cache), 200)
+        self.assertEqual(stat.S_IMODE(os.stat(self.tmp).st_mode), 0o700)
+
+
+class StaleConnectionTest(MockTestCase):
+    def test_post_not_replayed(self):
+        server = StaleServer()
+        self.addCleanup(server.close)
+        pool = self.lmn["HTTPConnectionPool"](retry_policy=self.lmn["RetryPolicy"](attempts=1))
+
+        pool.request("GET", server.url)  # leaves an idle connection the server will not answer on
+        self.assertEqual(pool.request("POST", server.url, body=b"{}").read(), b"ok")
+        self.assertEqual(server.requests.count("POST"), 1)
+
+    def test_post_retried_if_allowed(self):
+        server = StaleServer()
+        self.addCleanup(server.close)
+        pool = self.lmn["HTTPConnectionPool"](retry_policy=self.lmn["RetryPolicy"](attempts=1))
+
+        # like the login, the caller knows sending it twice does no harm
+        pool.request("GET", server.url)
+        self.assertEqual(pool.request("POST", server.url, body=b"{}", retry=True).read(), b"ok")
+        self.assertEqual(server.requests.count("POST"), 2)
+
+    def test_get_retried(self):
+        server = StaleServer()
+        self.addCleanup(server.close)
+        pool = self.lmn["HTTPConnectionPool"](retry_policy=self.lmn["RetryPolicy"](attempts=1))
+
+        pool.request("GET", server.url)
+        self.assertEqual(pool.request("GET", server.url).read(), b"ok")
+        self.assertEqual(server.requests, ["GET", "GET", "GET"])
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.lmn = bench["load_client"](bench["CLIENT"])
+
+    def test_single_trial(self):
+        URLError = self.lmn["urllib_error"].URLError
+        breaker = self.lmn["CircuitBreaker"](threshold=2, cooldown=0.0)
+        self.assertFalse(breaker.check("h"))
+        breaker.failure("h")
+        self.assertFalse(breaker.check("h"))
+        breaker.failure("h")
+
+        self.assertTrue(breaker.check("h"))
+        self.assertRaises(URLError, breaker.check, "h")  # only one trial at a time
+        breaker.failure("h")
+        self.assertTrue(breaker.check("h"))
+        breaker.release("h")
+        self.assertTrue(breaker.check("h"))
+        breaker.success("h")
+        self.assertFalse(breaker.check("h"))
+        self.assertFalse(breaker.check("h"))
+
+    def test_cooldown(self):
+        breaker = self.lmn["CircuitBreaker"](threshold=1, cooldown=60.0)
+        breaker.failure("h")
+        self.assertRaises(self.lmn["urllib_error"].URLError, breaker.check, "h")
+        self.assertFalse(breaker.check("other"))
+
+
+class BestKmodResolverTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.lmn = bench["load_client"](bench["CLIENT"])
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache = self.lmn["DownloadCache"].open(self.tmp)
+        self.remote = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def resolver(self, uname_r, answer):
+        test = self
+
+        class Distribution(object):
+            family, name, osrelease_text = "rhel", "rhel9", 'ID="rhel"\nVERSION_ID="9.2"\n'
+
+        class Resolver(self.lmn["BestKmodResolver"]):
+            def _remote(self):
+                test.remote.append(uname_r)
+                return answer
+
+        return Resolver(Distribution(), self.cache, kmod_list="", uname_r=uname_r).best()
+
+    def test_cached(self):
+        self.assertEqual(self.resolver("5.14.0-1.el9.x86_64", "kmod-drbd-a"), "kmod-drbd-a")
+        self.assertEqual(self.resolver("5.14.0-1.el9.x86_64", "kmod-drbd-b"), "kmod-drbd-a")
+        self.assertEqual(self.remote, ["5.14.0-1.el9.x86_64"])
+
+    def test_expired(self):
+        self.assertEqual(self.resolver("5.14.0-1.el9.x86_64", "kmod-drbd-a"), "kmod-drbd-a")
+        state = self.cache.load_state("best-kmod")
+        state["checked"] -= self.lmn["BEST_KMOD_TTL"]
+        self.cache.save_state("best-kmod", state)
+        self.assertEqual(self.resolver("5.14.0-1.el9.x86_64", "kmod-drbd-b"), "kmod-drbd-b")
+
+    def test_other_kernel(self):
+        self.resolver("5.14.0-1.el9.x86_64", "kmod-drbd-a")
+        self.assertEqual(self.resolver("5.14.0-2.el9.x86_64", "kmod-drbd-b"), "kmod-drbd-b")
+        self.assertEqual(self.cache.load_state("best-kmod")["best"], "kmod-drbd-b")
+        self.assertEqual(len(self.remote), 2)
+
+
+class RangeTest(MockTestCase):
+    def test_range_uncompressed(self):
+        handler = self.handler()
+        f = handler.get_range(self.lmn["SELF"], 0, 99)
+        self.assertEqual(f.getcode(), 206)
+        self.assertEqual(f.read(), self.server.script[:100])
+        self.assertEqual(self.state.last["self"]["headers"].get("accept-encoding"), "identity")
+
+    def test_full_download_compressed(self):
+        f = self.handler().fileHandle(self.lmn["SELF"])
+        self.assertEqual(f.read(), self.server.script)
+        self.assertEqual(self.state.last["self"]["headers"].get("accept-encoding"), "gzip")
+
+    def test_upstream_version(self):
+        self.assertEqual(self.lmn["upstream_version"](self.handler()),
+                         tuple(int(x) for x in self.lmn["VERSION"].split(".")[:2]))
+
+
+class FastPathTest(MockTestCase):
+    def setUp(self):
+        MockTestCase.setUp(self)
+        self.written = []
+        saved = dict((k, self.lmn[k]) for k in ("writeFile", "isRoot"))
+        self.addCleanup(self.lmn.update, saved)
+        # nothing of this host gets written, the keyring is only installed by root
+        self.lmn["writeFile"] = lambda name, content, **kwargs: self.written.append(name) or True
+        self.lmn["isRoot"] = lambda: False
+
+        cluster_id = self.state.create_cluster(1)["id"]
+        macs = ["52:54:00:00:00:01", "52:54:00:00:00:02"]
+        node = self.state.register(1, cluster_id, "fast", macs)
+        self.reg_data = {
+            "nodehash": node["nodehash"],
+            "contract_id": 1,
+            "cluster_id": str(cluster_id),
+            "hostname": "fast",
+            "distribution": "debian-bookworm",
+            "mac_addresses": ",".join(macs),
+            "hidden_repos": False,
+            "repos": dict((k, v["config"]) for k, v in
+                          bench["repo_configs"](self.server.packages, node["nodehash"], "debian-bookworm",
+                                                False).items()),
+            "registered_at": int(time.time()) - 60,
+        }
+        self.macs = set(macs)
+
+    def test_registration_is_current(self):
+        current = self.lmn["registration_is_current"]
+        self.assertTrue(current(self.reg_data, "fast", self.macs, "debian-bookworm", 0, False))
+        self.assertTrue(current(self.reg_data, "fast", self.macs, "debian-bookworm", None, False))
+        self.assertTrue(current(self.reg_data, "fast", self.macs, "debian-bookworm",
+                                int(self.reg_data["cluster_id"]), False))
+        self.assertFalse(current(self.reg_data, "fast", self.macs, "debian-bookworm",
+                                 int(self.reg_data["cluster_id"]) + 1, False))
+        self.assertFalse(current(self.reg_data, "fast", set(["52:54:00:00:00:01"]), "debian-bookworm", 0, False))
+        self.assertFalse(current(self.reg_data, "fast", self.macs, "debian-bookworm", 0, True))
+        self.assertFalse(current(None, "fast", self.macs, "debian-bookworm", 0, False))
+
+    def test_registration_expired(self):
+        current = self.lmn["registration_is_current"]
+        self.assertTrue(current(self.reg_data, "fast", self.macs, "debian-bookworm", 0, False, 120))
+        self.assertFalse(current(self.reg_data, "fast", self.macs, "debian-bookworm", 0, False, 30))
+        self.assertFalse(current(self.reg_data, "fast", self.macs, "debian-bookworm", 0, False, 0))
+        del self.reg_data["registered_at"]  # written by an older version
+        self.assertFalse(current(self.reg_data, "fast", self.macs, "debian-bookworm", 0, False))
+
+    def test_refresh_registration(self):
+        registrations = self.requests("register-node")
+        handler = self.handler()
+        headers = {}
+        self.assertEqual(handler.login(headers, "bench", "bench"), 200)
+
+        self.lmn["refresh_registration"](handler, headers, self.reg_data, "fast", self.macs, "debian-bookworm",
+                                         "debian", None)
+
+        self.assertEqual(self.requests("register-node"), registrations)
+        data = self.state.last["license-from-nodehash"]["data"]
+        self.assertEqual(data["nodehash"], self.reg_data["nodehash"])
+        self.assertEqual(data["contract_id"], 1)
+        self.assertEqual(data["cluster_id"], int(self.reg_data["cluster_id"]))
+        self.assertEqual(sorted(data["mac_addresses"]), sorted(self.macs))
+        self.assertEqual(self.written, ["/etc/drbd-proxy.license", self.lmn["REPO_FILES"]["debian"]])
+
+    def test_contract_id_of_old_registration(self):
+        del self.reg_data["contract_id"]
+        handler = self.handler()
+        self.lmn["refresh_registration"](handler, {}, self.reg_data, "fast", self.macs, "debian-bookworm",
+                                         "debian", None, contract_id=1)
+        self.assertEqual(self.state.last["license-from-nodehash"]["data"]["contract_id"], 1)
+
+
+class NodeMacsTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.lmn = bench["load_client"](bench["CLIENT"])
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.classnet = os.path.join(self.tmp, "class", "net")
+        os.makedirs(self.classnet)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def device(self, name, **attrs):
+        path = os.path.join(self.tmp, "devices", name)
+        os.makedirs(path)
+        for attr, value in attrs.items():
+            with open(os.path.join(path, attr), "w") as f:
+                f.write(value + "\n")
+        os.symlink(path, os.path.join(self.classnet, name))
+        return path
+
+    def test_macs(self):
+        self.device("eth0", type="1", addr_assign_type="0", address="52:54:00:00:00:01")
+        self.device("eth1", type="1", address="52:54:00:00:00:02")  # very old kernel
+        self.device("vnet0", type="1", address="52:54:00:00:00:03")
+        self.device("ib0", type="32", addr_assign_type="0", address="80:00:00:00:00:04")
+        self.device("veth0", type="1", addr_assign_type="1", address="52:54:00:00:00:05")
+        self.assertEqual(self.lmn["node_macs"](self.classnet), set(["52:54:00:00:00:01", "52:54:00:00:00:02"]))
+
+    def test_vanished_device(self):
+        self.device("eth0", type="1", addr_assign_type="0", address="52:54:00:00:00:01")
+        shutil.rmtree(self.device("eth1", type="1", addr_assign_type="0", address="52:54:00:00:00:02"))
+        self.assertEqual(self.lmn["node_macs"](self.classnet), set(["52:54:00:00:00:01"]))
+
+    def test_read_error(self):
+        path = self.device("eth0", type="1", addr_assign_type="0")
+        os.mkdir(os.path.join(path, "address"))  # reading it fails with EISDIR
+        self.assertRaises(OSError, self.lmn["node_macs"], self.classnet)
+
+
+class ClusterListingTest(MockTestCase):
+    MOCK_ARGS = ["--clusters", "30", "--cluster-nodes", "1"]
+
+    def setUp(self):
+        MockTestCase.setUp(self)
+        self.addCleanup(self.lmn.update, {"METADATA_MAX_CLUSTERS": self.lmn["METADATA_MAX_CLUSTERS"]})
+        self.cache = self.lmn["MetadataCache"](os.path.join(self.tmp, "metadata.json"))
+
+    def listing(self):
+        handler = self.lmn["UrllibHandler"](pool=self.lmn["HTTPConnectionPool"](), cluster_page_size=10,
+                                            metadata=self.cache)
+        headers = {}
+        self.assertEqual(handler.login(headers, "bench", "bench"), 200)
+        index = handler.get_cluster_index(headers, 1, self.lmn["ClusterIndex"]())
+        self.assertEqual(index.by_hostname("c30-n0"), 30)
+        return index
+
+    def test_cached(self):
+        self.listing()
+        requests = self.requests("clusters")
+        self.listing()
+        self.assertEqual(self.requests("clusters"), requests)
+
+    def test_too_many_to_cache(self):
+        self.lmn["METADATA_MAX_CLUSTERS"] = 15
+        self.listing()
+        requests = self.requests("clusters")
+        self.listing()
+        self.assertEqual(self.requests("clusters"), requests + 4)
+
+
+if __name__ == "__main__":
+    unittest.main()